@@ -0,0 +1,366 @@
+# Copyright (C) 2011 Johan Rydberg
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Time the hot paths of gossip and compare against a baseline.
+
+Usage::
+
+    python benchmarks/hotpaths.py [--quick] [--only NAME]
+        [--save FILE] [--compare FILE] [--against REV]
+        [--threshold RATIO]
+
+Every benchmark is run for a number of peer and key counts and
+reported as seconds per call, the best of several repetitions, along
+with how far the median repetition is above the best.  With C{--save}
+the results are written to a JSON baseline.  With C{--compare} they
+are checked against one; the run fails if any benchmark is more than
+C{--threshold} times slower than its baseline, after allowing for the
+spread seen in either run.  Benchmarks that look slower are timed once
+more before they count.
+
+Baselines are only comparable when taken on the same machine.  To
+measure a change against the commit it is based on, run::
+
+    python benchmarks/hotpaths.py --quick --against HEAD
+
+which exports C{REV} with C{git archive}, times the package found
+there with this script, and then compares the working tree with it.
+"""
+
+import json
+import optparse
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if __name__ == '__main__':
+    # Import the package from --tree if given, and otherwise from the
+    # tree this script lives in rather than from benchmarks/.
+    if '--tree' in sys.argv:
+        sys.path.insert(0, sys.argv[sys.argv.index('--tree') + 1])
+    else:
+        sys.path.insert(0, ROOT)
+
+from twisted.internet import task
+
+from txgossip.codec import BinaryCodec, JSONCodec
+from txgossip.detector import FailureDetector
+from txgossip.recipies import KeyStoreMixin
+from txgossip.scuttle import Scuttle
+from txgossip.state import PeerState
+
+
+class NullParticipant(object):
+
+    def value_changed(self, peer, key, value):
+        pass
+
+    def peer_alive(self, peer):
+        pass
+
+    def peer_dead(self, peer):
+        pass
+
+
+def peer_name(i):
+    return '10.0.%d.%d:9000' % (i // 256, i % 256)
+
+
+def build_scuttle(peers, keys, lag=0):
+    """Return a scuttle over C{peers} peers with C{keys} keys each,
+    each key set twice, and a digest that is C{lag} versions behind
+    it for every peer.
+    """
+    clock = task.Clock()
+    participant = NullParticipant()
+    states = {}
+    local = None
+    for i in range(peers):
+        state = PeerState(clock, participant, name=peer_name(i))
+        for j in range(2 * keys):
+            state.update_local('service:%d' % (j % keys),
+                               [1300000000.0 + j, 'value %d' % j])
+        states[state.name] = state
+        if local is None:
+            local = state
+    scuttle = Scuttle(states, local)
+    behind = dict((name, max(0, version - lag))
+                  for (name, version) in scuttle.digest().items())
+    return scuttle, behind
+
+
+def bench_digest(peers, keys):
+    scuttle, behind = build_scuttle(peers, keys)
+    return lambda: scuttle.digest_slice()
+
+
+def bench_scuttle(peers, keys):
+    scuttle, behind = build_scuttle(peers, keys, lag=keys // 2)
+    return lambda: scuttle.scuttle(behind, 1336)
+
+
+def bench_fetch_deltas(peers, keys):
+    scuttle, behind = build_scuttle(peers, keys, lag=keys // 2)
+    return lambda: scuttle.fetch_deltas(behind, 1336)
+
+
+def bench_deltas_after_version(peers, keys):
+    scuttle, behind = build_scuttle(1, keys * peers)
+    state = scuttle.local_peer
+    version = state.max_version_seen - keys
+    return lambda: state.deltas_after_version(version)
+
+
+def bench_phi(peers, keys):
+    detectors = []
+    for i in range(peers):
+        detector = FailureDetector()
+        for j in range(1000):
+            detector.add(j + (i % 7) * 0.01)
+        detectors.append(detector)
+    def run():
+        for detector in detectors:
+            detector.phi(1000.5)
+    return run
+
+
+def message(peers, keys):
+    scuttle, behind = build_scuttle(peers, keys, lag=keys // 2)
+    deltas = scuttle.fetch_deltas(behind, 1336)
+    return {'type': 'first-response', 'digest': dict(scuttle.digest()),
+            'updates': [list(delta) for delta in deltas]}
+
+
+def bench_json_encode(peers, keys):
+    codec, m = JSONCodec(), message(peers, keys)
+    return lambda: codec.encode(m)
+
+
+def bench_json_decode(peers, keys):
+    codec = JSONCodec()
+    data = codec.encode(message(peers, keys))
+    return lambda: codec.decode(data)
+
+
+def bench_binary_encode(peers, keys):
+    codec, m = BinaryCodec(), message(peers, keys)
+    return lambda: codec.encode(m)
+
+
+def bench_binary_decode(peers, keys):
+    codec = BinaryCodec()
+    data = codec.encode(message(peers, keys))
+    return lambda: codec.decode(data)
+
+
+class _KeyStoreGossiper(object):
+
+    name = 'self'
+
+    def __init__(self, keys):
+        self._keys = keys
+
+    def keys(self):
+        return self._keys
+
+
+def bench_keys_pattern(peers, keys):
+    keystore = KeyStoreMixin(task.Clock(), {})
+    keystore.make_connection(_KeyStoreGossiper(
+            ['service:%d:key:%d' % (i, j)
+             for i in range(peers) for j in range(keys)]))
+    def run():
+        keystore.keys('service:1:*')
+        keystore.keys('*:key:1')
+    return run
+
+
+BENCHMARKS = [
+    ('digest', bench_digest),
+    ('scuttle', bench_scuttle),
+    ('fetch_deltas', bench_fetch_deltas),
+    ('deltas_after_version', bench_deltas_after_version),
+    ('phi', bench_phi),
+    ('json_encode', bench_json_encode),
+    ('json_decode', bench_json_decode),
+    ('binary_encode', bench_binary_encode),
+    ('binary_decode', bench_binary_decode),
+    ('keys_pattern', bench_keys_pattern),
+    ]
+
+SIZES = [(10, 10), (100, 10), (100, 100), (1000, 10)]
+QUICK_SIZES = [(10, 10), (100, 10)]
+
+
+def time_call(fn, min_time=0.2, repeat=7):
+    """Time C{fn}, with each repetition taking at least C{min_time}
+    seconds.
+
+    @return: The best time of a single call, and how far the median
+        repetition is above it, as a fraction of the best.
+    """
+    timer = timeit.Timer(fn)
+    number = 1
+    while timer.timeit(number) < min_time / 4:
+        number *= 4
+    number *= 4
+    times = sorted(timer.repeat(repeat, number))
+    best = times[0]
+    return best / number, times[len(times) // 2] / best - 1
+
+
+def benchmarks(sizes, only=None):
+    """Yield the label and setup function of every benchmark to run."""
+    for name, setup in BENCHMARKS:
+        if only and name not in only:
+            continue
+        for peers, keys in sizes:
+            label = '%s/peers=%d,keys=%d' % (name, peers, keys)
+            yield label, lambda setup=setup, peers=peers, keys=keys: (
+                setup(peers, keys))
+
+
+def run(sizes, only=None):
+    """Run the benchmarks.
+
+    @return: A mapping from label to the best time and the spread
+        returned by L{time_call}.
+    """
+    results = {}
+    for label, setup in benchmarks(sizes, only):
+        best, spread = results[label] = time_call(setup())
+        print "%-44s %12.2f us  +%3.0f%%" % (label, best * 1e6, spread * 100)
+        sys.stdout.flush()
+    return results
+
+
+def compare(results, baseline, threshold, retime=None):
+    """Print how C{results} compare with C{baseline}.
+
+    A benchmark is slower if its ratio to the baseline is above
+    C{threshold} grown by the larger of the two spreads.  If given,
+    C{retime} is called with the label of such a benchmark and
+    returns a new result for it, which is used instead.
+
+    @return: The labels of the benchmarks that got slower.
+    """
+    slower = []
+    print
+    print "%-44s %9s" % ('benchmark', 'vs base')
+    for label in sorted(results):
+        if label not in baseline:
+            continue
+        base, base_spread = baseline[label]
+        for attempt in range(2):
+            best, spread = results[label]
+            ratio = best / base
+            limit = threshold * (1 + max(spread, base_spread))
+            if ratio <= limit or retime is None or attempt:
+                break
+            results[label] = min(results[label], retime(label))
+        flag = ''
+        if ratio > limit:
+            slower.append(label)
+            flag = '  SLOWER'
+        print "%-44s %8.2fx%s" % (label, ratio, flag)
+    return slower
+
+
+def run_against(rev, options):
+    """Time the package as of git revision C{rev} with this script.
+
+    @return: The results, as returned by L{run}.
+    """
+    tree = tempfile.mkdtemp(prefix='hotpaths-')
+    try:
+        archive = subprocess.Popen(['git', 'archive', rev, 'txgossip'],
+                                   cwd=ROOT, stdout=subprocess.PIPE)
+        subprocess.check_call(['tar', '-x', '-C', tree],
+                              stdin=archive.stdout)
+        if archive.wait():
+            raise SystemExit("cannot export revision %r" % (rev,))
+        save = os.path.join(tree, 'baseline.json')
+        args = [sys.executable, os.path.abspath(__file__),
+                '--tree', tree, '--save', save]
+        if options.quick:
+            args.append('--quick')
+        for name in options.only or ():
+            args.extend(['--only', name])
+        print "baseline: %s" % (rev,)
+        subprocess.check_call(args)
+        print
+        with open(save) as f:
+            return json.load(f)['results']
+    finally:
+        shutil.rmtree(tree)
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--quick', action='store_true',
+                      help="only run the smaller sizes")
+    parser.add_option('--only', action='append',
+                      help="only run the named benchmark")
+    parser.add_option('--save', metavar='FILE',
+                      help="write the results to a baseline")
+    parser.add_option('--compare', metavar='FILE',
+                      help="compare the results with a baseline")
+    parser.add_option('--against', metavar='REV',
+                      help="compare the results with git revision REV")
+    parser.add_option('--tree', metavar='DIR',
+                      help="time the package found in DIR")
+    parser.add_option('--threshold', type='float', default=1.25,
+                      help="slowdown that fails a comparison")
+    options, args = parser.parse_args()
+
+    sizes = QUICK_SIZES if options.quick else SIZES
+    baseline = None
+    if options.against:
+        baseline = run_against(options.against, options)
+    results = run(sizes, options.only)
+    if options.save:
+        with open(options.save, 'w') as f:
+            json.dump({'python': platform.python_version(),
+                       'machine': platform.machine(),
+                       'results': results}, f, indent=2, sort_keys=True)
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)['results']
+    if baseline is not None:
+        setups = dict(benchmarks(sizes, options.only))
+        retime = lambda label: time_call(setups[label](), repeat=15)
+        slower = compare(results, baseline, options.threshold, retime)
+        if slower:
+            print
+            print "%d benchmark(s) slower than %.2fx the baseline" % (
+                len(slower), options.threshold)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
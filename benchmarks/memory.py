@@ -0,0 +1,134 @@
+# Copyright (C) 2011 Johan Rydberg
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Report how much memory a view of a cluster takes up.
+
+Usage::
+
+    python benchmarks/memory.py [--peers N] [--keys K] [--heartbeats H]
+
+Builds the peer states a node would hold for a cluster of C{N} peers
+that each publish the same C{K} keys, and reports the number of bytes
+per peer and per key, as measured by walking the object graph.
+"""
+
+import optparse
+import os
+import sys
+
+if __name__ == '__main__':
+    # Import the package from the tree this script lives in rather
+    # than from benchmarks/.
+    sys.path.insert(0, os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))))
+
+from twisted.internet import task
+
+from txgossip.state import PeerState, ValueStore
+
+
+class NullParticipant(object):
+
+    def value_changed(self, peer, key, value):
+        pass
+
+    def peer_alive(self, peer):
+        pass
+
+    def peer_dead(self, peer):
+        pass
+
+
+def deep_size(obj, seen):
+    """Return the size of C{obj} and everything it references that
+    is not in C{seen}.
+    """
+    size = 0
+    pending = [obj]
+    while pending:
+        obj = pending.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            pending.extend(obj.keys())
+            pending.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            pending.extend(obj)
+        if hasattr(obj, '__dict__'):
+            pending.append(obj.__dict__)
+        for cls in type(obj).__mro__:
+            for name in getattr(cls, '__slots__', ()):
+                if hasattr(obj, name):
+                    pending.append(getattr(obj, name))
+    return size
+
+
+def build_view(clock, participant, peers, keys, heartbeats):
+    states = []
+    values = ValueStore()
+    for i in range(peers):
+        state = PeerState(clock, participant, name='10.0.%d.%d:9000' % (
+                i // 256, i % 256), values=values)
+        for j in range(keys):
+            state.update_with_delta('service:%d' % j, [1300000000.0 + j,
+                                    'value'], state.max_version_seen + 1)
+        for j in range(heartbeats):
+            state.detector.add(float(j))
+        states.append(state)
+    return states
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--peers', type='int', default=1000)
+    parser.add_option('--keys', type='int', default=20)
+    parser.add_option('--heartbeats', type='int', default=1000)
+    options, args = parser.parse_args()
+
+    clock = task.Clock()
+    participant = NullParticipant()
+    # Things that are shared by all peers are not counted.
+    shared = set([id(clock), id(participant), id(None), id(True), id(False)])
+
+    empty = build_view(clock, participant, options.peers, 0,
+                       options.heartbeats)
+    per_peer = deep_size(empty, set(shared)) / float(options.peers)
+
+    full = build_view(clock, participant, options.peers, options.keys,
+                      options.heartbeats)
+    total = deep_size(full, set(shared))
+    per_key = 0
+    if options.keys:
+        per_key = ((total / float(options.peers) - per_peer)
+                   / options.keys)
+
+    print "peers:         %d" % options.peers
+    print "keys per peer: %d" % options.keys
+    print "bytes/peer:    %.0f (without keys)" % per_peer
+    print "bytes/key:     %.0f" % per_key
+    print "total:         %.1f MiB" % (total / 1048576.0)
+
+
+if __name__ == '__main__':
+    main()
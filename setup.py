@@ -5,5 +5,6 @@ setup(name='txgossip',
       author='Johan Rydberg',
       author_email='johan.rydberg@gmail.com',
       url='http://github.com/jrydberg/txgossip',
-      packages=find_packages()
+      packages=find_packages(),
+      extras_require={'numpy': ['numpy']}
 )
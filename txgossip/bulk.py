@@ -0,0 +1,230 @@
+# Copyright (C) 2011 Johan Rydberg
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Bulk transfer of cluster state over TCP.
+
+Gossip brings a node up to date a datagram at a time, which takes
+many rounds for a node that joins a large cluster or that has been
+away for long.  L{BulkSync} lets such a node fetch a compressed
+snapshot of all state from another node over TCP in one transfer,
+after which it goes on with gossip as usual.
+
+The TCP port of a node is by default the same number as its gossip
+port.  A snapshot is sent as zlib-compressed JSON, and the
+connection is closed when it is complete.
+"""
+
+import json
+import random
+import zlib
+
+from twisted.internet import defer, error, protocol
+from twisted.python import log
+
+from txgossip.gossip import _address_from_peer_name
+
+
+class SnapshotError(Exception):
+    """Raised when a snapshot transfer fails."""
+
+
+def encode_snapshot(snapshot):
+    return zlib.compress(json.dumps(snapshot, separators=(',', ':')))
+
+
+def decode_snapshot(data, max_size=None):
+    """Decode a snapshot encoded by L{encode_snapshot}.
+
+    @param max_size: If given, the largest number of bytes the
+        snapshot may take up once decompressed.
+    """
+    try:
+        if max_size is None:
+            return json.loads(zlib.decompress(data))
+        decompressor = zlib.decompressobj()
+        text = decompressor.decompress(data, max_size + 1)
+        if len(text) > max_size:
+            raise SnapshotError("snapshot larger than %d bytes" % max_size)
+        return json.loads(text + decompressor.flush())
+    except (zlib.error, ValueError), e:
+        raise SnapshotError(str(e))
+
+
+class _SnapshotSender(protocol.Protocol):
+
+    def connectionMade(self):
+        self.transport.write(encode_snapshot(self.factory.gossiper.snapshot()))
+        self.transport.loseConnection()
+
+
+class _SnapshotReceiver(protocol.Protocol):
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.chunks = []
+        self.size = 0
+
+    def dataReceived(self, data):
+        max_size = self.factory.max_size
+        self.size += len(data)
+        if max_size is not None and self.size > max_size:
+            self.factory.fail(SnapshotError(
+                    "snapshot larger than %d bytes" % max_size))
+            self.transport.loseConnection()
+            return
+        self.chunks.append(data)
+
+    def connectionLost(self, reason):
+        if not reason.check(error.ConnectionDone):
+            self.factory.fail(reason)
+            return
+        try:
+            snapshot = decode_snapshot(''.join(self.chunks),
+                                       self.factory.max_size)
+        except SnapshotError, e:
+            self.factory.fail(e)
+        else:
+            self.factory.succeed(snapshot)
+
+
+class _SnapshotClientFactory(protocol.ClientFactory):
+
+    def __init__(self, max_size):
+        self.deferred = defer.Deferred()
+        self.max_size = max_size
+
+    def buildProtocol(self, addr):
+        return _SnapshotReceiver(self)
+
+    def clientConnectionFailed(self, connector, reason):
+        self.fail(reason)
+
+    def succeed(self, snapshot):
+        if not self.deferred.called:
+            self.deferred.callback(snapshot)
+
+    def fail(self, reason):
+        # The transfer may already have been given up on.
+        if not self.deferred.called:
+            self.deferred.errback(reason)
+
+
+class BulkSync(object):
+    """Serves snapshots of a gossiper's state over TCP and fetches
+    them from other nodes.
+
+    Once attached, a snapshot is fetched whenever the digest of a
+    peer shows that we are at least C{threshold} versions behind, at
+    most once every C{min_interval} seconds.  Call L{join} right after
+    starting the gossiper to fetch the state from a seed.
+    """
+
+    def __init__(self, gossiper, reactor=None, tcp_port=None,
+                 threshold=1000, min_interval=60, timeout=30,
+                 max_size=64 * 1024 * 1024):
+        """
+        @param gossiper: The L{Gossiper} whose state is synchronized.
+        @param tcp_port: TCP port of other nodes, or C{None} if it
+            is the same as their gossip port.
+        @param threshold: Number of versions we must be behind a peer
+            before a snapshot is fetched from it.
+        @param min_interval: Seconds that must pass after a transfer
+            before another one is started because we are behind.
+        @param timeout: Seconds a transfer may take before it is
+            given up on.
+        @param max_size: Largest number of bytes a snapshot may take
+            up, compressed or not, or C{None} for no limit.
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+        self.gossiper = gossiper
+        self.reactor = reactor
+        self.tcp_port = tcp_port
+        self.min_interval = min_interval
+        self.timeout = timeout
+        self.max_size = max_size
+        self._syncing = False
+        self._last_sync = None
+        gossiper.watch_lag(threshold, self._lagging)
+
+    def listen(self, port, interface=''):
+        """Start serving snapshots on TCP C{port}.
+
+        @return: The listening port.
+        """
+        factory = protocol.Factory()
+        factory.protocol = _SnapshotSender
+        factory.gossiper = self.gossiper
+        return self.reactor.listenTCP(port, factory, interface=interface)
+
+    def join(self):
+        """Fetch the state from a random seed.
+
+        @return: A C{Deferred} that fires when the state is loaded.
+        """
+        seeds = self.gossiper.seeds
+        if not seeds:
+            return defer.succeed(None)
+        return self.sync_from(_address_from_peer_name(random.choice(seeds)))
+
+    def sync_from(self, address):
+        """Fetch the state of the node at C{address}, a C{(host, port)}
+        tuple with its gossip port, and load it into our gossiper.
+
+        @return: A C{Deferred} that fires when the state is loaded.
+        """
+        host, port = address
+        if self.tcp_port is not None:
+            port = self.tcp_port
+        self._syncing = True
+        factory = _SnapshotClientFactory(self.max_size)
+        connector = self.reactor.connectTCP(host, port, factory,
+                                            timeout=self.timeout)
+        timer = self.reactor.callLater(self.timeout, self._timed_out,
+                                       factory, connector)
+        d = factory.deferred
+        d.addCallback(self.gossiper.load_snapshot)
+        d.addBoth(self._synced, timer)
+        return d
+
+    def _timed_out(self, factory, connector):
+        factory.fail(SnapshotError("snapshot transfer timed out"))
+        connector.disconnect()
+
+    def _synced(self, result, timer=None):
+        if timer is not None and timer.active():
+            timer.cancel()
+        self._syncing = False
+        self._last_sync = self.reactor.seconds()
+        return result
+
+    def _lagging(self, address, lag):
+        if self._syncing:
+            return
+        if (self._last_sync is not None
+                and self.reactor.seconds() - self._last_sync
+                < self.min_interval):
+            return
+        log.msg("%d versions behind %s:%d; fetching snapshot"
+                % ((lag,) + address))
+        self.sync_from(address).addErrback(log.err,
+                                           "failed to fetch snapshot")
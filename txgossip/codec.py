@@ -0,0 +1,437 @@
+# Copyright (C) 2011 Johan Rydberg
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Wire codecs for gossip messages.
+
+A message is a C{dict} with a C{'type'} entry and a number of
+type-specific fields.  A codec turns such a message into a datagram
+payload and back again.
+
+Two codecs are provided: L{JSONCodec}, which is what all nodes
+understand, and L{BinaryCodec}, which uses packed integer arrays, a
+per-message string table for peer and key names and a one-byte
+message type.
+Payloads of the two codecs can be told apart by their first byte, so
+a node can accept both at the same time.
+"""
+
+import json
+import struct
+
+
+class CodecError(Exception):
+    """Raised when a payload cannot be decoded."""
+
+
+class JSONCodec(object):
+    """The original JSON wire format."""
+
+    name = 'json'
+
+    def encode(self, message):
+        return json.dumps(message, separators=(',', ':'))
+
+    def decode(self, data):
+        try:
+            return json.loads(data)
+        except ValueError, e:
+            raise CodecError(str(e))
+
+    def accepts(self, data):
+        return data[:1] == b'{'
+
+
+# Fixed-size parts of a payload, packed in one go.
+_HEADER = struct.Struct('<BII')
+_FIELD = struct.Struct('<BI')
+_COUNT = struct.Struct('<I')
+_UINT64 = struct.Struct('<Q')
+
+
+def _unpack(fmt, data, offset, end):
+    """Return what C{fmt} unpacks at C{offset}, and the offset after
+    it.
+    """
+    stop = offset + fmt.size
+    if stop > end:
+        raise CodecError("truncated payload")
+    return fmt.unpack_from(data, offset), stop
+
+
+def _pack_count(n):
+    try:
+        return _COUNT.pack(n)
+    except struct.error, e:
+        raise CodecError(str(e))
+
+
+# Integer arrays are written as a width code followed by the
+# little-endian integers, all of the smallest width that fits the
+# largest of them.  References to the first strings of the string
+# table, in order, are written as just the code C{'S'}.
+_WIDTHS = [(0xff, 'B'), (0xffff, 'H'), (0xffffffff, 'I'),
+           (0xffffffffffffffff, 'Q')]
+_WIDTH_SIZES = {'B': 1, 'H': 2, 'I': 4, 'Q': 8}
+_SEQUENCE = 'S'
+
+
+def _pack_uints(values, top=None):
+    """Pack C{values}, none of which is larger than C{top} if given."""
+    if not values:
+        return 'B'
+    if top is None:
+        top = max(values)
+    for limit, code in _WIDTHS:
+        if top <= limit:
+            break
+    else:
+        raise CodecError("cannot encode integer %r" % (top,))
+    try:
+        return code + struct.pack('<%d%s' % (len(values), code), *values)
+    except struct.error, e:
+        # Such as for negative integers.
+        raise CodecError(str(e))
+
+
+def _unpack_uints(data, offset, end, count):
+    """Return C{count} integers written by L{_pack_uints} at
+    C{offset}, and the offset after them.
+    """
+    if offset >= end:
+        raise CodecError("truncated integer array")
+    code = data[offset]
+    size = _WIDTH_SIZES.get(code)
+    if size is None:
+        raise CodecError("bad integer width %r" % (code,))
+    offset += 1
+    stop = offset + size * count
+    if stop > end:
+        raise CodecError("truncated integer array")
+    return struct.unpack('<%d%s' % (count, code), data[offset:stop]), stop
+
+
+def _utf8(s):
+    # Byte strings are written as they are, but only if a decoder
+    # will be able to read them back.
+    if isinstance(s, unicode):
+        return s.encode('utf-8')
+    try:
+        s.decode('utf-8')
+    except UnicodeDecodeError, e:
+        raise CodecError("cannot encode %r: %s" % (s, e))
+    return s
+
+
+class _StringTable(object):
+    """Strings that are referenced from the message body by index.
+
+    The strings of the first field are put first, in order, so that
+    the references of a digest, and of the heartbeats of the same
+    peers, are written as L{_SEQUENCE}.
+    """
+
+    def __init__(self, groups):
+        strings = []
+        seen = set()
+        for group in groups:
+            if not strings:
+                strings = list(group)
+                seen.update(strings)
+                if len(seen) != len(strings):
+                    strings = list(seen)
+            elif not seen.issuperset(group):
+                new = set(group)
+                new.difference_update(seen)
+                seen.update(new)
+                strings.extend(new)
+        self.strings = strings
+        self.blob = None
+        self._index = None
+
+    def pack(self):
+        """Join the strings into C{blob}.
+
+        @return: C{False} if a string holds a NUL character, in which
+            case the table cannot be written.
+        """
+        strings = self.strings
+        try:
+            blob = u'\0'.join(strings).encode('utf-8')
+        except UnicodeDecodeError:
+            blob = '\0'.join([_utf8(s) for s in strings])
+        if strings and blob.count('\0') != len(strings) - 1:
+            return False
+        self.blob = blob
+        return True
+
+    def index(self):
+        if self._index is None:
+            self._index = dict(zip(self.strings, xrange(len(self.strings))))
+        return self._index
+
+    def refs(self, strings):
+        """Pack the positions of C{strings} in the table."""
+        if not strings:
+            return _pack_uints(())
+        if strings == self.strings[:len(strings)]:
+            return _SEQUENCE
+        return _pack_uints(map(self.index().__getitem__, strings),
+                           len(self.strings) - 1)
+
+
+def _unpack_refs(data, offset, end, count, table):
+    """Return the C{count} strings referenced at C{offset}, and the
+    offset after the references.
+    """
+    if data[offset:offset + 1] == _SEQUENCE:
+        if count > len(table):
+            raise CodecError("bad string reference")
+        return table[:count], offset + 1
+    refs, offset = _unpack_uints(data, offset, end, count)
+    try:
+        return map(table.__getitem__, refs), offset
+    except IndexError:
+        raise CodecError("bad string reference")
+
+
+# Field codecs.  For every field there is a function that returns the
+# strings the field refers to, an encoder that takes the string table
+# and the value and returns the field payload, and a decoder that
+# takes the payload, its bounds and the decoded string table.
+
+def _map_strings(mapping):
+    return mapping.keys()
+
+def _encode_map(table, mapping):
+    # Maps with the same keys as the first field, such as the
+    # heartbeats of the peers in a digest, are written in table order.
+    names = mapping.keys()
+    values = mapping.values()
+    first = table.strings[:len(mapping)]
+    if names != first:
+        reordered = map(mapping.get, first)
+        if None not in reordered:
+            names, values = first, reordered
+    return _pack_count(len(mapping)) + table.refs(names) + _pack_uints(values)
+
+def _decode_map(data, offset, end, table):
+    (count,), offset = _unpack(_COUNT, data, offset, end)
+    names, offset = _unpack_refs(data, offset, end, count, table)
+    values, offset = _unpack_uints(data, offset, end, count)
+    return dict(zip(names, values))
+
+def _deltas_strings(deltas):
+    strings = [delta[0] for delta in deltas]
+    strings.extend([delta[1] for delta in deltas])
+    return strings
+
+def _encode_deltas(table, deltas):
+    if not deltas:
+        return _pack_count(0)
+    peers, keys, values, versions = zip(*deltas)
+    return ''.join([_pack_count(len(deltas)), table.refs(list(peers)),
+                    table.refs(list(keys)), _pack_uints(versions),
+                    json.dumps(values, separators=(',', ':'))])
+
+def _decode_deltas(data, offset, end, table):
+    (count,), offset = _unpack(_COUNT, data, offset, end)
+    if not count:
+        return []
+    peers, offset = _unpack_refs(data, offset, end, count, table)
+    keys, offset = _unpack_refs(data, offset, end, count, table)
+    versions, offset = _unpack_uints(data, offset, end, count)
+    values = json.loads(data[offset:end])
+    if not isinstance(values, list) or len(values) != count:
+        raise CodecError("bad delta values")
+    return zip(peers, keys, values, versions)
+
+def _strings_strings(strings):
+    return strings
+
+def _encode_strings(table, strings):
+    return _pack_count(len(strings)) + table.refs(list(strings))
+
+def _decode_strings(data, offset, end, table):
+    (count,), offset = _unpack(_COUNT, data, offset, end)
+    return _unpack_refs(data, offset, end, count, table)[0]
+
+def _string_strings(s):
+    return [s]
+
+def _encode_string(table, s):
+    return _COUNT.pack(table.index()[s])
+
+def _decode_string(data, offset, end, table):
+    (index,), offset = _unpack(_COUNT, data, offset, end)
+    try:
+        return table[index]
+    except IndexError:
+        raise CodecError("bad string reference %d" % (index,))
+
+def _uint_strings(n):
+    return ()
+
+def _encode_uint(table, n):
+    try:
+        return _UINT64.pack(n)
+    except struct.error, e:
+        raise CodecError(str(e))
+
+def _decode_uint(data, offset, end, table):
+    return _unpack(_UINT64, data, offset, end)[0][0]
+
+
+class BinaryCodec(object):
+    """Compact binary wire format.
+
+    Layout of a payload::
+
+        header     type (1 byte, always >= 0x80), string count and
+                   string table size (4 bytes each)
+        strings    NUL-separated utf-8
+        fields     (tag (1 byte), length (4 bytes), payload)*
+
+    All integers are little-endian.  Every peer and key name is
+    written once to the string table and referenced by index from the
+    fields.  Integers within a field are written as arrays of fixed
+    width, so that they are packed and unpacked in one go.  Fields
+    carry their length, so a decoder skips tags it does not know
+    about.  Message types without a type code, and messages with names
+    that hold NUL characters, are sent as L{EXTENSION} followed by a
+    JSON document.
+    """
+
+    name = 'binary'
+
+    EXTENSION = 0xff
+
+    TYPES = {
+        'request': 0x81,
+        'first-response': 0x82,
+        'second-response': 0x83,
+        'digest-request': 0x84,
+        }
+
+    FIELDS = [
+        (1, 'digest', _map_strings, _encode_map, _decode_map),
+        (2, 'updates', _deltas_strings, _encode_deltas, _decode_deltas),
+        (3, 'codecs', _strings_strings, _encode_strings, _decode_strings),
+        (4, 'features', _strings_strings, _encode_strings, _decode_strings),
+        (5, 'hash', _uint_strings, _encode_uint, _decode_uint),
+        (6, 'heartbeats', _map_strings, _encode_map, _decode_map),
+        (7, 'tombstones', _map_strings, _encode_map, _decode_map),
+        (8, 'name', _string_strings, _encode_string, _decode_string),
+        ]
+
+    def __init__(self):
+        self._type_names = dict((v, k) for (k, v) in self.TYPES.items())
+        self._fields_by_tag = dict((f[0], f) for f in self.FIELDS)
+        # The string table of the last message, which is usually
+        # that of the next one too.
+        self._last_table = None
+
+    def accepts(self, data):
+        return data[:1] != b'' and bytearray(data[:1])[0] >= 0x80
+
+    def _extension(self, message):
+        return chr(self.EXTENSION) + json.dumps(
+            message, separators=(',', ':'))
+
+    def encode(self, message):
+        code = self.TYPES.get(message['type'])
+        if code is None:
+            return self._extension(message)
+
+        fields = [f for f in self.FIELDS if f[1] in message]
+        table = _StringTable([f[2](message[f[1]]) for f in fields])
+        last = self._last_table
+        if last is not None and table.strings == last.strings:
+            table = last
+        elif table.pack():
+            self._last_table = table
+        else:
+            return self._extension(message)
+
+        buf = [_HEADER.pack(code, len(table.strings), len(table.blob)),
+               table.blob]
+        for tag, name, strings, encode, decode in fields:
+            field = encode(table, message[name])
+            buf.append(_FIELD.pack(tag, len(field)))
+            buf.append(field)
+        return ''.join(buf)
+
+    def decode(self, data):
+        data = bytes(data)
+        if not data:
+            raise CodecError("empty payload")
+        if ord(data[0]) == self.EXTENSION:
+            try:
+                return json.loads(data[1:])
+            except ValueError, e:
+                raise CodecError(str(e))
+        end = len(data)
+        (code, count, length), offset = _unpack(_HEADER, data, 0, end)
+        try:
+            message = {'type': self._type_names[code]}
+        except KeyError:
+            raise CodecError("unknown message type 0x%02x" % (code,))
+
+        if offset + length > end:
+            raise CodecError("truncated string table")
+        table = []
+        if count:
+            try:
+                table = data[offset:offset + length].decode('utf-8').split(
+                    u'\0')
+            except UnicodeDecodeError, e:
+                raise CodecError(str(e))
+            if len(table) != count:
+                raise CodecError("bad string table")
+        offset += length
+
+        fields = self._fields_by_tag
+        while offset < end:
+            (tag, length), offset = _unpack(_FIELD, data, offset, end)
+            stop = offset + length
+            if stop > end:
+                raise CodecError("truncated field %d" % (tag,))
+            field = fields.get(tag)
+            if field is not None:
+                try:
+                    message[field[1]] = field[4](data, offset, stop, table)
+                except (ValueError, TypeError), e:
+                    raise CodecError(str(e))
+            offset = stop
+        return message
+
+
+def default_codecs():
+    """Return the codecs a gossiper supports unless told otherwise,
+    in order of preference.
+
+    JSON comes first: the binary codec makes large datagrams less than
+    half the size and decodes them faster, but encoding small messages
+    in pure Python costs more than the C-accelerated JSON encoder.
+    Pass C{codecs=[BinaryCodec(), JSONCodec()]} to a L{Gossiper} to
+    prefer it.
+    """
+    return [JSONCodec(), BinaryCodec()]
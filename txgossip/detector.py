@@ -23,29 +23,275 @@
 
 import math
 
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+_LOG10 = math.log(10)
+
 
 class FailureDetector(object):
+    """Phi accrual failure detector.
+
+    Heartbeat inter-arrival times are kept in a fixed-size window,
+    along with their running sum and sum of squares, so adding a
+    heartbeat and computing L{phi} take constant time.
+
+    Two models of the inter-arrival times are supported.  The
+    C{'exponential'} model only looks at the mean interval.  The
+    C{'normal'} model also takes the variance into account, which
+    makes it less sensitive to jitter; its standard deviation is
+    never taken to be less than C{min_std_deviation}.  With both
+    models, C{acceptable_pause} seconds of silence beyond the expected
+    interval are tolerated before suspicion starts growing.
+    """
+
+    DISTRIBUTIONS = ('exponential', 'normal')
+
+    __slots__ = ('last_time', 'intervals', 'window_size', 'distribution',
+                 'min_std_deviation', 'acceptable_pause', 'first_interval',
+                 '_next', '_sum', '_sum_sq', 'registry', 'slot')
 
-    def __init__(self):
+    def __init__(self, window_size=1000, distribution='exponential',
+                 min_std_deviation=0.5, acceptable_pause=0,
+                 first_interval=0.75):
+        if distribution not in self.DISTRIBUTIONS:
+            raise ValueError("unknown distribution %r" % (distribution,))
         self.last_time = None
-        self.intervals = []
+        self.intervals = array('d')
+        self.window_size = window_size
+        self.distribution = distribution
+        self.min_std_deviation = min_std_deviation
+        self.acceptable_pause = acceptable_pause
+        self.first_interval = first_interval
+        self._next = 0
+        self._sum = 0.0
+        self._sum_sq = 0.0
+        self.registry = None
+        self.slot = None
 
     def add(self, arrival_time):
         last_time, self.last_time = self.last_time, arrival_time
         if last_time is None:
-            i = 0.75
+            i = self.first_interval
         else:
             i = arrival_time - last_time
-        self.intervals.append(i)
-        if len(self.intervals) > 1000:
-            self.intervals.pop(0)
+        intervals = self.intervals
+        if len(intervals) < self.window_size:
+            intervals.append(i)
+        else:
+            n = self._next
+            old = intervals[n]
+            intervals[n] = i
+            self._sum -= old
+            self._sum_sq -= old * old
+            self._next = n = (n + 1) % self.window_size
+            if n == 0:
+                # Get rid of accumulated rounding errors once in a
+                # while.
+                self._sum = math.fsum(intervals)
+                self._sum_sq = math.fsum([x * x for x in intervals])
+                if self.registry is not None:
+                    self.registry.update(self)
+                return
+        self._sum += i
+        self._sum_sq += i * i
+        if self.registry is not None:
+            self.registry.update(self)
 
     def phi(self, current_time):
         if self.last_time is None:
             return 0
-        current_interval = current_time - self.last_time
-        exp = -1 * current_interval / self.interval_mean()
-        return -1 * (math.log(pow(math.e, exp)) / math.log(10))
+        current_interval = max(
+            current_time - self.last_time - self.acceptable_pause, 0)
+        if self.distribution == 'exponential':
+            return current_interval / (self.interval_mean() * _LOG10)
+        # Logistic approximation of the normal CDF, as used by Akka.
+        y = (current_interval - self.interval_mean()) / self.std_deviation()
+        z = -y * (1.5976 + 0.070566 * y * y)
+        if z < -30:
+            return -z / _LOG10
+        return math.log10(1 + math.exp(-z))
+
+    def deadline(self, threshold):
+        """Return the time at which L{phi} will pass C{threshold}
+        unless another heartbeat arrives, or C{None} if no heartbeat
+        has arrived yet.
+        """
+        if self.last_time is None:
+            return None
+        if self.distribution == 'exponential':
+            interval = threshold * _LOG10 * self.interval_mean()
+        else:
+            interval = (self.interval_mean() + self.std_deviation()
+                        * _inverse_logistic(threshold))
+        return self.last_time + self.acceptable_pause + interval
 
     def interval_mean(self):
-        return sum(self.intervals) / float(len(self.intervals))
+        return self._sum / len(self.intervals)
+
+    def std_deviation(self):
+        mean = self.interval_mean()
+        variance = max(self._sum_sq / len(self.intervals) - mean * mean, 0)
+        return max(math.sqrt(variance), self.min_std_deviation)
+
+
+class DetectorRegistry(object):
+    """Evaluates the failure detectors of many peers at once.
+
+    The registry keeps the last arrival time and interval statistics
+    of every registered peer in contiguous arrays, which the
+    detectors update as heartbeats arrive.  L{evaluate} then computes
+    phi for all peers in a single vectorized NumPy operation.  When
+    NumPy is not available, or C{use_numpy} is false, each detector
+    is evaluated in turn instead.
+    """
+
+    def __init__(self, use_numpy=True):
+        self.use_numpy = use_numpy and numpy is not None
+        self._states = []
+        self._free = []
+        self._last = self._mean = self._std = self._pause = None
+        self._threshold = self._normal = self._alive = self._used = None
+        if self.use_numpy:
+            self._allocate(16)
+
+    def _allocate(self, capacity):
+        def grow(old, fill, dtype=float):
+            new = numpy.empty(capacity, dtype=dtype)
+            new.fill(fill)
+            if old is not None:
+                new[:len(old)] = old
+            return new
+        self._last = grow(self._last, numpy.nan)
+        self._mean = grow(self._mean, 1.0)
+        self._std = grow(self._std, 1.0)
+        self._pause = grow(self._pause, 0.0)
+        self._threshold = grow(self._threshold, numpy.inf)
+        self._normal = grow(self._normal, False, bool)
+        self._alive = grow(self._alive, False, bool)
+        self._used = grow(self._used, False, bool)
+
+    def add(self, state):
+        """Start evaluating the detector of C{state}."""
+        detector = state.detector
+        if self._free:
+            slot = self._free.pop()
+            self._states[slot] = state
+        else:
+            slot = len(self._states)
+            self._states.append(state)
+        detector.registry, detector.slot = self, slot
+        if self.use_numpy:
+            if slot >= len(self._last):
+                self._allocate(2 * len(self._last))
+            self._used[slot] = True
+            self._threshold[slot] = state.PHI
+            self._pause[slot] = detector.acceptable_pause
+            self._normal[slot] = detector.distribution == 'normal'
+            self._alive[slot] = state.alive
+            self._last[slot] = numpy.nan
+            if detector.last_time is not None:
+                self.update(detector)
+
+    def remove(self, state):
+        """Stop evaluating the detector of C{state}."""
+        detector = state.detector
+        slot = detector.slot
+        if detector.registry is not self:
+            return
+        detector.registry = detector.slot = None
+        self._states[slot] = None
+        self._free.append(slot)
+        if self.use_numpy:
+            self._used[slot] = False
+
+    def update(self, detector):
+        """Copy the statistics of C{detector} into the arrays."""
+        if not self.use_numpy:
+            return
+        slot = detector.slot
+        self._last[slot] = detector.last_time
+        self._mean[slot] = detector.interval_mean()
+        if detector.distribution == 'normal':
+            self._std[slot] = detector.std_deviation()
+
+    def status_changed(self, state):
+        """Record that C{state} was marked alive or dead."""
+        if self.use_numpy and state.detector.registry is self:
+            self._alive[state.detector.slot] = state.alive
+
+    def evaluate(self, now):
+        """Compute phi of all peers at time C{now}.
+
+        @return: A tuple of two sequences; the states of peers that
+            should now be considered alive, and the states of peers
+            that should now be considered dead.
+        """
+        if not self.use_numpy:
+            return self._evaluate_each(now)
+
+        n = len(self._states)
+        last = self._last[:n]
+        t = numpy.maximum(now - last - self._pause[:n], 0)
+        with numpy.errstate(over='ignore', invalid='ignore'):
+            phi = t / (self._mean[:n] * _LOG10)
+            normal = self._normal[:n]
+            if normal.any():
+                y = (t - self._mean[:n]) / self._std[:n]
+                z = -y * (1.5976 + 0.070566 * y * y)
+                phi = numpy.where(
+                    normal,
+                    numpy.where(z < -30, -z / _LOG10,
+                                numpy.log10(1 + numpy.exp(-z))),
+                    phi)
+            alive = (phi <= self._threshold[:n]) & ~numpy.isnan(last)
+        used = self._used[:n]
+        current = self._alive[:n]
+        states = self._states
+        became_alive = [states[i] for i in
+                        numpy.flatnonzero(alive & ~current & used)]
+        became_dead = [states[i] for i in
+                       numpy.flatnonzero(~alive & current & used)]
+        current[:] = alive
+        return became_alive, became_dead
+
+    def _evaluate_each(self, now):
+        became_alive, became_dead = [], []
+        for state in self._states:
+            if state is None:
+                continue
+            detector = state.detector
+            alive = (detector.last_time is not None
+                     and detector.phi(now) <= state.PHI)
+            if alive and not state.alive:
+                became_alive.append(state)
+            elif state.alive and not alive:
+                became_dead.append(state)
+        return became_alive, became_dead
+
+
+def _cbrt(x):
+    if x < 0:
+        return -((-x) ** (1.0 / 3))
+    return x ** (1.0 / 3)
+
+
+def _inverse_logistic(phi):
+    """Return the number of standard deviations above the mean at
+    which the normal model of L{FailureDetector.phi} reaches C{phi}.
+    """
+    # Solve a*y**3 + b*y = r, which has a single real root since both
+    # a and b are positive.
+    if phi > 15:
+        r = phi * _LOG10
+    else:
+        r = math.log(10 ** phi - 1)
+    p = 1.5976 / 0.070566
+    q = -r / 0.070566
+    d = math.sqrt(q * q / 4 + p * p * p / 27)
+    return _cbrt(-q / 2 + d) + _cbrt(-q / 2 - d)
@@ -0,0 +1,258 @@
+# Copyright (C) 2011 Johan Rydberg
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Delivery of state changes to participants."""
+
+from collections import OrderedDict
+
+
+class _Target(object):
+    """A participant along with the changes queued up for it."""
+
+    __slots__ = ('participant', 'batched', 'heartbeats', 'pending')
+
+    def __init__(self, participant):
+        self.participant = participant
+        self.batched = hasattr(participant, 'values_changed')
+        self.heartbeats = getattr(participant, 'notify_heartbeats', False)
+        self.pending = OrderedDict()
+
+
+class _Node(object):
+
+    __slots__ = ('children', 'targets')
+
+    def __init__(self):
+        self.children = {}
+        self.targets = []
+
+
+class PrefixIndex(object):
+    """Maps keys to the targets that subscribed to them, either by
+    the exact key or by a prefix of it.
+
+    Prefixes are kept in a trie, so looking up a key costs time
+    proportional to the length of the key, not to the number of
+    subscriptions.
+    """
+
+    def __init__(self):
+        self._exact = {}
+        self._root = _Node()
+        self._prefixes = 0
+
+    def add_key(self, key, target):
+        targets = self._exact.setdefault(key, [])
+        if target not in targets:
+            targets.append(target)
+
+    def add_prefix(self, prefix, target):
+        node = self._root
+        for c in prefix:
+            node = node.children.setdefault(c, _Node())
+        if target not in node.targets:
+            node.targets.append(target)
+            self._prefixes += 1
+
+    def remove(self, target):
+        for key, targets in self._exact.items():
+            if target in targets:
+                targets.remove(target)
+                if not targets:
+                    del self._exact[key]
+        pending = [self._root]
+        while pending:
+            node = pending.pop()
+            if target in node.targets:
+                node.targets.remove(target)
+                self._prefixes -= 1
+            pending.extend(node.children.values())
+
+    def match(self, key):
+        """Return the targets that subscribed to C{key}."""
+        matched = list(self._exact.get(key, ()))
+        if self._prefixes:
+            node = self._root
+            matched.extend(node.targets)
+            for c in key:
+                node = node.children.get(c)
+                if node is None:
+                    break
+                matched.extend(node.targets)
+            if len(matched) > 1:
+                unique = []
+                for target in matched:
+                    if target not in unique:
+                        unique.append(target)
+                matched = unique
+        return matched
+
+
+class Dispatcher(object):
+    """Sits between the peer states and the participants.
+
+    The participant given to the dispatcher is told about every
+    change.  Further participants can L{subscribe} to exact keys or to
+    key prefixes, and are only told about matching changes.  All of
+    them are told about peers that come and go.
+
+    Participants that implement C{values_changed(peer, changes)} get
+    all changes that were applied together in a single call, with
+    C{changes} being a list of C{(key, value)} tuples.  Changes to
+    C{'__heartbeat__'} are left out unless the participant has a true
+    C{notify_heartbeats} attribute.
+
+    Other participants get one C{value_changed(peer, key, value)} call
+    per change, as they are applied.
+
+    Values installed through L{values_loaded} are not changes, but
+    participants that implement C{values_loaded(peer, items)} are told
+    about those that match them, for example to index them.
+    """
+
+    def __init__(self, participant, metrics=None):
+        """
+        @param metrics: Optional L{Metrics} registry in which peers
+            coming and going are counted.
+        """
+        self.participant = participant
+        self._alive_counter = self._dead_counter = None
+        if metrics is not None:
+            self._alive_counter = metrics.counter('peer_transitions',
+                                                  to='alive')
+            self._dead_counter = metrics.counter('peer_transitions',
+                                                 to='dead')
+        self._main = None
+        if participant is not None:
+            self._main = _Target(participant)
+        self._index = PrefixIndex()
+        self._subscribers = []
+        self._depth = 0
+        self._pending = []
+
+    def subscribe(self, participant, keys=(), prefixes=()):
+        """Tell C{participant} about changes to C{keys} and to keys
+        that start with any of C{prefixes}.
+        """
+        for target in self._subscribers:
+            if target.participant is participant:
+                break
+        else:
+            target = _Target(participant)
+            self._subscribers.append(target)
+        for key in keys:
+            self._index.add_key(key, target)
+        for prefix in prefixes:
+            self._index.add_prefix(prefix, target)
+
+    def unsubscribe(self, participant):
+        """Stop telling C{participant} about anything."""
+        for target in self._subscribers:
+            if target.participant is participant:
+                self._subscribers.remove(target)
+                self._index.remove(target)
+                break
+
+    def begin(self):
+        """Start collecting changes into a batch.
+
+        Batches nest; changes are delivered when the outermost batch
+        is committed.
+        """
+        self._depth += 1
+
+    def commit(self):
+        """End a batch started with L{begin}."""
+        self._depth -= 1
+        if not self._depth:
+            self._flush()
+
+    def _flush(self):
+        # Participants may change values while handling a batch, and
+        # those changes make up another batch.
+        self._depth += 1
+        try:
+            while self._pending:
+                targets, self._pending = self._pending, []
+                for target in targets:
+                    pending, target.pending = target.pending, OrderedDict()
+                    for peer, changes in pending.values():
+                        target.participant.values_changed(peer, changes)
+        finally:
+            self._depth -= 1
+
+    def value_changed(self, peer, key, value):
+        targets = self._index.match(key)
+        if self._main is not None:
+            targets.insert(0, self._main)
+        for target in targets:
+            self._deliver(target, peer, key, value)
+
+    def _deliver(self, target, peer, key, value):
+        if not target.batched:
+            target.participant.value_changed(peer, key, value)
+            return
+        if key == '__heartbeat__' and not target.heartbeats:
+            return
+        if not self._depth:
+            target.participant.values_changed(peer, [(key, value)])
+            return
+        if not target.pending:
+            self._pending.append(target)
+        try:
+            target.pending[id(peer)][1].append((key, value))
+        except KeyError:
+            target.pending[id(peer)] = (peer, [(key, value)])
+
+    def values_loaded(self, peer, items):
+        """Tell participants about a sequence of C{(key, value)}
+        tuples that were installed in the state of C{peer} without
+        being announced as changes.
+        """
+        loaded = OrderedDict()
+        for key, value in items:
+            for target in self._index.match(key):
+                loaded.setdefault(target, []).append((key, value))
+        if self._main is not None:
+            loaded[self._main] = items
+        for target, matching in loaded.items():
+            if hasattr(target.participant, 'values_loaded'):
+                target.participant.values_loaded(peer, matching)
+
+    def _participants(self):
+        participants = [target.participant for target in self._subscribers]
+        if self._main is not None:
+            participants.insert(0, self._main.participant)
+        return participants
+
+    def peer_alive(self, peer):
+        if self._alive_counter is not None:
+            self._alive_counter.inc()
+        for participant in self._participants():
+            participant.peer_alive(peer)
+
+    def peer_dead(self, peer):
+        if self._dead_counter is not None:
+            self._dead_counter.inc()
+        for participant in self._participants():
+            participant.peer_dead(peer)
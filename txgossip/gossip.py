@@ -21,10 +21,14 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import math
 import random
-import json
 
-from txgossip.state import PeerState
+from txgossip.codec import CodecError, JSONCodec, default_codecs
+from txgossip.detector import DetectorRegistry, FailureDetector
+from txgossip.dispatch import Dispatcher
+from txgossip.metrics import Metrics
+from txgossip.state import Membership, PeerState, ValueStore
 from txgossip.scuttle import Scuttle
 from twisted.python import log
 from twisted.internet.protocol import DatagramProtocol
@@ -40,7 +44,13 @@ def _address_to_peer_name(address):
 
 
 class Participant(object):
-    """Base class for participants."""
+    """Base class for participants.
+
+    A participant is told about changed values through either
+    C{value_changed(peer, key, value)}, once for every key, or
+    C{values_changed(peer, changes)}, once for every set of changes
+    applied together; see L{Dispatcher}.
+    """
 
     def make_connection(self, gossiper):
         """Attach this participant to a gossiper."""
@@ -53,31 +63,212 @@ class Participant(object):
         """Report that there's a peer dead."""
 
 
+class Batch(object):
+    """Values to be set together when a C{with} block ends::
+
+        with gossiper.batch() as batch:
+            batch.set('a', 1)
+            batch['b'] = 2
+
+    Only values set through the batch are collected; calls to
+    L{Gossiper.set} made meanwhile, by participants or anyone else,
+    take effect right away.  Nothing is set if the block raises an
+    exception.
+
+    @ivar items: The C{(key, value)} tuples set so far.
+    """
+
+    def __init__(self, set_many):
+        self._set_many = set_many
+        self.items = []
+
+    def set(self, key, value):
+        self.items.append((key, value))
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self._set_many(self.items)
+
+
 class Gossiper(DatagramProtocol):
 
-    def __init__(self, clock, participant, address=None):
+    # Our C{ADDRESS:PORT}, known once the protocol has started:
+    name = None
+
+    # Message types of the gossip protocol itself:
+    _MESSAGE_TYPES = frozenset(['request', 'first-response',
+                                'second-response', 'digest-request'])
+
+    # Protocol extensions this gossiper understands, advertised in
+    # every request and response:
+    FEATURES = ('digest-hash', 'heartbeats')
+
+    def __init__(self, clock, participant, address=None, codecs=None,
+                 mtu=1400, delta_policy='most-behind', digest_hash=True,
+                 digest_size=None, digest_mode='window', heartbeat_size=None,
+                 fanout=1, gossip_interval=1, heartbeat_interval=1,
+                 adaptive=False, max_gossip_interval=None,
+                 detector_factory=FailureDetector, batch_phi=False,
+                 dead_peer_ttl=None, tombstone_ttl=None, metrics=None):
         """Create a new gossiper.
 
+        @param participant: The participant that is told about all
+            changes, or C{None} if all participants are attached
+            through L{subscribe}.
         @param address: Listen address if the gossiper will not be
             bound to a specific listen interface.
         @param address: C{str}
+        @param codecs: Wire codecs this gossiper understands, in order
+            of preference.  Peers are always first contacted using
+            JSON, and switch to the most preferred codec that both
+            sides support once they have heard from each other.
+        @param mtu: Upper bound on the size of a response datagram,
+            or C{None} to send all outstanding deltas at once.
+        @param delta_policy: What peers get to use the space in a
+            datagram first; see L{Scuttle}.
+        @param digest_hash: If true, peers that support it are sent
+            only a hash of our digest, and the full digest is only
+            exchanged when the hashes differ.
+        @param digest_size: If set, requests carry a slice of at most
+            this many peers of our digest instead of all of it.
+        @param digest_mode: How the slice is picked; see
+            L{Scuttle.digest_slice}.
+        @param heartbeat_size: Upper bound on the number of heartbeat
+            generations of other peers sent along with a digest hash,
+            or C{None} to send those of all peers in the digest slice;
+            see L{Scuttle.heartbeat_slice}.  A bound keeps requests
+            small, but in clusters much larger than it heartbeats of
+            a peer arrive less often and its failure takes longer to
+            detect.
+        @param fanout: Number of live peers to gossip with each round.
+        @param gossip_interval: Seconds between gossip rounds.
+        @param heartbeat_interval: Seconds between heartbeats.
+        @param adaptive: If true, gossip with at least M{ln(n + 1)} of
+            the C{n} live peers each round, and double the time
+            between rounds, up to C{max_gossip_interval}, for every
+            round in which our digest did not change.
+        @param max_gossip_interval: Upper bound of the adaptive round
+            interval.  Defaults to four times C{gossip_interval}.
+        @param detector_factory: Callable that returns a failure
+            detector for a peer, such as L{FailureDetector} with some
+            of its arguments bound.
+        @param batch_phi: If true, evaluate the failure detectors of
+            all peers at once each round using a L{DetectorRegistry},
+            which is vectorized when NumPy is installed.
+        @param dead_peer_ttl: If set, peers that have been dead for
+            this many seconds are forgotten, unless they are seeds.
+            Other nodes are told through a tombstone, and no node
+            picks the peer up again from the digests of others until
+            the tombstone expires or the peer contacts it.
+        @param tombstone_ttl: Seconds a tombstone is kept.  Defaults
+            to C{dead_peer_ttl}.
+        @param metrics: The L{Metrics} registry to count what we do
+            in, available as C{metrics}.  A new one is created if not
+            given.
         """
-        self.state = PeerState(clock, participant)
+        if metrics is None:
+            metrics = Metrics()
+        self.metrics = metrics
+        self._dispatcher = Dispatcher(participant, metrics)
+        self._values = ValueStore()
+        self.state = PeerState(clock, self._dispatcher, values=self._values)
         self._states = {}
+        self._membership = Membership(
+            DetectorRegistry() if batch_phi else None)
         self._address = address
-        self._scuttle = Scuttle(self._states, self.state)
+        self._scuttle = Scuttle(self._states, self.state,
+            policy=delta_policy, digest_size=digest_size,
+            digest_mode=digest_mode, heartbeat_size=heartbeat_size)
+        self._mtu = mtu
         self._heart_beat_timer = task.LoopingCall(self._beat_heart)
         self._heart_beat_timer.clock = clock
         self._gossip_timer = task.LoopingCall(self._gossip)
         self._gossip_timer.clock = clock
+        self._fanout = fanout
+        self._gossip_interval = gossip_interval
+        self._heartbeat_interval = heartbeat_interval
+        self._adaptive = adaptive
+        if max_gossip_interval is None:
+            max_gossip_interval = 4 * gossip_interval
+        self._max_gossip_interval = max_gossip_interval
+        self._last_digest_hash = None
+        self._detector_factory = detector_factory
         self.clock = clock
         self.participant = participant
+        self._subscribers = []
         self._seeds = []
+        if codecs is None:
+            codecs = default_codecs()
+        self._json_codec = JSONCodec()
+        self._codecs = list(codecs)
+        if self._json_codec.name not in [c.name for c in self._codecs]:
+            self._codecs.append(self._json_codec)
+        self._peer_codecs = {}
+        self._peer_features = {}
+        self._digest_hash = digest_hash
+        self._handlers = {}
+        self._lag_watch = None
+        self._dead_peer_ttl = dead_peer_ttl
+        if tombstone_ttl is None:
+            tombstone_ttl = dead_peer_ttl
+        self._tombstone_ttl = tombstone_ttl
+        self._setup_metrics()
+
+    # Upper bounds of the datagram size histogram:
+    _SIZE_BUCKETS = (128, 256, 512, 1024, 1400, 2048, 4096, 8192)
+
+    def _setup_metrics(self):
+        metrics = self.metrics
+        self._sent_counters = {}
+        self._received_counters = {}
+        self._bytes_sent = metrics.counter('bytes_sent')
+        self._bytes_received = metrics.counter('bytes_received')
+        self._datagrams_dropped = metrics.counter('datagrams_dropped')
+        self._datagram_size = metrics.histogram('datagram_bytes',
+                                                self._SIZE_BUCKETS)
+        self._deltas_applied = metrics.counter('deltas_applied')
+        self._deltas_stale = metrics.counter('deltas_stale')
+        self._rounds = metrics.counter('gossip_rounds')
+        self._lag = metrics.gauge('versions_behind')
+        metrics.gauge('live_peers', lambda: len(self._membership.live))
+        metrics.gauge('dead_peers', lambda: len(self._membership.dead))
+        metrics.gauge('digest_peers', lambda: len(self._scuttle.digest()))
+        metrics.gauge('tombstones', lambda: len(self._scuttle.tombstones))
+        metrics.gauge('gossip_interval',
+                      lambda: self._gossip_timer.interval)
+        metrics.add_collector(self._collect_phi)
+
+    def _collect_phi(self, add):
+        """Report the current phi of every peer."""
+        now = self.clock.seconds()
+        for name, state in self._states.items():
+            if state is not self.state:
+                add('phi', state.detector.phi(now), peer=name)
+
+    def _count_message(self, counters, name, message_type):
+        if (not isinstance(message_type, basestring)
+                or (message_type not in self._MESSAGE_TYPES
+                    and message_type not in self._handlers)):
+            message_type = 'unknown'
+        counter = counters.get(message_type)
+        if counter is None:
+            counter = counters[message_type] = self.metrics.counter(
+                name, type=message_type)
+        counter.inc()
 
     def _setup_state_for_peer(self, peer_name):
         """Setup state for a new peer."""
-        self._states[peer_name] = PeerState(self.clock, self.participant,
-            name=peer_name)
+        state = PeerState(self.clock, self._dispatcher, name=peer_name,
+            detector_factory=self._detector_factory, values=self._values)
+        self._states[peer_name] = state
+        self._scuttle.add_peer(state)
+        self._membership.add(state)
 
     def seed(self, seeds):
         """Tell this gossiper that there are gossipers to
@@ -88,6 +279,11 @@ class Gossiper(DatagramProtocol):
         self._seeds.extend(seeds)
         self._handle_new_peers(seeds)
 
+    @property
+    def seeds(self):
+        """The C{'ADDRESS:PORT'} strings given to L{seed}."""
+        return list(self._seeds)
+
     def _handle_new_peers(self, names):
         """Set up state for new peers."""
         for peer_name in names:
@@ -95,6 +291,54 @@ class Gossiper(DatagramProtocol):
                 continue
             self._setup_state_for_peer(peer_name)
 
+    def _evict(self, state, expires):
+        """Forget about C{state} and keep a tombstone for it until
+        C{expires}.
+        """
+        name = state.name
+        del self._states[name]
+        self._scuttle.remove_peer(name)
+        self._membership.remove(state)
+        state.clear()
+        address = _address_from_peer_name(name)
+        self._peer_codecs.pop(address, None)
+        self._peer_features.pop(address, None)
+        self._scuttle.tombstones[name] = expires
+
+    def _evict_dead_peers(self, now):
+        """Evict peers that have been dead for too long, and drop
+        expired tombstones.
+        """
+        if self._dead_peer_ttl is None:
+            return
+        seeds = self._seeds
+        for state in self.dead_peers:
+            if (now - state.dead_since >= self._dead_peer_ttl
+                    and state.name not in seeds):
+                self._evict(state, now + self._tombstone_ttl)
+        tombstones = self._scuttle.tombstones
+        for name, expires in tombstones.items():
+            if expires <= now:
+                del tombstones[name]
+
+    def _apply_tombstones(self, tombstones):
+        """Apply tombstones, mapping peer names to the number of
+        seconds they are kept, received from another node.
+
+        Peers that are dead to us too are evicted right away.
+        """
+        now = self.clock.seconds()
+        ours = self._scuttle.tombstones
+        for name, ttl in tombstones.items():
+            if (ttl <= 0 or name == self.name or name in self._seeds
+                    or name in ours):
+                continue
+            state = self._states.get(name)
+            if state is None:
+                ours[name] = now + ttl
+            elif not state.alive:
+                self._evict(state, now + ttl)
+
     def _determine_endpoint(self):
         """Determine the IP address of this peer.
 
@@ -114,97 +358,410 @@ class Gossiper(DatagramProtocol):
         """Start protocol."""
         self.name = self._determine_endpoint()
         self.state.set_name(self.name)
+        if self.name in self._states:
+            # We were seeded with our own address.
+            self._membership.remove(self._states[self.name])
         self._states[self.name] = self.state
-        self._heart_beat_timer.start(1, now=True)
-        self._gossip_timer.start(1, now=True)
-        self.participant.make_connection(self)
+        self._scuttle.add_peer(self.state)
+        self._heart_beat_timer.start(self._heartbeat_interval, now=True)
+        self._gossip_timer.start(self._gossip_interval, now=True)
+        if self.participant is not None:
+            self.participant.make_connection(self)
+        for participant in self._subscribers:
+            participant.make_connection(self)
 
     def stopProtocol(self):
         """Stop protocol."""
         self._gossip_timer.stop()
         self._heart_beat_timer.stop()
 
+    def subscribe(self, participant, keys=(), prefixes=()):
+        """Attach another participant to this gossiper.
+
+        Unlike the participant given when the gossiper was created,
+        which is told about every change, C{participant} is only told
+        about changes to the given C{keys}, and to keys that start
+        with any of the given C{prefixes}.  It is told about all peers
+        that come and go.
+
+        @param keys: A sequence of exact keys.
+        @param prefixes: A sequence of key prefixes, such as
+            C{'leader:'}.  The empty prefix matches all keys.
+        """
+        self._dispatcher.subscribe(participant, keys, prefixes)
+        if participant not in self._subscribers:
+            self._subscribers.append(participant)
+            if self.name is not None:
+                participant.make_connection(self)
+
+    def unsubscribe(self, participant):
+        """Detach a participant attached with L{subscribe}."""
+        self._dispatcher.unsubscribe(participant)
+        if participant in self._subscribers:
+            self._subscribers.remove(participant)
+
+    def watch_lag(self, threshold, callback):
+        """Have C{callback(address, lag)} called when the digest of
+        the gossiper at C{address}, a C{(host, port)} tuple, shows
+        that we are at least C{threshold} versions behind it, summed
+        over all peers.
+        """
+        self._lag_watch = (threshold, callback)
+
+    def snapshot(self):
+        """Return the state of all peers we know of, in a form that
+        can be encoded as JSON and passed to L{load_snapshot} on
+        another node.
+
+        Heartbeat generations are only included for live peers.
+        """
+        peers = {}
+        for name, state in self._states.items():
+            peer = {'version': state.max_version_seen,
+                    'keys': [list(delta) for delta
+                             in state.deltas_after_version(0)]}
+            if state.alive or state is self.state:
+                peer['heartbeat'] = state.heart_beat_version
+            peers[name] = peer
+        return {'peers': peers}
+
+    def load_snapshot(self, snapshot):
+        """Bring our view of other peers up to date with a snapshot
+        taken by L{snapshot} on another node.
+
+        Only what is newer than what we know is applied, and
+        participants are told about it as if it had been gossiped.
+        """
+        peers = snapshot['peers']
+        names = [name for name in peers if name != self.name
+                 and name not in self._scuttle.tombstones]
+        self._handle_new_peers(names)
+        updates = []
+        heartbeats = {}
+        for name in names:
+            peer = peers[name]
+            if peer['version'] > self._states[name].max_version_seen:
+                updates.extend((name, key, value, version)
+                               for (key, value, version) in peer['keys'])
+            if 'heartbeat' in peer:
+                heartbeats[name] = peer['heartbeat']
+        self._apply_updates(updates)
+        self._scuttle.update_heartbeats(heartbeats)
+
+    def register_message_type(self, message_type, handler):
+        """Have C{handler(message, address)} called for incoming
+        messages of type C{message_type}.
+
+        This lets participants run protocols of their own next to
+        gossip.  Their messages are sent with L{send_message}.
+        """
+        self._handlers[message_type] = handler
+
+    def send_message(self, message, address):
+        """Send C{message}, a C{dict} with a C{'type'} entry, to the
+        gossiper at C{address}, a C{(host, port)} tuple.
+        """
+        self._send(message, address)
+
     def _beat_heart(self):
         """Beat heart of our own state."""
-        self.state.beat_that_heart()
+        self.state.beat_that_heart(publish=self._has_legacy_peers())
+
+    def _has_legacy_peers(self):
+        """Return C{True} if any live peer has gossiped with us
+        without telling us that it understands the heartbeat channel.
+
+        Such peers only see our heartbeats if they are published as
+        a key, as they were before the channel existed.
+        """
+        return self._membership.live_legacy > 0
 
     def datagramReceived(self, data, address):
         """Handle a received datagram."""
-        self._handle_message(json.loads(data), address)
+        self._bytes_received.inc(len(data))
+        for codec in self._codecs:
+            if codec.accepts(data):
+                break
+        else:
+            log.msg("dropping datagram from %s:%d in unknown format"
+                    % address)
+            self._datagrams_dropped.inc()
+            return
+        try:
+            message = codec.decode(data)
+        except CodecError, e:
+            log.msg("dropping bad datagram from %s:%d: %s"
+                    % (address + (e,)))
+            self._datagrams_dropped.inc()
+            return
+        self._count_message(self._received_counters, 'messages_received',
+                            message.get('type'))
+        self._negotiate_codec(codec, message, address)
+        self._handle_message(message, address)
+
+    def _negotiate_codec(self, codec, message, address):
+        """Figure out what codec to use when talking to C{address}.
+
+        A peer that speaks anything but JSON to us obviously
+        understands that codec.  A peer that speaks JSON may tell us
+        what else it understands in the C{codecs} field; older peers
+        do not, and will be spoken to in JSON.
+        """
+        if codec.name != self._json_codec.name:
+            self._peer_codecs[address] = codec
+            return
+        supported = message.get('codecs', ())
+        for codec in self._codecs:
+            if codec.name in supported:
+                break
+        else:
+            codec = self._json_codec
+        self._peer_codecs[address] = codec
+
+    def _encode(self, message, address):
+        """Encode C{message} for C{address}."""
+        codec = self._peer_codecs.get(address, self._json_codec)
+        if codec.name == self._json_codec.name:
+            message['codecs'] = [c.name for c in self._codecs]
+        return codec.encode(message)
+
+    def _send(self, message, address):
+        """Encode and send C{message} to C{address}.
+
+        The deltas of a message are packed against an estimate of
+        their size, so if the datagram still comes out larger than
+        the MTU the last of them are left out until it fits.  The
+        first delta is always kept, like L{Scuttle._pack} does, and
+        goes out in a datagram of its own size if it has to.
+        """
+        data = self._encode(message, address)
+        updates = message.get('updates')
+        while (updates is not None and len(updates) > 1
+                and self._mtu is not None and len(data) > self._mtu):
+            updates.pop()
+            data = self._encode(message, address)
+        self._count_message(self._sent_counters, 'messages_sent',
+                            message['type'])
+        self._bytes_sent.inc(len(data))
+        self._datagram_size.observe(len(data))
+        self.transport.write(data, address)
 
     def _gossip(self):
         """Initiate a round of gossiping."""
+        self._rounds.inc()
         live_peers = self.live_peers
         dead_peers = self.dead_peers
-        if live_peers:
-            self._gossip_with_peer(random.choice(live_peers))
+        fanout = self._fanout
+        if self._adaptive:
+            fanout = max(fanout,
+                int(math.ceil(math.log(len(live_peers) + 1))))
+        if fanout == 1 and live_peers:
+            self._gossip_with_peer(live_peers.choice())
+        else:
+            for peer in random.sample(live_peers,
+                                      min(fanout, len(live_peers))):
+                self._gossip_with_peer(peer)
 
         prob = len(dead_peers) / float(len(live_peers) + 1)
         if random.random() < prob:
-            self._gossip_with_peer(random.choice(dead_peers))
-
-        for state in self._states.values():
-            if state.name != self.name:
-                state.check_suspected()
+            self._gossip_with_peer(dead_peers.choice())
+
+        now = self.clock.seconds()
+        self._membership.check_suspected(now)
+        self._evict_dead_peers(now)
+
+        if self._adaptive:
+            self._adapt_gossip_interval()
+
+    def _adapt_gossip_interval(self):
+        """Back off the round interval while nothing changes."""
+        digest_hash = self._scuttle.digest_hash
+        if digest_hash == self._last_digest_hash:
+            interval = min(self._gossip_timer.interval * 2,
+                           self._max_gossip_interval)
+        else:
+            interval = self._gossip_interval
+        self._last_digest_hash = digest_hash
+        self._gossip_timer.interval = interval
 
     def _gossip_with_peer(self, peer):
         """Send a gossip message to C{peer}."""
-        self.transport.write(json.dumps({
-            'type': 'request', 'digest': self._scuttle.digest()
-            }), _address_from_peer_name(peer.name))
+        address = _address_from_peer_name(peer.name)
+        if (self._digest_hash
+                and 'digest-hash' in self._peer_features.get(address, ())):
+            self._send({
+                'type': 'request', 'hash': self._scuttle.digest_hash,
+                'heartbeats': self._scuttle.heartbeat_slice(),
+                'features': list(self.FEATURES), 'name': self.name
+                }, address)
+        else:
+            self._send_digest(address)
+
+    def _send_digest(self, address):
+        """Send a request carrying our full digest to C{address}."""
+        digest = self._scuttle.digest_slice()
+        message = {
+            'type': 'request', 'digest': digest,
+            'heartbeats': self._scuttle.heartbeats(digest),
+            'features': list(self.FEATURES), 'name': self.name
+            }
+        tombstones = self._scuttle.tombstones
+        if tombstones:
+            # Tombstones are only dropped once a round, so some may
+            # have expired since.
+            now = self.clock.seconds()
+            tombstones = dict((name, int(math.ceil(expires - now)))
+                              for (name, expires) in tombstones.items()
+                              if expires > now)
+            if tombstones:
+                message['tombstones'] = tombstones
+        self._send(message, address)
+
+    def _delta_budget(self, message, address):
+        """Return how many bytes C{message}, a response to C{address}
+        that has no deltas yet, may spend on them.
+        """
+        if self._mtu is None:
+            return None
+        return self._mtu - len(self._encode(message, address))
 
     def _handle_message(self, message, address):
         """Handle an incoming message."""
+        if self._scuttle.tombstones and 'name' in message:
+            # A peer we evicted is evidently back.
+            self._scuttle.tombstones.pop(message['name'], None)
         if message['type'] == 'request':
             self._handle_request(message, address)
+            self._record_features(message, address)
         elif message['type'] == 'first-response':
             self._handle_first_response(message, address)
+            self._record_features(message, address)
         elif message['type'] == 'second-response':
             self._handle_second_response(message, address)
+        elif message['type'] == 'digest-request':
+            self._handle_digest_request(message, address)
+            self._record_features(message, address)
+        elif isinstance(message['type'], basestring):
+            handler = self._handlers.get(message['type'])
+            if handler is not None:
+                handler(message, address)
+
+    def _record_features(self, message, address):
+        """Remember what protocol extensions the sender of C{message}
+        understands.
+
+        Every message but the second response carries the
+        C{features} field, unless the sender predates it.
+        """
+        features = message.get('features', ())
+        self._peer_features[address] = features
+        state = self._states.get(message.get('name', '%s:%d' % address))
+        if state is not None and state is not self.state:
+            self._membership.mark_legacy(state, 'heartbeats' not in features)
 
     def _handle_request(self, message, address):
-        """Handle an incoming gossip request."""
+        """Handle an incoming gossip request.
+
+        A request carries either a full digest or, if the sender knows
+        that we understand it, only the hash of its digest.  When the
+        hash differs from ours we ask the sender for its full digest,
+        after which the exchange goes on as if the sender had sent it
+        in the first place.
+
+        Either way the request carries the heartbeat generations the
+        sender knows of.  We respond with the ones we know to be newer.
+        """
+        heartbeats = message.get('heartbeats', {})
+        newer = self._scuttle.newer_heartbeats(heartbeats)
+        self._scuttle.update_heartbeats(heartbeats)
+        if 'digest' not in message:
+            if message.get('hash') != self._scuttle.digest_hash:
+                self._send({
+                    'type': 'digest-request', 'heartbeats': newer,
+                    'features': list(self.FEATURES)
+                    }, address)
+            elif newer:
+                self._send({
+                    'type': 'first-response', 'digest': {}, 'updates': [],
+                    'heartbeats': newer, 'features': list(self.FEATURES)
+                    }, address)
+            return
+        if 'tombstones' in message:
+            self._apply_tombstones(message['tombstones'])
+        response = {
+            'type': 'first-response', 'digest': {}, 'updates': [],
+            'heartbeats': newer, 'features': list(self.FEATURES)
+            }
         deltas, requests, new_peers = self._scuttle.scuttle(
-            message['digest'])
+            message['digest'], self._delta_budget(response, address))
         self._handle_new_peers(new_peers)
-        response = json.dumps({
-            'type': 'first-response', 'digest': requests, 'updates': deltas
-            })
-        self.transport.write(response, address)
+        self._check_lag(message['digest'], requests, address)
+        response['digest'] = requests
+        response['updates'] = deltas
+        self._send(response, address)
+
+    def _check_lag(self, digest, requests, address):
+        """Record how far behind C{requests}, made from C{digest},
+        show us to be, and tell the lag watcher if it is too far."""
+        lag = sum(digest[name] - version
+                  for (name, version) in requests.items())
+        self._lag.set(lag)
+        if self._lag_watch is not None:
+            threshold, callback = self._lag_watch
+            if lag >= threshold:
+                callback(address, lag)
+
+    def _handle_digest_request(self, message, address):
+        """Handle a peer asking for our full digest because it did
+        not match the hash we sent.
+        """
+        self._scuttle.update_heartbeats(message.get('heartbeats', {}))
+        self._send_digest(address)
+
+    def _apply_updates(self, updates):
+        """Apply the updates of a message as a single batch."""
+        self._dispatcher.begin()
+        try:
+            applied = self._scuttle.update_known_state(updates)
+        finally:
+            self._dispatcher.commit()
+        self._deltas_applied.inc(applied)
+        self._deltas_stale.inc(len(updates) - applied)
 
     def _handle_first_response(self, message, address):
         """Handle the response to a request."""
-        self._scuttle.update_known_state(message['updates'])
-        response = json.dumps({
-            'type': 'second-response',
-            'updates': self._scuttle.fetch_deltas(
-                    message['digest'])
-            })
-        self.transport.write(response, address)
+        self._scuttle.update_heartbeats(message.get('heartbeats', {}))
+        self._apply_updates(message['updates'])
+        if not message['digest']:
+            return
+        response = {'type': 'second-response', 'updates': []}
+        response['updates'] = self._scuttle.fetch_deltas(
+            message['digest'], self._delta_budget(response, address))
+        self._send(response, address)
 
     def _handle_second_response(self, message, address):
         """Handle the ack of the response."""
-        self._scuttle.update_known_state(message['updates'])
+        self._apply_updates(message['updates'])
 
     def live_peers():
         """Property for all peers that we know is alive.
 
-        The property holds a sequence L{PeerState}'s.
+        The property holds a L{PeerSet} of L{PeerState}'s, which is
+        kept up to date as peers come and go.
         """
         def get(self):
-            return [p for (n, p) in self._states.items()
-               if p.alive and n != self.name]
+            return self._membership.live
         return get,
     live_peers = property(*live_peers())
 
     def dead_peers():
         """Property for all peers that we know is dead.
 
-        The property holds a sequence L{PeerState}'s.
+        The property holds a L{PeerSet} of L{PeerState}'s, which is
+        kept up to date as peers come and go.
         """
         def get(self):
-            return [p for (n, p) in self._states.items()
-               if not p.alive and n != self.name]
+            return self._membership.dead
         return get,
     dead_peers = property(*dead_peers())
 
@@ -216,9 +773,42 @@ class Gossiper(DatagramProtocol):
     def set(self, key, value):
         self.state[key] = value
 
+    def set_many(self, items):
+        """Set a number of keys at once.
+
+        The keys get consecutive versions, so peers pick them up
+        together, and participants are told about them in one batch.
+
+        @param items: A mapping or a sequence of C{(key, value)}
+            tuples.
+        """
+        self._dispatcher.begin()
+        try:
+            self.state.set_many(items)
+        finally:
+            self._dispatcher.commit()
+
+    def batch(self):
+        """Return a L{Batch} that sets the values set through it with
+        L{set_many} when a C{with} block ends.
+        """
+        return Batch(self.set_many)
+
     def __setitem__(self, key, value):
         self.set(key, value)
 
+    def load(self, items):
+        """Install a sequence of C{(key, value)} tuples in our state
+        without telling participants about them as changes.
+
+        Participants that implement C{values_loaded(peer, items)} are
+        still told about the items; see L{Dispatcher.values_loaded}.
+        See also L{PeerState.load}.
+        """
+        items = list(items)
+        self.state.load(items)
+        self._dispatcher.values_loaded(self.state, items)
+
     def __contains__(self, key):
         return key in self.state
 
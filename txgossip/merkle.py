@@ -0,0 +1,274 @@
+# Copyright (C) 2011 Johan Rydberg
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Merkle-tree anti-entropy for the replicated key store.
+
+Every node of a L{KeyStoreMixin} cluster ends up with the same
+C{(timestamp, value)} pair for each replicated key.  The
+L{AntiEntropy} participant finds the keys on which two nodes differ
+by comparing hash trees of their key stores, descending only into
+the ranges whose hashes differ, and then exchanges just the values
+of those ranges.
+"""
+
+import hashlib
+import json
+import struct
+
+from twisted.internet import task
+
+from txgossip.gossip import _address_from_peer_name
+from txgossip.recipies import _newer
+
+
+_DIGITS = '0123456789abcdef'
+
+
+def _bucket(key, depth):
+    """Return the path of the leaf that C{key} belongs to."""
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return hashlib.md5(key).hexdigest()[:depth]
+
+
+def _entry_hash(key, timestamped_value):
+    data = json.dumps([key, timestamped_value], sort_keys=True,
+                      separators=(',', ':'))
+    return struct.unpack('>Q', hashlib.md5(data).digest()[:8])[0]
+
+
+class MerkleTree(object):
+    """Hash tree over a set of key-value pairs.
+
+    Keys are placed in one of M{16^depth} leaves by the hash of the
+    key.  A node is named by its path, a string of hex digits, with
+    the root being C{''}.  The hash of a node is the XOR of the hashes
+    of all entries below it, so a change updates M{depth + 1} nodes.
+    """
+
+    def __init__(self, depth=3):
+        self.depth = depth
+        self._hashes = {}
+        self._leaves = {}
+
+    def set(self, key, timestamped_value):
+        path = _bucket(key, self.depth)
+        leaf = self._leaves.setdefault(path, {})
+        h = _entry_hash(key, timestamped_value)
+        if key in leaf:
+            h ^= _entry_hash(key, leaf[key])
+        leaf[key] = timestamped_value
+        hashes = self._hashes
+        for i in range(self.depth + 1):
+            hashes[path[:i]] = hashes.get(path[:i], 0) ^ h
+
+    def hash(self, path=''):
+        return self._hashes.get(path, 0)
+
+    def children(self, path):
+        """Return the hashes of the children of the node at C{path}."""
+        hashes = self._hashes
+        return [hashes.get(path + c, 0) for c in _DIGITS]
+
+    def entries(self, path):
+        """Return the C{(key, timestamped_value)} pairs of the leaf
+        at C{path}.
+        """
+        return self._leaves.get(path, {}).items()
+
+
+class AntiEntropy(object):
+    """Participant that reconciles the key store with other nodes.
+
+    Attach it to the gossiper of a L{KeyStoreMixin} with
+    C{gossiper.subscribe(anti_entropy, prefixes=[''])}.  When a peer
+    comes alive, and every C{interval} seconds with a random live peer
+    if C{interval} is given, the two nodes compare the children of
+    the differing nodes of their trees, one level per message.  For
+    leaves that differ the initiator sends its entries, and the other
+    node replicates the newer ones and sends back those that it has
+    newer or that the initiator lacks.
+
+    Leaves whose entries do not fit in one message are split over
+    several, but it is cheaper if C{depth} is large enough for a leaf
+    to fit in a datagram.
+    """
+
+    def __init__(self, keystore, clock, depth=3, interval=None,
+                 max_bytes=1200):
+        """
+        @param keystore: The L{KeyStoreMixin} to reconcile.
+        @param depth: Depth of the hash tree.
+        @param interval: Seconds between exchanges with a random live
+            peer, or C{None} to only exchange with peers that come
+            alive.
+        @param max_bytes: Approximate upper bound on the size of the
+            messages.
+        """
+        self.keystore = keystore
+        self.clock = clock
+        self.tree = MerkleTree(depth)
+        self.interval = interval
+        self.max_bytes = max_bytes
+        self.gossiper = None
+        self._timer = None
+
+    def make_connection(self, gossiper):
+        self.gossiper = gossiper
+        gossiper.register_message_type('merkle-hashes', self._handle_hashes)
+        gossiper.register_message_type('merkle-entries',
+                                       self._handle_entries)
+        for key in gossiper.keys():
+            if self.keystore.is_replicated(key):
+                self.tree.set(key, gossiper.get(key))
+        if self.interval is not None:
+            self._timer = task.LoopingCall(self._exchange_with_random_peer)
+            self._timer.clock = self.clock
+            self._timer.start(self.interval, now=False)
+
+    def value_changed(self, peer, key, value):
+        self.values_changed(peer, [(key, value)])
+
+    def values_changed(self, peer, changes):
+        if peer.name != self.gossiper.name:
+            return
+        for key, timestamped_value in changes:
+            if self.keystore.is_replicated(key):
+                self.tree.set(key, timestamped_value)
+
+    def values_loaded(self, peer, items):
+        # Values restored with KeyStoreMixin.load_from are not
+        # announced as changes, but belong in the tree all the same.
+        self.values_changed(peer, items)
+
+    def peer_alive(self, peer):
+        self.synchronize(_address_from_peer_name(peer.name))
+
+    def peer_dead(self, peer):
+        pass
+
+    def _exchange_with_random_peer(self):
+        live_peers = self.gossiper.live_peers
+        if live_peers:
+            self.synchronize(_address_from_peer_name(
+                    live_peers.choice().name))
+
+    def synchronize(self, address):
+        """Start reconciling with the gossiper at C{address}."""
+        self.gossiper.send_message({
+                'type': 'merkle-hashes',
+                'nodes': {'': self.tree.children('')}
+                }, address)
+
+    def _chunks(self, items, size):
+        """Split C{items} into lists whose estimated size, according
+        to C{size}, fits in a message.
+        """
+        chunk, used = [], 0
+        for item in items:
+            n = size(item)
+            if chunk and used + n > self.max_bytes:
+                yield chunk
+                chunk, used = [], 0
+            chunk.append(item)
+            used += n
+        if chunk:
+            yield chunk
+
+    def _handle_hashes(self, message, address):
+        tree = self.tree
+        inner, leaves = [], []
+        for path, hashes in message['nodes'].items():
+            path = str(path)
+            for c, theirs, ours in zip(_DIGITS, hashes, tree.children(path)):
+                if theirs == ours:
+                    continue
+                child = path + c
+                if len(child) == tree.depth:
+                    leaves.append(child)
+                else:
+                    inner.append(child)
+
+        for chunk in self._chunks(inner, lambda path: 24 * 16):
+            self.gossiper.send_message({
+                    'type': 'merkle-hashes',
+                    'nodes': dict((path, tree.children(path))
+                                  for path in chunk)
+                    }, address)
+        self._send_entries(leaves, True, address)
+
+    def _send_entries(self, leaves, reply, address, lacking=None):
+        """Send the entries of C{leaves}, in as many messages as it
+        takes to stay within C{max_bytes}.
+
+        A leaf whose entries are split over several messages is only
+        listed in the last of them.  If C{reply} is set the receiver
+        then also sends back the entries of the leaf that were in the
+        earlier messages, which is redundant but harmless.  An entry
+        that is larger than C{max_bytes} is sent on its own.
+
+        @param reply: Whether the receiver should send back entries
+            that we lack.
+        @param lacking: If given, a function that tells if the
+            receiver lacks an entry; other entries are left out.
+        """
+        for chunk, entries in self._entry_chunks(leaves, lacking):
+            if not entries and not reply:
+                continue
+            self.gossiper.send_message({
+                    'type': 'merkle-entries', 'leaves': chunk,
+                    'entries': entries, 'reply': reply
+                    }, address)
+
+    def _entry_chunks(self, leaves, lacking):
+        """Split the entries of C{leaves} into C{(leaves, entries)}
+        pairs that fit in a message each.
+        """
+        tree = self.tree
+        chunk, entries, used = [], [], 0
+        for leaf in leaves:
+            for entry in tree.entries(leaf):
+                if lacking is not None and not lacking(*entry):
+                    continue
+                n = len(json.dumps(entry)) + 2
+                if entries and used + n > self.max_bytes:
+                    yield chunk, entries
+                    chunk, entries, used = [], [], 0
+                entries.append(entry)
+                used += n
+            chunk.append(leaf)
+            used += len(leaf) + 4
+        if chunk or entries:
+            yield chunk, entries
+
+    def _handle_entries(self, message, address):
+        theirs = {}
+        for key, timestamped_value in message['entries']:
+            theirs[key] = timestamped_value
+            self.keystore.replicate_key_value(None, key, timestamped_value)
+        if not message.get('reply'):
+            return
+        def lacking(key, timestamped_value):
+            return (key not in theirs
+                    or _newer(timestamped_value, theirs[key]))
+        self._send_entries([str(leaf) for leaf in message['leaves']],
+                           False, address, lacking)
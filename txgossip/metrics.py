@@ -0,0 +1,223 @@
+# Copyright (C) 2011 Johan Rydberg
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Counters, gauges and histograms describing a running gossiper.
+
+Every L{Gossiper} keeps a L{Metrics} registry in its C{metrics}
+attribute.  Updating a metric is an attribute increment or two, so
+they are updated unconditionally; L{Metrics.snapshot} collects the
+current values when someone asks for them.
+
+L{MetricsResource} exports a registry as plain text over HTTP::
+
+    from twisted.web.server import Site
+    reactor.listenTCP(9100, Site(MetricsResource(gossiper.metrics)),
+                      interface='127.0.0.1')
+"""
+
+import bisect
+
+from twisted.web import resource
+
+
+def _key(name, labels):
+    if not labels:
+        return name
+    return '%s{%s}' % (name, ','.join(
+            '%s="%s"' % (k, labels[k]) for k in sorted(labels)))
+
+
+class Counter(object):
+    """A count that only goes up."""
+
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+
+class Gauge(object):
+    """A value that is either set, or read from C{fn} when a snapshot
+    is taken.
+    """
+
+    __slots__ = ('value', 'fn')
+
+    def __init__(self, fn=None):
+        self.value = 0
+        self.fn = fn
+
+    def set(self, value):
+        self.value = value
+
+    def get(self):
+        if self.fn is not None:
+            return self.fn()
+        return self.value
+
+
+class Histogram(object):
+    """Counts of observed values that fall below each of a number of
+    upper bounds.
+    """
+
+    __slots__ = ('bounds', 'counts', 'count', 'sum')
+
+    def __init__(self, bounds):
+        self.bounds = sorted(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def get(self):
+        """Return the cumulative count for each bound, with C{None}
+        standing for infinity, along with the total count and sum.
+        """
+        buckets = []
+        total = 0
+        for bound, n in zip(self.bounds + [None], self.counts):
+            total += n
+            buckets.append((bound, total))
+        return {'buckets': buckets, 'count': self.count, 'sum': self.sum}
+
+
+class Metrics(object):
+    """Registry of named metrics.
+
+    A metric is named by a name and optional labels, such as
+    C{counter('messages_sent', type='request')}.  Asking for the same
+    name and labels again returns the same metric.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+
+    def _get(self, key, factory):
+        metric = self._metrics.get(key)
+        if metric is None:
+            metric = self._metrics[key] = factory()
+        return metric
+
+    def counter(self, name, **labels):
+        return self._get(_key(name, labels), Counter)
+
+    def gauge(self, name, fn=None, **labels):
+        """Return a gauge, which if C{fn} is given is read from it."""
+        gauge = self._get(_key(name, labels), Gauge)
+        if fn is not None:
+            gauge.fn = fn
+        return gauge
+
+    def histogram(self, name, bounds, **labels):
+        return self._get(_key(name, labels), lambda: Histogram(bounds))
+
+    def add_collector(self, collector):
+        """Have C{collector(add)} called when a snapshot is taken.
+
+        The collector reports values that are costly to keep up to
+        date by calling C{add(name, value, **labels)}.
+        """
+        self._collectors.append(collector)
+
+    def snapshot(self):
+        """Return a mapping of metric keys to their current values.
+
+        Counters and gauges map to numbers, histograms to the
+        C{dict} returned by L{Histogram.get}.
+        """
+        values = {}
+        for key, metric in self._metrics.items():
+            if type(metric) is Counter:
+                values[key] = metric.value
+            else:
+                values[key] = metric.get()
+        def add(name, value, **labels):
+            values[_key(name, labels)] = value
+        for collector in self._collectors:
+            collector(add)
+        return values
+
+
+def _split(key):
+    if '{' in key:
+        name, labels = key.split('{', 1)
+        return name, labels[:-1]
+    return key, ''
+
+
+def _join(name, labels, extra=''):
+    labels = ','.join(l for l in (labels, extra) if l)
+    if labels:
+        return '%s{%s}' % (name, labels)
+    return name
+
+
+def _number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def format_text(snapshot, prefix='txgossip_'):
+    """Format a snapshot with one C{name value} line per value, in the
+    text format Prometheus understands.
+    """
+    lines = []
+    for key in sorted(snapshot):
+        value = snapshot[key]
+        name, labels = _split(key)
+        name = prefix + name
+        if isinstance(value, dict):
+            for bound, n in value['buckets']:
+                le = '+Inf' if bound is None else repr(bound)
+                lines.append('%s %d' % (
+                        _join(name + '_bucket', labels, 'le="%s"' % le), n))
+            lines.append('%s %d' % (_join(name + '_count', labels),
+                                    value['count']))
+            lines.append('%s %s' % (_join(name + '_sum', labels),
+                                    _number(value['sum'])))
+        elif value is not None:
+            lines.append('%s %s' % (_join(name, labels), _number(value)))
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsResource(resource.Resource):
+    """Web resource that renders a registry with L{format_text}."""
+
+    isLeaf = True
+
+    def __init__(self, metrics):
+        resource.Resource.__init__(self)
+        self.metrics = metrics
+
+    def render_GET(self, request):
+        request.setHeader('content-type', 'text/plain; version=0.0.4')
+        return format_text(self.metrics.snapshot())
@@ -20,14 +20,128 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import bisect
 import fnmatch
+import json
+import re
+import threading
+
+from collections import OrderedDict
+
+from twisted.internet import defer, threads
+from twisted.python import failure, log
+
+from txgossip.gossip import Batch
+
+
+def _newer(timestamped_value, other):
+    """Return C{True} if C{timestamped_value} wins over C{other}.
+
+    The later timestamp wins.  Values with the same timestamp are told
+    apart by their canonical JSON encoding, so that every node picks
+    the same one.
+    """
+    if timestamped_value[0] != other[0]:
+        return timestamped_value[0] > other[0]
+    return _canonical(timestamped_value[1]) > _canonical(other[1])
+
+
+def _canonical(value):
+    return json.dumps(value, sort_keys=True, separators=(',', ':'))
+
+
+_GLOB_SPECIAL = re.compile(r'[*?[]')
+_globs = {}
+
+
+def _compile_glob(pattern):
+    """Split a glob pattern into its literal prefix and a matcher for
+    whole keys.
+
+    The matcher is C{None} if every key with the prefix matches.
+    """
+    try:
+        return _globs[pattern]
+    except KeyError:
+        pass
+    m = _GLOB_SPECIAL.search(pattern)
+    prefix = pattern if m is None else pattern[:m.start()]
+    if pattern[len(prefix):] == '*':
+        matcher = None
+    else:
+        matcher = re.compile(fnmatch.translate(pattern)).match
+    if len(_globs) >= 256:
+        _globs.clear()
+    _globs[pattern] = prefix, matcher
+    return prefix, matcher
+
+
+class KeyIndex(object):
+    """Sorted set of keys that supports membership tests, prefix and
+    range scans, and glob matching in logarithmic time.
+    """
+
+    def __init__(self, keys=()):
+        self._keys = sorted(set(keys))
+
+    def add(self, key):
+        keys = self._keys
+        i = bisect.bisect_left(keys, key)
+        if i == len(keys) or keys[i] != key:
+            keys.insert(i, key)
+
+    def __contains__(self, key):
+        keys = self._keys
+        i = bisect.bisect_left(keys, key)
+        return i != len(keys) and keys[i] == key
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def range(self, low=None, high=None):
+        """Return the keys from C{low} up to, but not including,
+        C{high}, in order.
+        """
+        keys = self._keys
+        i = 0 if low is None else bisect.bisect_left(keys, low)
+        j = len(keys) if high is None else bisect.bisect_left(keys, high)
+        return keys[i:j]
+
+    def prefixed(self, prefix):
+        """Return the keys that start with C{prefix}, in order."""
+        keys = self._keys
+        i = j = bisect.bisect_left(keys, prefix)
+        n = len(keys)
+        while j < n and keys[j].startswith(prefix):
+            j += 1
+        return keys[i:j]
+
+    def match(self, pattern):
+        """Return the keys that match the glob C{pattern}, in order.
+
+        Only keys that start with the literal part of the pattern are
+        looked at.
+        """
+        prefix, matcher = _compile_glob(pattern)
+        if prefix == pattern:
+            return [pattern] if pattern in self else []
+        keys = self.prefixed(prefix) if prefix else self._keys
+        if matcher is None:
+            return list(keys)
+        return [key for key in keys if matcher(key)]
 
 
 class LeaderElectionMixin:
     """Mixin for leader election among the nodes in the cluster.
 
     The C{value_changed} method should be called when any of the
-    related keys are changed in the key-stores.
+    related keys are changed in the key-stores.  The mixin can be
+    attached to a gossiper with C{gossiper.subscribe(election,
+    prefixes=['leader:'])}, in which case it is told about nothing
+    else.
 
     The mixin will call C{leader_elected} when an election has taken
     place.
@@ -95,6 +209,21 @@ class LeaderElectionMixin:
 
         return key in (self.VOTE_KEY, self.LEADER_KEY, self.PRIO_KEY)
 
+    def values_changed(self, peer, changes):
+        """Inform about a set of changed key-value pairs.
+
+        Every key is passed on to L{value_changed} once, with its last
+        value, no matter how many times it occurs in C{changes}.
+
+        @param peer: The peer that changed the values.
+        @param changes: A sequence of C{(key, value)} tuples.
+        """
+        changed = OrderedDict()
+        for key, value in changes:
+            changed[key] = value
+        for key, value in changed.iteritems():
+            self.value_changed(peer, key, value)
+
     def _vote(self):
         """Perform an election."""
         self._election_timeout = None
@@ -155,52 +284,237 @@ class LeaderElectionMixin:
 
 
 class KeyStoreMixin:
-    """Mixin that implements a distributed key-value store."""
+    """Mixin that implements a distributed key-value store.
+
+    By default every local change is written to storage and synced
+    before the notification returns.  If C{flush_interval} is given,
+    changes are instead queued and committed in a thread, either
+    C{flush_interval} seconds after the first queued change or as soon
+    as C{flush_size} keys are queued, with a single sync per commit.
+    Use L{flush} to wait for queued changes to reach storage, for
+    example before shutting down.
+
+    The commit thread only holds the storage lock while it hands a
+    batch over to storage, not while syncing it.  Values that have
+    been committed are also kept in a map on the reactor side, which
+    replicated changes are checked against first.
+    """
 
-    def __init__(self, clock, storage, ignore_keys=[]):
+    def __init__(self, clock, storage, ignore_keys=[], flush_interval=None,
+                 flush_size=None, run_in_thread=None):
         """Initialize key-value store mixin.
 
         @param clock: Something that can report the time, normally a
             Twisted reactor.
         @param storage: A backing storage object that responds to the
-            normal C{dict}-like protocol.
+            normal C{dict}-like protocol, such as a
+            L{txgossip.storage.LogStorage}.  If it has a C{sync}
+            method, it is called after every write; with
+            C{flush_interval} set, values must be readable while a
+            sync runs in another thread.
         @param ignore_keys: A sequence of keys that should not be
             replicated between the peers.
+        @param flush_interval: Number of seconds a change may stay
+            queued before it is committed, or C{None} to write
+            changes synchronously.
+        @param flush_size: Number of queued keys that triggers a
+            commit right away, or C{None} for no limit.
+        @param run_in_thread: Function used to run a commit outside
+            the reactor thread; takes a callable and its arguments
+            and returns a C{Deferred}.  Defaults to C{deferToThread}.
         """
         self.clock = clock
         self._storage = storage
         self._ignore_keys = ignore_keys
         self._gossiper = None
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self._run_in_thread = run_in_thread or threads.deferToThread
+        self._lock = threading.Lock()
+        self._dirty = {}
+        self._committing = None
+        # Values known to be in storage, kept in the reactor thread.
+        self._stored_values = {}
+        # Local changes collected by values_changed, or None.
+        self._batched = None
+        self._flush_call = None
+        self._waiters = []
+        self._index = None
 
     def make_connection(self, gossiper):
         self._gossiper = gossiper
+        self._index = None
+
+    def _key_index(self):
+        # Built from the gossiper on first use, and kept up to date
+        # from the changes we are told about.
+        if self._index is None:
+            self._index = KeyIndex(self._gossiper.keys())
+        return self._index
 
     def persist_key_value(self, key, timestamped_value):
-        self._storage[key] = timestamped_value
+        if self._batched is not None:
+            self._batched.append((key, timestamped_value))
+            return
+        self.persist_key_values([(key, timestamped_value)])
+
+    def persist_key_values(self, items):
+        """Persist a sequence of C{(key, timestamped_value)} tuples
+        with a single sync.
+        """
+        if self.flush_interval is None:
+            self._write(items)
+            self._stored_values.update(items)
+            return
+        self._dirty.update(items)
+        if self._committing is not None:
+            # Whatever is queued now is scheduled when the running
+            # commit is done.
+            return
+        if self.flush_size is not None and len(self._dirty) >= self.flush_size:
+            self._commit()
+        elif self._flush_call is None:
+            self._flush_call = self.clock.callLater(self.flush_interval,
+                                                    self._commit)
+
+    def flush(self):
+        """Commit all queued changes.
+
+        @return: A C{Deferred} that fires when every change queued
+            before the call has been written and synced.
+        """
+        if self.flush_interval is None:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._waiters.append(d)
+        if self._committing is None:
+            self._commit()
+        return d
+
+    def _commit(self):
+        if self._flush_call is not None:
+            if self._flush_call.active():
+                self._flush_call.cancel()
+            self._flush_call = None
+        waiters, self._waiters = self._waiters, []
+        if not self._dirty:
+            for d in waiters:
+                d.callback(None)
+            return
+        items, self._dirty = self._dirty, {}
+        self._committing = items
+        d = self._run_in_thread(self._write, items.items())
+        d.addBoth(self._committed, items, waiters)
+
+    def _committed(self, result, items, waiters):
+        self._committing = None
+        if isinstance(result, failure.Failure):
+            # Keep the values around for the next commit, unless they
+            # have been changed since.
+            for key, timestamped_value in items.items():
+                self._dirty.setdefault(key, timestamped_value)
+            log.err(result, "failed to commit key-value store")
+            for d in waiters:
+                d.errback(result)
+        else:
+            self._stored_values.update(items)
+            for d in waiters:
+                d.callback(None)
+        if self._waiters:
+            self._commit()
+        elif self._dirty and self._flush_call is None:
+            self._flush_call = self.clock.callLater(self.flush_interval,
+                                                    self._commit)
+
+    def _write(self, items):
+        with self._lock:
+            for key, timestamped_value in items:
+                self._storage[key] = timestamped_value
+        self._sync()
+
+    def _sync(self):
         if hasattr(self._storage, 'sync'):
             self._storage.sync()
 
+    def _stored(self, key):
+        """Return the timestamped value for C{key} that is stored or
+        about to be, or C{None}.
+        """
+        if key in self._dirty:
+            return self._dirty[key]
+        if self._committing is not None and key in self._committing:
+            return self._committing[key]
+        if key in self._stored_values:
+            return self._stored_values[key]
+        with self._lock:
+            if key not in self._storage:
+                return None
+            timestamped_value = self._storage[key]
+        self._stored_values[key] = timestamped_value
+        return timestamped_value
+
     def replicate_key_value(self, peer, key, timestamped_value):
-        timestamp, value = timestamped_value
-        if key in self._storage:
-            current_timestamp, current_value = self._storage[key]
-            if timestamp <= current_timestamp:
-                return
+        current = self._stored(key)
+        if current is not None and not _newer(timestamped_value, current):
+            return
         # We replicate the value.
         self._gossiper.set(key, timestamped_value)
 
+    def is_replicated(self, key):
+        """Return C{True} if C{key} is replicated between the peers."""
+        return key != '__heartbeat__' and key not in self._ignore_keys
+
     def value_changed(self, peer, key, timestamp_value):
         """A peer has changed its value."""
-        if key == '__heartbeat__' or key in self._ignore_keys:
+        local = peer.name == self._gossiper.name
+        if local and self._index is not None:
+            self._index.add(key)
+        if not self.is_replicated(key):
             return
-        if peer.name == self._gossiper.name:
+        if local:
             self.persist_key_value(key, timestamp_value)
         else:
             self.replicate_key_value(peer, key, timestamp_value)
 
+    def values_changed(self, peer, changes):
+        """A peer has changed a set of values.
+
+        Every change is passed on to L{value_changed}, and the local
+        ones it persists are written to storage with a single sync.
+        """
+        self._batched = batched = []
+        try:
+            for key, timestamp_value in changes:
+                self.value_changed(peer, key, timestamp_value)
+        finally:
+            self._batched = None
+        if batched:
+            self.persist_key_values(batched)
+
     def set(self, key, value):
         self._gossiper.set(key, [self.clock.seconds(), value])
 
+    def set_many(self, items):
+        """Set a number of keys at once, with the same timestamp.
+
+        The values are persisted together, with a single sync.
+
+        @param items: A mapping or a sequence of C{(key, value)}
+            tuples.
+        """
+        if hasattr(items, 'items'):
+            items = items.items()
+        now = self.clock.seconds()
+        self._gossiper.set_many([(key, [now, value])
+                                 for (key, value) in items])
+
+    def batch(self):
+        """Return a L{Batch} that sets the values set through it with
+        L{set_many}, and so with a single timestamp, when a C{with}
+        block ends.
+        """
+        return Batch(self.set_many)
+
     def __setitem__(self, key, value):
         self.set(key, value)
 
@@ -208,26 +522,42 @@ class KeyStoreMixin:
         return self._gossiper.get(key)[1]
 
     def get(self, key, default=None):
-        if key in self.keys():
+        if key in self:
             return self[key]
         return default
 
     def keys(self, pattern=None):
-        """Return a iterable of all available keys."""
+        """Return a sorted list of all available keys, or of those
+        that match the glob C{pattern}.
+        """
         if pattern is None:
-            return self._gossiper.keys()
-        else:
-            keys = self._gossiper.keys()
-            return [key for key in keys
-                    if fnmatch.fnmatch(key, pattern)]
+            return list(self._key_index())
+        return self._key_index().match(pattern)
+
+    def keys_with_prefix(self, prefix):
+        """Return a sorted list of the keys that start with
+        C{prefix}.
+        """
+        return self._key_index().prefixed(prefix)
+
+    def keys_in_range(self, low=None, high=None):
+        """Return a sorted list of the keys from C{low} up to, but
+        not including, C{high}.
+        """
+        return self._key_index().range(low, high)
 
     def load_from(self, storage):
-        for key in storage:
-            if key not in self._ignore_keys:
-                self._gossiper.set(key, storage[key])
+        """Restore the values in C{storage} as our own.
+
+        The values are installed in one step, without being written
+        back to storage.
+        """
+        self._gossiper.load([(key, storage[key]) for key in storage
+                             if key not in self._ignore_keys])
+        self._index = None
 
     def __contains__(self, key):
-        return key in self.keys()
+        return key in self._key_index()
 
     def peer_dead(self, peer):
         """A peer is dead."""
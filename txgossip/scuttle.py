@@ -21,27 +21,258 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import hashlib
+import json
+import random
+import struct
+
+from collections import OrderedDict
+
 from txgossip.state import PeerState
 
 
+def delta_size(peer, key, value, version):
+    """Estimate the number of bytes a delta takes up on the wire.
+
+    The estimate is that of the JSON codec, which is never smaller
+    than that of the binary codec.
+    """
+    return (len(peer) + len(key) + len(str(version)) + 10
+            + len(json.dumps(value, separators=(',', ':'))))
+
+
+def _entry_hash(peer, version):
+    data = ('%s:%d' % (peer, version)).encode('utf-8')
+    return struct.unpack('<Q', hashlib.md5(data).digest()[:8])[0]
+
+
+def digest_size(digest):
+    """Estimate the number of bytes a digest takes up on the wire."""
+    return 2 + sum([len(peer) + len(str(version)) + 6
+                    for (peer, version) in digest.items()])
+
+
 class Scuttle(object):
+    """Reconciliation of peer states, as described in the paper
+    "Efficient Reconciliation and Flow Control for Anti-Entropy
+    Protocols".
+
+    When a byte budget is given to L{scuttle} or L{fetch_deltas} the
+    deltas are packed into that budget.  Deltas of a single peer are
+    always packed in version order, and packing of a peer stops at
+    the first delta that does not fit; the rest is sent in a later
+    round.  The order in which peers get to use the budget is decided
+    by C{policy}:
+
+      - C{'most-behind'}: peers with the most outstanding deltas
+        first.
+      - C{'round-robin'}: rotate the peer that goes first between
+        calls.
+      - C{'oldest-first'}: peers whose deltas have been left out for
+        the longest time first.
 
-    def __init__(self, peers, local_peer):
+    The digest is kept up to date as versions change, which requires
+    that the scuttle is the C{listener} of every peer state, and that
+    it is told about new peers through L{add_peer}.  Along with the
+    digest a rolling hash is maintained, C{digest_hash}, that is equal
+    on two nodes if their digests are equal.  Entries with version 0
+    are part of the hash too, since they tell what peers exist.
+
+    Heartbeat generations that change through L{update_heartbeats} are
+    queued, and L{heartbeat_slice} hands out at most C{heartbeat_size}
+    of them at a time, oldest change first.
+    """
+
+    POLICIES = ('most-behind', 'round-robin', 'oldest-first')
+
+    DIGEST_MODES = ('window', 'random', 'recent')
+
+    def __init__(self, peers, local_peer, policy='most-behind',
+                 sizeof=delta_size, digest_size=None, digest_mode='window',
+                 heartbeat_size=None):
+        if policy not in self.POLICIES:
+            raise ValueError("unknown policy %r" % (policy,))
+        if digest_mode not in self.DIGEST_MODES:
+            raise ValueError("unknown digest mode %r" % (digest_mode,))
         self.peers = peers
         self.local_peer = local_peer
+        self.policy = policy
+        self.sizeof = sizeof
+        self._rounds = 0
+        self._served = {}
+        self._digest = {}
+        self.digest_hash = 0
+        self.digest_size = digest_size
+        self.digest_mode = digest_mode
+        self._names = []
+        self._window = 0
+        self._recent = OrderedDict()
+        self.heartbeat_size = heartbeat_size
+        # Peers whose heartbeat generation changed since it was last
+        # handed out by heartbeat_slice.
+        self._beats = OrderedDict()
+        # Peers that were removed and must not be picked up again from
+        # the digests of others, mapped to when that ends.
+        self.tombstones = {}
+        for state in peers.values():
+            self.add_peer(state)
+
+    def add_peer(self, state):
+        """Start tracking the version of C{state}."""
+        state.listener = self
+        if state.name in self._digest:
+            self.version_changed(state, self._digest[state.name])
+            return
+        self._names.append(state.name)
+        self._digest[state.name] = state.max_version_seen
+        self._recent[state.name] = state.max_version_seen
+        self.digest_hash ^= _entry_hash(state.name, state.max_version_seen)
+
+    def remove_peer(self, name):
+        """Stop tracking the peer named C{name}."""
+        version = self._digest.pop(name, None)
+        if version is None:
+            return
+        self.digest_hash ^= _entry_hash(name, version)
+        self._names.remove(name)
+        self._recent.pop(name, None)
+        self._served.pop(name, None)
+        self._beats.pop(name, None)
+
+    def version_changed(self, state, old_version):
+        """Update digest after the version of C{state} changed."""
+        name, version = state.name, state.max_version_seen
+        self.digest_hash ^= _entry_hash(name, self._digest[name])
+        self.digest_hash ^= _entry_hash(name, version)
+        self._digest[name] = version
+        self._recent.pop(name, None)
+        self._recent[name] = version
 
     def digest(self):
-        digest = {}
-        for peer, state in self.peers.items():
-            digest[peer] = state.max_version_seen
-        return digest
+        """Return a mapping of peer name to the highest version we
+        have seen of that peer.
+
+        The returned mapping is owned by the scuttle and must not be
+        modified.
+        """
+        return self._digest
+
+    def digest_slice(self):
+        """Return the part of the digest to send in a request.
+
+        Unless C{digest_size} is set this is the full digest.
+        Otherwise it holds the local peer and at most C{digest_size}
+        other peers, picked according to C{digest_mode}:
 
-    def scuttle(self, digest):
+          - C{'window'}: a window that moves over all peers, so that
+            every peer is covered every few rounds.
+          - C{'random'}: a random sample of the peers.
+          - C{'recent'}: the peers whose version changed most
+            recently, except for a quarter of the slice, rounded up,
+            that is taken from the moving window so that peers that
+            have not changed for a while are still covered.
+
+        The receiver of a slice only reconciles the peers in it.
+        """
+        size = self.digest_size
+        if size is None or size >= len(self._names):
+            return self._digest
+        if self.digest_mode == 'window':
+            chosen = self._window_slice(size, ())
+        elif self.digest_mode == 'random':
+            chosen = random.sample(self._names, size)
+        else:
+            recent = size - (size + 3) // 4
+            chosen = []
+            for name in reversed(self._recent):
+                if len(chosen) == recent:
+                    break
+                chosen.append(name)
+            skip = set(chosen)
+            skip.add(self.local_peer.name)
+            chosen += self._window_slice(size - recent, skip)
+        digest = self._digest
+        sliced = dict((name, digest[name]) for name in chosen)
+        local_name = self.local_peer.name
+        if local_name in digest:
+            sliced[local_name] = digest[local_name]
+        return sliced
+
+    def _window_slice(self, size, skip):
+        """Return the next C{size} peers of the moving window,
+        passing over those in C{skip}."""
+        names = self._names
+        start = i = self._window % len(names)
+        chosen = []
+        while len(chosen) < size and i < start + len(names):
+            name = names[i % len(names)]
+            if name not in skip:
+                chosen.append(name)
+            i += 1
+        self._window = i
+        return chosen
+
+    def heartbeats(self, names):
+        """Return a mapping of peer name to heartbeat generation for
+        the peers in C{names}.
+        """
+        peers = self.peers
+        return dict((name, peers[name].heart_beat_version)
+                    for name in names if name in peers)
+
+    def heartbeat_slice(self):
+        """Return the heartbeat generations to send along with the
+        hash of our digest.
+
+        Unless C{heartbeat_size} is set these are the generations of
+        the peers in L{digest_slice}.  Otherwise they are our own and
+        at most C{heartbeat_size} of those that changed since they
+        were last returned, so that the size of a request does not
+        grow with the cluster.
+        """
+        size = self.heartbeat_size
+        if size is None:
+            return self.heartbeats(self.digest_slice())
+        peers = self.peers
+        beats = self._beats
+        heartbeats = {}
+        while beats and len(heartbeats) < size:
+            name, _ = beats.popitem(last=False)
+            heartbeats[name] = peers[name].heart_beat_version
+        local = self.local_peer
+        heartbeats[local.name] = local.heart_beat_version
+        return heartbeats
+
+    def newer_heartbeats(self, heartbeats):
+        """Return the entries of our own heartbeat mapping that are
+        newer than those in C{heartbeats}.
+        """
+        newer = {}
+        peers = self.peers
+        for name, generation in heartbeats.items():
+            state = peers.get(name)
+            if state is not None and state.heart_beat_version > generation:
+                newer[name] = state.heart_beat_version
+        return newer
+
+    def update_heartbeats(self, heartbeats):
+        """Apply heartbeat generations received from a peer."""
+        peers = self.peers
+        for name, generation in heartbeats.items():
+            state = peers.get(name)
+            if (state is not None and state is not self.local_peer
+                    and generation > state.heart_beat_version):
+                state.update_heartbeat(generation)
+                self._beats[name] = None
+
+    def scuttle(self, digest, max_bytes=None):
         deltas_with_peer = []
         requests = {}
         new_peers = []
         for peer, digest_version in digest.items():
             if not peer in self.peers:
+                if peer in self.tombstones:
+                    continue
                 requests[peer] = 0
                 new_peers.append(peer)
             else:
@@ -54,28 +285,68 @@ class Scuttle(object):
                 elif state.max_version_seen < digest_version:
                     requests[peer] = state.max_version_seen
 
-        # Sort by peers with most deltas
-        def sort_metric(a, b):
-            return len(b[1]) - len(a[1])
-        deltas_with_peer.sort(cmp=sort_metric)
-
-        deltas = []
-        for (peer, peer_deltas) in deltas_with_peer:
-            for (key, value, version) in peer_deltas:
-                deltas.append((peer, key, value, version))
-
+        if max_bytes is not None:
+            # The requests go into the same datagram as the deltas.
+            max_bytes -= digest_size(requests)
+        deltas = self._pack(deltas_with_peer, max_bytes)
         return deltas, requests, new_peers
 
     def update_known_state(self, deltas):
+        """Apply C{deltas} to the states of their peers.
+
+        @return: The number of deltas that were applied; the rest
+            were stale.
+        """
+        peers = self.peers
+        applied = 0
         for peer, key, value, version in deltas:
-            self.peers[peer].update_with_delta(
-                str(key), value, version)
+            # The peer may have been removed since we asked for it.
+            if peer in peers and peers[peer].update_with_delta(
+                    str(key), value, version):
+                applied += 1
+        return applied
 
-    def fetch_deltas(self, requests):
-        deltas = []
+    def fetch_deltas(self, requests, max_bytes=None):
+        deltas_with_peer = []
         for peer, version in requests.items():
-            peer_deltas = self.peers[peer].deltas_after_version(
-                version)
+            if peer not in self.peers:
+                continue
+            deltas_with_peer.append((
+                    peer, self.peers[peer].deltas_after_version(version)))
+        return self._pack(deltas_with_peer, max_bytes)
+
+    def _order(self, deltas_with_peer):
+        """Order C{deltas_with_peer} according to the policy."""
+        if self.policy == 'most-behind':
+            deltas_with_peer.sort(key=lambda pd: -len(pd[1]))
+        elif self.policy == 'round-robin':
+            deltas_with_peer.sort(key=lambda pd: pd[0])
+            if deltas_with_peer:
+                n = self._rounds % len(deltas_with_peer)
+                deltas_with_peer = deltas_with_peer[n:] + deltas_with_peer[:n]
+        else:
+            served = self._served
+            deltas_with_peer.sort(key=lambda pd: served.get(pd[0], -1))
+        self._rounds += 1
+        return deltas_with_peer
+
+    def _pack(self, deltas_with_peer, max_bytes):
+        """Flatten per-peer deltas into a list of C{(peer, key,
+        value, version)} tuples that fit into C{max_bytes}.
+
+        The first delta is always included, so that a single large
+        value does not stall reconciliation forever.
+        """
+        deltas = []
+        remaining = max_bytes
+        for (peer, peer_deltas) in self._order(deltas_with_peer):
             for (key, value, version) in peer_deltas:
+                if remaining is not None:
+                    size = self.sizeof(peer, key, value, version)
+                    if size > remaining and deltas:
+                        break
+                    remaining -= size
                 deltas.append((peer, key, value, version))
+            else:
+                self._served[peer] = self._rounds
         return deltas
@@ -0,0 +1,348 @@
+# Copyright (C) 2011 Johan Rydberg
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Deterministic simulation of a gossip cluster in a single process.
+
+L{Network} stands in for C{reactor.listenUDP}.  Datagrams are delivered
+by a C{task.Clock} after a configurable latency, and may be lost,
+reordered or blocked by partitions.  All randomness comes from a
+seeded generator, so a run can be repeated exactly.
+
+L{Simulation} runs a number of gossipers on such a network and
+measures how long it takes for membership and values to converge, how
+many messages and bytes that costs, and how often a live peer is
+wrongly declared dead.  It can also be run from the command line::
+
+    python -m txgossip.simulation --nodes 1000 --loss 0.01
+"""
+
+import heapq
+import itertools
+import optparse
+import random
+
+from twisted.internet import task
+from twisted.internet.address import IPv4Address
+
+from txgossip.gossip import Gossiper
+
+
+class SimulatedPort(object):
+    """Transport of a protocol listening on a L{Network}."""
+
+    def __init__(self, network, protocol, address):
+        self.network = network
+        self.protocol = protocol
+        self.address = address
+
+    def getHost(self):
+        return IPv4Address('UDP', self.address[0], self.address[1])
+
+    def write(self, data, address):
+        self.network.send(self.address, address, data)
+
+    def stopListening(self):
+        self.network.remove(self.address)
+
+
+class Network(object):
+    """In-memory datagram network driven by a clock.
+
+    Every datagram takes C{latency} seconds plus a uniformly random
+    extra of up to C{jitter} seconds to arrive.  With probability
+    C{loss} it is dropped, and with probability C{reorder} it is held
+    back for another C{reorder_delay} seconds, so that later datagrams
+    overtake it.
+    """
+
+    def __init__(self, clock=None, latency=0.01, jitter=0.0, loss=0.0,
+                 reorder=0.0, reorder_delay=None, seed=0):
+        if clock is None:
+            clock = task.Clock()
+        self.clock = clock
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.reorder = reorder
+        if reorder_delay is None:
+            reorder_delay = 2 * latency
+        self.reorder_delay = reorder_delay
+        self.random = random.Random(seed)
+        self._ports = {}
+        self._groups = None
+        # Datagrams in flight are kept in a heap of our own, with a
+        # single call on the clock for the first of them.
+        self._queue = []
+        self._counter = itertools.count()
+        self._call = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        """Zero the message counters."""
+        self.messages = 0
+        self.bytes = 0
+        self.dropped = 0
+
+    def listenUDP(self, port, protocol, interface='127.0.0.1'):
+        """Attach C{protocol} to the network, like C{reactor.listenUDP}.
+
+        @return: The L{SimulatedPort}.
+        """
+        address = (interface, port)
+        if address in self._ports:
+            raise ValueError("address %s:%d already in use" % address)
+        transport = SimulatedPort(self, protocol, address)
+        self._ports[address] = transport
+        protocol.makeConnection(transport)
+        return transport
+
+    def remove(self, address):
+        transport = self._ports.pop(address, None)
+        if transport is not None:
+            transport.protocol.doStop()
+
+    def partition(self, *groups):
+        """Split the network into C{groups} of C{(host, port)}
+        addresses.  Datagrams between groups are dropped.  Addresses
+        not in any group form a group of their own.
+        """
+        self._groups = {}
+        for i, group in enumerate(groups):
+            for address in group:
+                self._groups[address] = i
+
+    def heal(self):
+        """Remove all partitions."""
+        self._groups = None
+
+    def _blocked(self, source, destination):
+        groups = self._groups
+        if groups is None:
+            return False
+        return groups.get(source) != groups.get(destination)
+
+    def send(self, source, destination, data):
+        self.messages += 1
+        self.bytes += len(data)
+        rand = self.random.random
+        if (self.loss and rand() < self.loss) or self._blocked(
+                source, destination):
+            self.dropped += 1
+            return
+        delay = self.latency
+        if self.jitter:
+            delay += rand() * self.jitter
+        if self.reorder and rand() < self.reorder:
+            delay += self.reorder_delay
+        self._schedule(self.clock.seconds() + delay,
+                       (source, destination, data))
+
+    def _schedule(self, when, datagram):
+        heapq.heappush(self._queue, (when, next(self._counter), datagram))
+        if self._call is not None:
+            if self._call.getTime() <= when:
+                return
+            self._call.cancel()
+        self._call = self.clock.callLater(when - self.clock.seconds(),
+                                          self._deliver)
+
+    def _deliver(self):
+        self._call = None
+        queue = self._queue
+        now = self.clock.seconds()
+        while queue and queue[0][0] <= now:
+            when, n, (source, destination, data) = heapq.heappop(queue)
+            transport = self._ports.get(destination)
+            if transport is None or self._blocked(source, destination):
+                self.dropped += 1
+                continue
+            transport.protocol.datagramReceived(data, source)
+        if queue:
+            self._call = self.clock.callLater(max(0, queue[0][0] - now),
+                                              self._deliver)
+
+
+class _Recorder(object):
+    """Participant that records what a gossiper is told."""
+
+    def __init__(self, simulation):
+        self.simulation = simulation
+        self.gossiper = None
+
+    def make_connection(self, gossiper):
+        self.gossiper = gossiper
+
+    def value_changed(self, peer, key, value):
+        pass
+
+    def peer_alive(self, peer):
+        pass
+
+    def peer_dead(self, peer):
+        self.simulation._peer_reported_dead(self.gossiper, peer.name)
+
+
+class Simulation(object):
+    """Runs a cluster of gossipers on a L{Network}.
+
+    All nodes listen on C{127.0.0.1}, on consecutive ports, and are
+    seeded with the first C{seeds} nodes.
+
+    Gossipers pick peers through the C{random} module, so seed it too
+    for a run to be repeatable.
+    """
+
+    def __init__(self, nodes, seeds=1, network=None, base_port=10000,
+                 **gossiper_args):
+        """
+        @param nodes: Number of gossipers.
+        @param network: The L{Network} to run on; a default one is
+            created if not given.
+        @param gossiper_args: Keyword arguments for every L{Gossiper}.
+        """
+        if network is None:
+            network = Network()
+        self.network = network
+        self.clock = network.clock
+        self.gossipers = []
+        self.ports = []
+        self.stopped = set()
+        self.false_positives = 0
+        seed_names = ['127.0.0.1:%d' % (base_port + i)
+                      for i in range(min(seeds, nodes))]
+        for i in range(nodes):
+            gossiper = Gossiper(self.clock, _Recorder(self), '127.0.0.1',
+                                **gossiper_args)
+            gossiper.seed([name for name in seed_names
+                           if name != '127.0.0.1:%d' % (base_port + i)])
+            self.gossipers.append(gossiper)
+            self.ports.append(network.listenUDP(base_port + i, gossiper))
+
+    @property
+    def running(self):
+        """The gossipers that have not been stopped."""
+        return [g for g in self.gossipers if g.name not in self.stopped]
+
+    def stop(self, i):
+        """Stop the C{i}th gossiper, as if its node went down."""
+        self.stopped.add(self.gossipers[i].name)
+        self.ports[i].stopListening()
+
+    def _peer_reported_dead(self, gossiper, name):
+        if name not in self.stopped:
+            self.false_positives += 1
+
+    def run(self, seconds, step=0.1):
+        """Let C{seconds} of simulated time pass."""
+        self.clock.pump([step] * int(round(seconds / step)))
+
+    def run_until(self, predicate, timeout=600, step=0.1):
+        """Let time pass until C{predicate()} is true.
+
+        @return: The number of seconds it took, or C{None} if it did
+            not happen within C{timeout} seconds.
+        """
+        start = self.clock.seconds()
+        while not predicate():
+            if self.clock.seconds() - start >= timeout:
+                return None
+            self.clock.advance(step)
+        return self.clock.seconds() - start
+
+    def membership_converged(self):
+        """Return C{True} if every running gossiper sees all other
+        running gossipers, and only them, as alive.
+        """
+        running = self.running
+        names = set(g.name for g in running)
+        for gossiper in running:
+            live = set(state.name for state in gossiper.live_peers)
+            live.add(gossiper.name)
+            if live != names:
+                return False
+        return True
+
+    def value_converged(self, origin, key, value):
+        """Return C{True} if every running gossiper has seen C{origin}
+        set C{key} to C{value}.
+        """
+        for gossiper in self.running:
+            state = gossiper._states.get(origin.name)
+            if state is None or state.get(key) != value:
+                return False
+        return True
+
+    def measure(self, timeout=600, step=0.1):
+        """Measure the time to form the cluster and to spread a value
+        from one node to all, along with what it cost.
+
+        @return: A C{dict} of results.  Times are C{None} if the
+            cluster did not converge within C{timeout} seconds.
+        """
+        network = self.network
+        network.reset_stats()
+        join_time = self.run_until(self.membership_converged, timeout, step)
+        report = {
+            'nodes': len(self.gossipers),
+            'join_time': join_time,
+            'join_messages': network.messages,
+            'join_bytes': network.bytes,
+            }
+        network.reset_stats()
+        origin = self.running[-1]
+        origin.set('simulation:probe', self.clock.seconds())
+        value = origin.get('simulation:probe')
+        report['propagation_time'] = self.run_until(
+            lambda: self.value_converged(origin, 'simulation:probe', value),
+            timeout, step)
+        report['propagation_messages'] = network.messages
+        report['propagation_bytes'] = network.bytes
+        report['dropped'] = network.dropped
+        report['false_positives'] = self.false_positives
+        return report
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--nodes', type='int', default=100)
+    parser.add_option('--seeds', type='int', default=1)
+    parser.add_option('--latency', type='float', default=0.01)
+    parser.add_option('--jitter', type='float', default=0.0)
+    parser.add_option('--loss', type='float', default=0.0)
+    parser.add_option('--reorder', type='float', default=0.0)
+    parser.add_option('--seed', type='int', default=0)
+    parser.add_option('--timeout', type='float', default=600)
+    options, args = parser.parse_args()
+
+    random.seed(options.seed)
+    network = Network(latency=options.latency, jitter=options.jitter,
+                      loss=options.loss, reorder=options.reorder,
+                      seed=options.seed)
+    simulation = Simulation(options.nodes, seeds=options.seeds,
+                            network=network)
+    report = simulation.measure(timeout=options.timeout)
+    for name in sorted(report):
+        print "%-22s %s" % (name + ':', report[name])
+
+
+if __name__ == '__main__':
+    main()
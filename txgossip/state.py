@@ -21,40 +21,403 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import bisect
+import heapq
+import itertools
+import random
+
 from txgossip.detector import FailureDetector
 
 
+class PeerSet(object):
+    """A set of peer states that supports adding, removing, counting
+    and random selection in constant time.
+
+    The set can be indexed like a sequence, so it can be passed to
+    C{random.choice} and C{random.sample}.  The order of the states
+    is arbitrary and changes as states are removed.
+    """
+
+    def __init__(self):
+        self._states = []
+        self._index = {}
+
+    def add(self, state):
+        if state in self._index:
+            return
+        self._index[state] = len(self._states)
+        self._states.append(state)
+
+    def discard(self, state):
+        i = self._index.pop(state, None)
+        if i is None:
+            return
+        last = self._states.pop()
+        if last is not state:
+            self._states[i] = last
+            self._index[last] = i
+
+    def choice(self):
+        return random.choice(self._states)
+
+    def __contains__(self, state):
+        return state in self._index
+
+    def __len__(self):
+        return len(self._states)
+
+    def __iter__(self):
+        return iter(list(self._states))
+
+    def __getitem__(self, i):
+        return self._states[i]
+
+    def __repr__(self):
+        return '<PeerSet %r>' % (self._states,)
+
+
+def _state_name(state):
+    return state.name
+
+
+class Membership(object):
+    """Index of which peers are alive and which are dead.
+
+    States added to the index report their own status changes through
+    L{PeerState.mark_alive} and L{PeerState.mark_dead}, and report
+    arriving heartbeats through L{heartbeat}.
+
+    Rather than evaluating the failure detector of every peer, the
+    index keeps a heap of the times at which each live peer will be
+    suspected if no heartbeat arrives.  L{check_suspected} only looks
+    at peers whose deadline has passed or that got a heartbeat.
+
+    If a L{DetectorRegistry} is given, all peers are instead evaluated
+    at once by the registry.
+
+    Peers marked through L{mark_legacy} as predating the heartbeat
+    channel are counted in C{live_legacy} for as long as they are
+    alive.
+    """
+
+    def __init__(self, registry=None):
+        self.registry = registry
+        self.live = PeerSet()
+        self.dead = PeerSet()
+        self._arrived = set()
+        self._deadlines = []
+        self._scheduled = {}
+        self._counter = itertools.count()
+        self._legacy = set()
+        self.live_legacy = 0
+
+    def add(self, state):
+        state.membership = self
+        if self.registry is not None:
+            self.registry.add(state)
+        self.status_changed(state)
+
+    def remove(self, state):
+        state.membership = None
+        if self.registry is not None:
+            self.registry.remove(state)
+        if state in self._legacy:
+            self._legacy.discard(state)
+            if state in self.live:
+                self.live_legacy -= 1
+        self.live.discard(state)
+        self.dead.discard(state)
+        self._arrived.discard(state)
+        self._scheduled.pop(state, None)
+
+    def mark_legacy(self, state, legacy):
+        """Record whether C{state} predates the heartbeat channel."""
+        if legacy == (state in self._legacy):
+            return
+        if legacy:
+            self._legacy.add(state)
+        else:
+            self._legacy.discard(state)
+        if state in self.live:
+            self.live_legacy += 1 if legacy else -1
+
+    def heartbeat(self, state):
+        """Report that a heartbeat arrived for C{state}."""
+        if self.registry is None:
+            self._arrived.add(state)
+
+    def check_suspected(self, now):
+        """Update the status of all peers that may have changed."""
+        if self.registry is not None:
+            became_alive, became_dead = self.registry.evaluate(now)
+            for state in became_alive:
+                state.mark_alive()
+            for state in became_dead:
+                state.mark_dead()
+            return
+        due, self._arrived = self._arrived, set()
+        deadlines = self._deadlines
+        while deadlines and deadlines[0][0] <= now:
+            deadline, n, state = heapq.heappop(deadlines)
+            if self._scheduled.get(state) == deadline:
+                del self._scheduled[state]
+                due.add(state)
+        # Sets of states are ordered by address; go by name instead,
+        # so that peers change status in a repeatable order.
+        for state in sorted(due, key=_state_name):
+            if not state.check_suspected():
+                self._schedule(state)
+
+    def _schedule(self, state):
+        deadline = state.detector.deadline(state.PHI)
+        if deadline is None:
+            return
+        self._scheduled[state] = deadline
+        heapq.heappush(self._deadlines,
+                       (deadline, next(self._counter), state))
+
+    def status_changed(self, state):
+        if self.registry is not None:
+            self.registry.status_changed(state)
+        was_live = state in self.live
+        if state.alive:
+            self.dead.discard(state)
+            self.live.add(state)
+        else:
+            self.live.discard(state)
+            self.dead.add(state)
+        if state in self._legacy and was_live != state.alive:
+            self.live_legacy += 1 if state.alive else -1
+
+
+_SCALAR_TYPES = frozenset([str, unicode, int, long, float, bool,
+                           type(None)])
+
+
+def _typed_key(value):
+    """Return a hashable key for C{value} that is only equal to the
+    key of another value if the two are equal and of the same types
+    at every level.
+
+    @raise TypeError: If C{value} holds something else than tuples
+        and scalars, or holds a NaN, which is not equal to anything.
+    """
+    t = type(value)
+    if t in _SCALAR_TYPES:
+        if t is float and not value:
+            # 0.0 and -0.0 are equal, but are not the same value.
+            return (t, repr(value))
+        if value != value:
+            raise TypeError("cannot share NaN")
+        return (t, value)
+    if t is tuple:
+        return (t, tuple([_typed_key(v) for v in value]))
+    raise TypeError("cannot share values of type %s" % (t.__name__,))
+
+
+class ValueStore(object):
+    """Values shared by the peer states of a gossiper.
+
+    The key store, for one, sets every value on every node, so equal
+    values show up in the states of all peers.  A string or tuple that
+    is put through L{intern} is kept once, and handed out to every
+    state that sets an equal value, until all of them have let go of
+    it through L{release}.  Lists and dicts can be modified, so they
+    are not shared; every state gets a copy of its own, which shares
+    what it holds.
+
+    Numbers, booleans and C{None} are not worth keeping track of and
+    are passed through as they are, as are tuples that hold a list, a
+    dict or a NaN.
+    """
+
+    def __init__(self):
+        self._values = {}
+
+    def _key(self, value):
+        t = type(value)
+        if t is unicode:
+            return value
+        if t is str:
+            return (t, value)
+        if t is tuple:
+            try:
+                return _typed_key(value)
+            except TypeError:
+                pass
+        return None
+
+    def intern(self, value):
+        """Return a value equal to C{value} that shares what it can
+        with the values interned before.
+        """
+        t = type(value)
+        if t is list:
+            return [self.intern(v) for v in value]
+        if t is dict:
+            return dict([(self.intern(k), self.intern(v))
+                         for (k, v) in value.iteritems()])
+        key = self._key(value)
+        if key is None:
+            return value
+        entry = self._values.get(key)
+        if entry is None:
+            self._values[key] = [value, 1]
+            return value
+        entry[1] += 1
+        return entry[0]
+
+    def release(self, value):
+        """Let go of a value returned by L{intern}."""
+        t = type(value)
+        if t is list:
+            for v in value:
+                self.release(v)
+            return
+        if t is dict:
+            for k, v in value.iteritems():
+                self.release(k)
+                self.release(v)
+            return
+        key = self._key(value)
+        if key is None:
+            return
+        entry = self._values.get(key)
+        if entry is not None:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._values[key]
+
+    def __len__(self):
+        return len(self._values)
+
+
 class PeerState(object):
 
-    def __init__(self, clock, participant, name=None, PHI=8):
+    __slots__ = ('clock', 'participant', 'max_version_seen', 'attrs',
+                 'detector', 'alive', 'heart_beat_version', 'name', 'PHI',
+                 'listener', 'membership', 'values', 'dead_since',
+                 '_log_versions', '_log_keys', '_log_stale')
+
+    def __init__(self, clock, participant, name=None, PHI=8,
+                 listener=None, detector_factory=FailureDetector,
+                 values=None):
+        """Create state for a peer.
+
+        @param listener: Optional object whose C{version_changed}
+            method is called with this state and the previous version
+            whenever C{max_version_seen} changes.
+        @param detector_factory: Callable that returns the failure
+            detector of this peer.
+        @param values: Optional L{ValueStore} shared with the states
+            of other peers, through which the values are kept.
+        """
         self.clock = clock
         self.participant = participant
         self.max_version_seen = 0
         self.attrs = {}
-        self.detector = FailureDetector()
+        self.detector = detector_factory()
         self.alive = False
         self.heart_beat_version = 0
         self.name = name
         self.PHI = PHI
+        self.listener = listener
+        self.membership = None
+        self.values = values
+        # New peers count as dead until we hear from them.
+        self.dead_since = clock.seconds()
+        # Version-ordered log of (version, key) pairs.  An entry is
+        # stale once its key has been set again with a later version.
+        self._log_versions = []
+        self._log_keys = []
+        self._log_stale = 0
 
     def set_name(self, name):
         self.name = name
 
     def update_with_delta(self, k, v, n):
-        """."""
+        """Apply a delta received through gossip.
+
+        @return: C{True} if the delta was applied, C{False} if it was
+            stale.
+        """
         # It's possibly to get the same updates more than once if
         # we're gossiping with multiple peers at once ignore them
         if n > self.max_version_seen:
-            self.max_version_seen = n
+            self._set_max_version(n)
             self.set_key(k,v,n)
             if k == '__heartbeat__':
-                self.detector.add(self.clock.seconds())
+                # Published by peers that predate the heartbeat
+                # channel, or that think we do.  The value is the
+                # same generation as on the channel.
+                self.update_heartbeat(v)
+            return True
+        return False
+
+    def update_heartbeat(self, generation):
+        """Apply a heartbeat generation received through gossip."""
+        if generation > self.heart_beat_version:
+            self.heart_beat_version = generation
+            self._heartbeat_arrived()
+
+    def _heartbeat_arrived(self):
+        self.detector.add(self.clock.seconds())
+        if self.membership is not None:
+            self.membership.heartbeat(self)
 
     def update_local(self, k, v):
         # This is used when the peerState is owned by this peer
-        self.max_version_seen += 1
+        self._set_max_version(self.max_version_seen + 1)
         self.set_key(k, v, self.max_version_seen)
 
+    def set_many(self, items):
+        """Set a number of keys of our own state under consecutive
+        versions.
+
+        The version changes once, after all keys are set, and only
+        then is the participant told about each of them.
+
+        @param items: A mapping or a sequence of C{(key, value)}
+            tuples.
+        """
+        if hasattr(items, 'items'):
+            items = items.items()
+        n = self.max_version_seen
+        changed = []
+        for k, v in items:
+            n += 1
+            changed.append((self._store(k, v, n), v))
+        if not changed:
+            return
+        self._set_max_version(n)
+        for k, v in changed:
+            self.participant.value_changed(self, str(k), v)
+
+    def load(self, items):
+        """Install a sequence of C{(key, value)} tuples in one step.
+
+        The keys get consecutive versions above the current one, and
+        the version is changed once for all of them.  Participants are
+        not told about the values; this is meant for restoring state
+        that is already persisted.
+        """
+        versions = self._log_versions
+        keys = self._log_keys
+        n = self.max_version_seen
+        for k, v in items:
+            n += 1
+            k = self._assign(k, v, n)
+            versions.append(n)
+            keys.append(k)
+        if n != self.max_version_seen:
+            self._set_max_version(n)
+        self._maybe_compact_log()
+
+    def _set_max_version(self, n):
+        old, self.max_version_seen = self.max_version_seen, n
+        if self.listener is not None:
+            self.listener.version_changed(self, old)
+
     def __iter__(self):
         return iter(self.attrs)
 
@@ -89,27 +452,95 @@ class PeerState(object):
             yield k, v
 
     def set_key(self, k, v, n):
-        self.attrs[k] = (v, n)
+        k = self._store(k, v, n)
         self.participant.value_changed(self, str(k), v)
 
-    def beat_that_heart(self):
+    def _store(self, k, v, n):
+        k = self._assign(k, v, n)
+        self._log_append(k, n)
+        return k
+
+    def _assign(self, k, v, n):
+        # Share key strings between all peers that have the key.
+        if type(k) is str:
+            k = intern(k)
+        values = self.values
+        if k in self.attrs:
+            self._log_stale += 1
+            if values is not None:
+                values.release(self.attrs[k][0])
+        if values is not None:
+            v = values.intern(v)
+        self.attrs[k] = (v, n)
+        return k
+
+    def _log_append(self, k, n):
+        versions = self._log_versions
+        if not versions or n > versions[-1]:
+            versions.append(n)
+            self._log_keys.append(k)
+        else:
+            i = bisect.bisect_right(versions, n)
+            versions.insert(i, n)
+            self._log_keys.insert(i, k)
+        self._maybe_compact_log()
+
+    def _maybe_compact_log(self):
+        if (self._log_stale > 32
+                and self._log_stale * 2 > len(self._log_versions)):
+            self._compact_log()
+
+    def _compact_log(self):
+        attrs = self.attrs
+        live = [(n, k) for (n, k) in zip(self._log_versions, self._log_keys)
+                if attrs[k][1] == n]
+        self._log_versions = [n for (n, k) in live]
+        self._log_keys = [k for (n, k) in live]
+        self._log_stale = 0
+
+    def clear(self):
+        """Forget all keys, letting go of their values."""
+        if self.values is not None:
+            for v, n in self.attrs.itervalues():
+                self.values.release(v)
+        self.attrs = {}
+        self._log_versions = []
+        self._log_keys = []
+        self._log_stale = 0
+
+    def beat_that_heart(self, publish=False):
+        """Advance our heartbeat generation.
+
+        The generation is carried next to the digest rather than as a
+        key, so that it does not show up as a change of our state.
+
+        @param publish: If true, also publish the generation as the
+            C{'__heartbeat__'} key, for peers that predate the
+            heartbeat channel.
+        """
         self.heart_beat_version += 1
-        self.update_local('__heartbeat__', self.heart_beat_version);
+        if publish:
+            self.update_local('__heartbeat__', self.heart_beat_version)
 
     def deltas_after_version(self, lowest_version):
         """
         Return sorted by version.
         """
+        versions = self._log_versions
+        keys = self._log_keys
+        attrs = self.attrs
         deltas = []
-        for key, (value, version) in self.attrs.items():
-            if version > lowest_version:
+        for i in xrange(bisect.bisect_right(versions, lowest_version),
+                        len(versions)):
+            key = keys[i]
+            value, version = attrs[key]
+            if version == versions[i]:
                 deltas.append((key, value, version))
-        deltas.sort(key=lambda kvv: kvv[2])
         return deltas
 
     def check_suspected(self):
         phi = self.detector.phi(self.clock.seconds())
-        if phi > self.PHI or phi == 0:
+        if phi > self.PHI or self.detector.last_time is None:
             self.mark_dead()
             return True
         else:
@@ -118,10 +549,16 @@ class PeerState(object):
 
     def mark_alive(self):
         alive, self.alive = self.alive, True
+        self.dead_since = None
         if not alive:
+            if self.membership is not None:
+                self.membership.status_changed(self)
             self.participant.peer_alive(self)
 
     def mark_dead(self):
         if self.alive:
             self.alive = False
+            self.dead_since = self.clock.seconds()
+            if self.membership is not None:
+                self.membership.status_changed(self)
             self.participant.peer_dead(self)
@@ -0,0 +1,169 @@
+# Copyright (C) 2011 Johan Rydberg
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Storage for the key-value store that is kept in memory and
+persisted as a snapshot plus an append-only log of later changes.
+"""
+
+import errno
+import json
+import mmap
+import os
+
+
+def _encode(record):
+    return json.dumps(record, separators=(',', ':')) + '\n'
+
+
+class LogStorage(object):
+    """Dict-like storage backed by a snapshot and an append-only log.
+
+    Every change is appended to C{PATH.log} as a line of JSON, and
+    L{sync} makes sure the log is on disk.  When the log has grown to
+    more than C{compact_ratio} records per stored key, and holds at
+    least C{min_compact} records, L{sync} writes all values to
+    C{PATH.snapshot} and starts over with an empty log.
+
+    Opening the storage maps the snapshot and the log into memory and
+    replays them.  A record that was only partly written when the
+    process went down is dropped.
+    """
+
+    def __init__(self, path, compact_ratio=2, min_compact=1024):
+        """Open the storage at C{path}, creating it if needed.
+
+        @param path: Path name prefix of the snapshot and log files.
+        @param compact_ratio: Number of log records per stored key
+            that triggers a compaction.
+        @param min_compact: Number of log records below which the log
+            is never compacted.
+        """
+        self.path = path
+        self.compact_ratio = compact_ratio
+        self.min_compact = min_compact
+        self._snapshot_path = path + '.snapshot'
+        self._log_path = path + '.log'
+        self._data = {}
+        self._replay(self._snapshot_path)
+        self._log_records, end = self._replay(self._log_path)
+        self._log = open(self._log_path, 'ab')
+        if os.fstat(self._log.fileno()).st_size > end:
+            # Drop the torn tail so that new records start on a line
+            # of their own.
+            self._log.truncate(end)
+
+    def _replay(self, path):
+        """Apply the records in C{path}.
+
+        @return: The number of records applied and the offset just
+            past the last of them.
+        """
+        try:
+            f = open(path, 'rb')
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                return 0, 0
+            raise
+        records = end = 0
+        with f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return 0, 0
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                data = self._data
+                while True:
+                    line = m.readline()
+                    if not line.endswith('\n'):
+                        break
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break
+                    if len(record) == 2:
+                        data[record[0]] = record[1]
+                    else:
+                        data.pop(record[0], None)
+                    records += 1
+                    end = m.tell()
+            finally:
+                m.close()
+        return records, end
+
+    def __setitem__(self, key, value):
+        self._log.write(_encode([key, value]))
+        self._log_records += 1
+        self._data[key] = value
+
+    def __delitem__(self, key):
+        del self._data[key]
+        self._log.write(_encode([key]))
+        self._log_records += 1
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def get(self, key, default=None):
+        return self._data.get(key, default)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def keys(self):
+        return self._data.keys()
+
+    def items(self):
+        return self._data.items()
+
+    def sync(self):
+        """Write all changes to disk, compacting the log if it has
+        grown too large.
+        """
+        self._log.flush()
+        os.fsync(self._log.fileno())
+        if (self._log_records >= self.min_compact
+                and self._log_records > self.compact_ratio * len(self._data)):
+            self.compact()
+
+    def compact(self):
+        """Write a snapshot of all values and truncate the log."""
+        tmp_path = self._snapshot_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            for key, value in self._data.iteritems():
+                f.write(_encode([key, value]))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self._snapshot_path)
+        # Replaying the old log on top of the new snapshot does no
+        # harm, so it is fine to go down before this point.
+        self._log.close()
+        self._log = open(self._log_path, 'wb')
+        self._log_records = 0
+
+    def close(self):
+        self.sync()
+        self._log.close()
@@ -0,0 +1,135 @@
+# Copyright (C) 2011 Johan Rydberg
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import json
+import zlib
+
+from twisted.trial import unittest
+from twisted.internet import defer, task
+from twisted.test.proto_helpers import MemoryReactorClock, StringTransport
+
+from txgossip.bulk import BulkSync, SnapshotError, decode_snapshot
+from txgossip.test.test_gossip import BatchParticipant, make_gossiper
+
+
+class SnapshotTestCase(unittest.TestCase):
+    """Test cases for moving all state in one go."""
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.seed = make_gossiper(self.clock, 9000, BatchParticipant())
+        self.seed._handle_new_peers(['127.0.0.1:9002'])
+        self.seed._states['127.0.0.1:9002'].update_with_delta('b', 2, 4)
+        self.seed.set_many([('a', 1), ('c', 3)])
+        self.participant = BatchParticipant()
+        self.node = make_gossiper(self.clock, 9001, self.participant)
+
+    def test_snapshot_brings_node_up_to_date(self):
+        self.node.load_snapshot(self.seed.snapshot())
+        self.assertEquals(self.node._scuttle.digest(),
+                          {'127.0.0.1:9000': 2, '127.0.0.1:9001': 0,
+                           '127.0.0.1:9002': 4})
+        self.assertEquals(self.node._states['127.0.0.1:9000'].get('c'), 3)
+        self.assertEquals(sorted(self.participant.batches),
+                          [('127.0.0.1:9000', [('a', 1), ('c', 3)]),
+                           ('127.0.0.1:9002', [('b', 2)])])
+
+    def test_only_live_peers_get_heartbeats(self):
+        self.node.load_snapshot(self.seed.snapshot())
+        self.assertEquals(
+            self.node._states['127.0.0.1:9002'].heart_beat_version, 0)
+        self.assertEquals(
+            self.node._states['127.0.0.1:9000'].heart_beat_version, 1)
+
+    def test_far_behind_node_is_told(self):
+        lags = []
+        self.node.watch_lag(2, lambda address, lag: lags.append(lag))
+        self.node._handle_request({'type': 'request',
+                                   'digest': self.seed._scuttle.digest()},
+                                  ('127.0.0.1', 9000))
+        self.assertEquals(lags, [6])
+
+    def test_truncated_snapshot_is_rejected(self):
+        self.assertRaises(SnapshotError, decode_snapshot, 'x\x9c\x01')
+
+
+class BulkSyncTestCase(unittest.TestCase):
+    """Test cases for fetching snapshots over TCP."""
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.seed = make_gossiper(self.clock, 9000, BatchParticipant())
+        self.seed.set('a', 1)
+        self.node = make_gossiper(self.clock, 9001, BatchParticipant())
+        self.port = BulkSync(self.seed).listen(0, interface='127.0.0.1')
+        self.addCleanup(self.port.stopListening)
+        self.address = ('127.0.0.1', self.port.getHost().port)
+
+    def test_sync_from_seed(self):
+        d = BulkSync(self.node).sync_from(self.address)
+        def check(result):
+            self.assertEquals(
+                self.node._states['127.0.0.1:9000'].get('a'), 1)
+        return d.addCallback(check)
+
+    def test_lag_triggers_one_sync_per_interval(self):
+        bulk = BulkSync(self.node, threshold=1)
+        synced = []
+        def sync_from(address):
+            synced.append(address)
+            return defer.succeed(None)
+        bulk.sync_from = sync_from
+        bulk._lagging(self.address, 5)
+        bulk._synced(None)
+        bulk._lagging(self.address, 5)
+        self.assertEquals(synced, [self.address])
+
+    def start_transfer(self, **kw):
+        reactor = MemoryReactorClock()
+        bulk = BulkSync(self.node, reactor=reactor, **kw)
+        d = bulk.sync_from(self.address)
+        host, port, factory, timeout, bind = reactor.tcpClients[0]
+        receiver = factory.buildProtocol(None)
+        transport = StringTransport()
+        receiver.makeConnection(transport)
+        return reactor, bulk, d, receiver, transport
+
+    def test_stalled_transfer_times_out(self):
+        reactor, bulk, d, receiver, transport = self.start_transfer(
+            timeout=10)
+        receiver.dataReceived('x')
+        reactor.advance(10)
+        self.failureResultOf(d, SnapshotError)
+        self.assertFalse(bulk._syncing)
+
+    def test_oversized_snapshot_is_dropped(self):
+        reactor, bulk, d, receiver, transport = self.start_transfer(
+            max_size=4)
+        receiver.dataReceived('x' * 5)
+        self.failureResultOf(d, SnapshotError)
+        self.assertTrue(transport.disconnecting)
+        self.assertFalse(bulk._syncing)
+        self.assertEquals(reactor.getDelayedCalls(), [])
+
+    def test_oversized_snapshot_is_rejected_once_decompressed(self):
+        data = zlib.compress(json.dumps({'peers': {}, 'pad': 'x' * 1000}))
+        self.assertRaises(SnapshotError, decode_snapshot, data, 100)
@@ -0,0 +1,132 @@
+# Copyright (C) 2011 Johan Rydberg
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from twisted.trial import unittest
+
+from txgossip.codec import JSONCodec, BinaryCodec, CodecError
+
+
+class BinaryCodecTestCase(unittest.TestCase):
+    """Test cases for the binary wire codec."""
+
+    def setUp(self):
+        self.codec = BinaryCodec()
+
+    def test_request_round_trips(self):
+        message = {'type': 'request',
+                   'digest': {'10.0.0.1:9000': 300, '10.0.0.2:9000': 0}}
+        self.assertEquals(self.codec.decode(self.codec.encode(message)),
+                          message)
+
+    def test_response_round_trips(self):
+        message = {'type': 'first-response',
+                   'digest': {'10.0.0.1:9000': 3},
+                   'updates': [('10.0.0.2:9000', 'k', [1.5, 'v'], 12),
+                               ('10.0.0.2:9000', 'l', None, 13)]}
+        decoded = self.codec.decode(self.codec.encode(message))
+        self.assertEquals(decoded['digest'], message['digest'])
+        self.assertEquals(decoded['updates'], message['updates'])
+
+    def test_name_round_trips(self):
+        message = {'type': 'request', 'hash': 7, 'name': '10.0.0.1:9000'}
+        self.assertEquals(self.codec.decode(self.codec.encode(message)),
+                          message)
+
+    def test_names_are_only_written_once(self):
+        message = {'type': 'second-response',
+                   'updates': [('10.0.0.2:9000', 'k', 1, n)
+                               for n in range(10)]}
+        self.assertEquals(
+            self.codec.encode(message).count('10.0.0.2:9000'), 1)
+
+    def test_smaller_than_json(self):
+        message = {'type': 'first-response',
+                   'digest': dict(('10.0.0.%d:9000' % i, 1000 + i)
+                                  for i in range(50)),
+                   'updates': [('10.0.0.2:9000', 'k%d' % i, i, 1000 + i)
+                               for i in range(20)]}
+        self.assertTrue(len(self.codec.encode(message))
+                        < len(JSONCodec().encode(message)))
+
+    def test_heartbeats_of_digest_peers_round_trip(self):
+        digest = dict(('10.0.0.%d:9000' % i, i) for i in range(50))
+        heartbeats = dict((name, 1000 - n) for (name, n) in digest.items())
+        message = {'type': 'request', 'digest': digest,
+                   'heartbeats': heartbeats}
+        self.assertEquals(self.codec.decode(self.codec.encode(message)),
+                          message)
+
+    def test_large_integers_round_trip(self):
+        message = {'type': 'request', 'hash': 2 ** 64 - 1,
+                   'digest': {'a': 2 ** 40, 'b': 1}}
+        self.assertEquals(self.codec.decode(self.codec.encode(message)),
+                          message)
+
+    def test_negative_integers_raise_codec_error(self):
+        self.assertRaises(CodecError, self.codec.encode,
+                          {'type': 'request', 'digest': {'a': -1}})
+
+    def test_names_with_nul_are_sent_as_json(self):
+        message = {'type': 'request', 'digest': {'a\x00b': 1, 'c': 2}}
+        data = self.codec.encode(message)
+        self.assertEquals(data[0], chr(BinaryCodec.EXTENSION))
+        self.assertEquals(self.codec.decode(data), message)
+
+    def test_unknown_fields_are_skipped(self):
+        data = bytearray(self.codec.encode({'type': 'request',
+                                            'digest': {'a': 1}}))
+        data.extend([0x7f, 0x02, 0x00, 0x00, 0x00, 0x01, 0x01])
+        self.assertEquals(self.codec.decode(bytes(data)),
+                          {'type': 'request', 'digest': {'a': 1}})
+
+    def test_unknown_message_types_are_sent_as_json(self):
+        message = {'type': 'something-else', 'x': [1, 2]}
+        self.assertEquals(self.codec.decode(self.codec.encode(message)),
+                          message)
+
+    def test_truncated_payload_raises_codec_error(self):
+        data = self.codec.encode({'type': 'request', 'digest': {'a': 1}})
+        self.assertRaises(CodecError, self.codec.decode, data[:-1])
+
+    def test_bad_utf8_in_string_table_raises_codec_error(self):
+        data = bytearray(self.codec.encode({'type': 'request',
+                                            'digest': {'a': 1}}))
+        data[9] = 0xff
+        self.assertRaises(CodecError, self.codec.decode, bytes(data))
+
+    def test_utf8_byte_string_names_round_trip(self):
+        message = {'type': 'request', 'digest': {'caf\xc3\xa9': 1}}
+        self.assertEquals(self.codec.decode(self.codec.encode(message)),
+                          {'type': 'request', 'digest': {u'caf\xe9': 1}})
+
+    def test_invalid_byte_string_names_raise_codec_error(self):
+        self.assertRaises(CodecError, self.codec.encode,
+                          {'type': 'request', 'digest': {'\xff': 1}})
+
+    def test_payloads_are_told_apart_from_json(self):
+        json_codec = JSONCodec()
+        data = self.codec.encode({'type': 'request', 'digest': {}})
+        self.assertTrue(self.codec.accepts(data))
+        self.assertFalse(json_codec.accepts(data))
+        data = json_codec.encode({'type': 'request', 'digest': {}})
+        self.assertTrue(json_codec.accepts(data))
+        self.assertFalse(self.codec.accepts(data))
@@ -0,0 +1,176 @@
+# Copyright (C) 2011 Johan Rydberg
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import math
+
+from mockito import mock
+
+from twisted.trial import unittest
+from twisted.internet import task
+
+from txgossip import detector
+from txgossip.detector import DetectorRegistry, FailureDetector
+from txgossip.state import Membership, PeerState
+
+
+class FailureDetectorTestCase(unittest.TestCase):
+    """Test cases for the phi accrual failure detector."""
+
+    def feed(self, detector, intervals, start=0.0):
+        t = start
+        detector.add(t)
+        for i in intervals:
+            t += i
+            detector.add(t)
+        return t
+
+    def test_phi_is_zero_without_heartbeats(self):
+        self.assertEquals(FailureDetector().phi(10), 0)
+
+    def test_window_is_bounded(self):
+        detector = FailureDetector(window_size=10)
+        self.feed(detector, [1.0] * 5 + [2.0] * 20)
+        self.assertEquals(len(detector.intervals), 10)
+        self.assertAlmostEquals(detector.interval_mean(), 2.0)
+        self.assertAlmostEquals(detector.std_deviation(), 0.5)
+
+    def test_running_statistics_match_window(self):
+        detector = FailureDetector(window_size=7)
+        self.feed(detector, [0.5 + (i % 5) * 0.3 for i in range(40)])
+        intervals = list(detector.intervals)
+        mean = sum(intervals) / len(intervals)
+        self.assertAlmostEquals(detector.interval_mean(), mean)
+        std = math.sqrt(sum([(x - mean) ** 2 for x in intervals])
+                        / len(intervals))
+        detector.min_std_deviation = 0
+        self.assertAlmostEquals(detector.std_deviation(), std)
+
+    def test_exponential_phi(self):
+        detector = FailureDetector()
+        t = self.feed(detector, [1.0] * 999)
+        self.assertAlmostEquals(detector.phi(t + 2),
+                                2 / math.log(10), places=3)
+
+    def test_normal_phi_grows_with_silence(self):
+        detector = FailureDetector(distribution='normal')
+        t = self.feed(detector, [1.0] * 100)
+        values = [detector.phi(t + d) for d in (0.5, 1, 2, 4, 8)]
+        self.assertEquals(values, sorted(values))
+        self.assertTrue(values[0] < 1)
+        self.assertTrue(values[-1] > 8)
+
+    def test_acceptable_pause_delays_suspicion(self):
+        detector = FailureDetector(distribution='normal',
+                                   acceptable_pause=3)
+        t = self.feed(detector, [1.0] * 100)
+        self.assertTrue(detector.phi(t + 4) < 1)
+
+    def test_deadline_is_where_phi_passes_threshold(self):
+        for distribution in FailureDetector.DISTRIBUTIONS:
+            detector = FailureDetector(distribution=distribution,
+                                       acceptable_pause=1)
+            self.feed(detector, [1.0, 1.2, 0.9, 1.1] * 10)
+            deadline = detector.deadline(8)
+            self.assertAlmostEquals(detector.phi(deadline), 8, places=3)
+
+
+class RegistryTestsMixin:
+    """Tests for the batch evaluation of failure detectors."""
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.registry = DetectorRegistry(use_numpy=self.use_numpy)
+        self.membership = Membership(self.registry)
+        self.states = []
+        for i in range(40):
+            factory = FailureDetector
+            if i % 2:
+                factory = lambda: FailureDetector(distribution='normal')
+            state = PeerState(self.clock, mock(), name='p%d' % i,
+                              detector_factory=factory)
+            self.membership.add(state)
+            self.states.append(state)
+
+    def beat(self, states):
+        for state in states:
+            state.update_with_delta('__heartbeat__',
+                                    state.heart_beat_version + 1,
+                                    state.max_version_seen + 1)
+
+    def tick(self):
+        self.clock.advance(1)
+        self.membership.check_suspected(self.clock.seconds())
+
+    def test_peers_without_heartbeats_stay_dead(self):
+        self.tick()
+        self.assertEquals(len(self.membership.live), 0)
+
+    def test_beating_peers_are_alive(self):
+        for i in range(5):
+            self.beat(self.states[:10])
+            self.tick()
+        self.assertEquals(set(self.membership.live),
+                          set(self.states[:10]))
+
+    def test_silent_peers_die(self):
+        for i in range(20):
+            self.beat(self.states)
+            self.tick()
+        self.assertEquals(len(self.membership.live), 40)
+        for i in range(60):
+            self.beat(self.states[:20])
+            self.tick()
+        self.assertEquals(set(self.membership.live),
+                          set(self.states[:20]))
+
+    def test_agrees_with_detectors(self):
+        for i in range(10):
+            self.beat(self.states[i:])
+            self.tick()
+        self.clock.advance(3)
+        now = self.clock.seconds()
+        became_alive, became_dead = self.registry.evaluate(now)
+        for state in self.states:
+            alive = state.detector.phi(now) <= state.PHI
+            self.assertEquals(alive, (state.alive or state in became_alive)
+                              and state not in became_dead)
+
+    def test_removed_peers_are_not_evaluated(self):
+        self.membership.remove(self.states[0])
+        for i in range(5):
+            self.beat(self.states)
+            self.tick()
+        self.assertNotIn(self.states[0], self.membership.live)
+        self.assertEquals(len(self.membership.live), 39)
+
+
+class PythonRegistryTestCase(RegistryTestsMixin, unittest.TestCase):
+
+    use_numpy = False
+
+
+class NumpyRegistryTestCase(RegistryTestsMixin, unittest.TestCase):
+
+    use_numpy = True
+
+    if detector.numpy is None:
+        skip = "NumPy is not installed"
@@ -0,0 +1,160 @@
+# Copyright (C) 2011 Johan Rydberg
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from mockito import mock, verify
+
+from twisted.trial import unittest
+
+from txgossip.dispatch import Dispatcher
+
+
+class ValueParticipant(object):
+
+    def __init__(self):
+        self.calls = []
+
+    def value_changed(self, peer, key, value):
+        self.calls.append((peer, key, value))
+
+
+class BatchParticipant(object):
+
+    notify_heartbeats = False
+
+    def __init__(self):
+        self.calls = []
+
+    def values_changed(self, peer, changes):
+        self.calls.append((peer, changes))
+
+
+class DispatcherTestCase(unittest.TestCase):
+    """Test cases for delivering changes to participants."""
+
+    def test_per_key_participant_gets_every_change(self):
+        participant = ValueParticipant()
+        dispatcher = Dispatcher(participant)
+        dispatcher.begin()
+        dispatcher.value_changed('a', 'k', 1)
+        dispatcher.value_changed('a', '__heartbeat__', 2)
+        self.assertEquals(participant.calls,
+                          [('a', 'k', 1), ('a', '__heartbeat__', 2)])
+        dispatcher.commit()
+
+    def test_batch_participant_gets_one_call_per_peer(self):
+        participant = BatchParticipant()
+        dispatcher = Dispatcher(participant)
+        dispatcher.begin()
+        dispatcher.value_changed('a', 'k', 1)
+        dispatcher.value_changed('b', 'k', 2)
+        dispatcher.value_changed('a', 'l', 3)
+        self.assertEquals(participant.calls, [])
+        dispatcher.commit()
+        self.assertEquals(participant.calls,
+                          [('a', [('k', 1), ('l', 3)]), ('b', [('k', 2)])])
+
+    def test_heartbeats_are_left_out_unless_asked_for(self):
+        participant = BatchParticipant()
+        dispatcher = Dispatcher(participant)
+        dispatcher.value_changed('a', '__heartbeat__', 1)
+        self.assertEquals(participant.calls, [])
+        participant.notify_heartbeats = True
+        dispatcher = Dispatcher(participant)
+        dispatcher.value_changed('a', '__heartbeat__', 1)
+        self.assertEquals(participant.calls, [('a', [('__heartbeat__', 1)])])
+
+    def test_changes_made_while_handling_a_batch_are_batched(self):
+        participant = BatchParticipant()
+        dispatcher = Dispatcher(participant)
+        def values_changed(peer, changes):
+            participant.calls.append((peer, changes))
+            if peer == 'a':
+                dispatcher.value_changed('self', 'x', 1)
+                dispatcher.value_changed('self', 'y', 2)
+        participant.values_changed = values_changed
+        dispatcher.begin()
+        dispatcher.value_changed('a', 'k', 1)
+        dispatcher.commit()
+        self.assertEquals(participant.calls,
+                          [('a', [('k', 1)]),
+                           ('self', [('x', 1), ('y', 2)])])
+
+    def test_membership_changes_are_forwarded(self):
+        participant = mock()
+        dispatcher = Dispatcher(participant)
+        dispatcher.peer_alive('a')
+        dispatcher.peer_dead('b')
+        verify(participant).peer_alive('a')
+        verify(participant).peer_dead('b')
+
+
+class SubscriptionTestCase(unittest.TestCase):
+    """Test cases for key and prefix subscriptions."""
+
+    def setUp(self):
+        self.main = ValueParticipant()
+        self.dispatcher = Dispatcher(self.main)
+
+    def test_subscribers_only_get_matching_keys(self):
+        leader = ValueParticipant()
+        service = BatchParticipant()
+        self.dispatcher.subscribe(leader, prefixes=['leader:'])
+        self.dispatcher.subscribe(service, keys=['service'])
+        self.dispatcher.begin()
+        for key in ['leader:vote', 'service', 'services', 'lead', 'x']:
+            self.dispatcher.value_changed('a', key, 1)
+        self.dispatcher.commit()
+        self.assertEquals(len(self.main.calls), 5)
+        self.assertEquals(leader.calls, [('a', 'leader:vote', 1)])
+        self.assertEquals(service.calls, [('a', [('service', 1)])])
+
+    def test_overlapping_subscriptions_deliver_once(self):
+        participant = ValueParticipant()
+        self.dispatcher.subscribe(participant, keys=['a:b'],
+                                  prefixes=['', 'a', 'a:'])
+        self.dispatcher.value_changed('p', 'a:b', 1)
+        self.assertEquals(participant.calls, [('p', 'a:b', 1)])
+
+    def test_unsubscribed_participant_gets_nothing(self):
+        participant = ValueParticipant()
+        self.dispatcher.subscribe(participant, prefixes=['a'])
+        self.dispatcher.unsubscribe(participant)
+        self.dispatcher.value_changed('p', 'a', 1)
+        self.assertEquals(participant.calls, [])
+
+    def test_loaded_values_go_to_matching_subscribers(self):
+        participant = ValueParticipant()
+        loaded = []
+        participant.values_loaded = lambda peer, items: loaded.append(
+            (peer, items))
+        self.dispatcher.subscribe(participant, prefixes=['a', 'a:'])
+        self.dispatcher.values_loaded('p', [('a:1', 1), ('b', 2)])
+        self.assertEquals(loaded, [('p', [('a:1', 1)])])
+        self.assertEquals(participant.calls, [])
+        self.assertEquals(self.main.calls, [])
+
+    def test_subscribers_are_told_about_membership(self):
+        participant = mock()
+        self.dispatcher = Dispatcher(None)
+        self.dispatcher.subscribe(participant, prefixes=['x'])
+        self.dispatcher.peer_alive('a')
+        verify(participant).peer_alive('a')
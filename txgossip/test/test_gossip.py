@@ -0,0 +1,607 @@
+# Copyright (C) 2011 Johan Rydberg
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from mockito import mock
+
+from twisted.trial import unittest
+from twisted.internet import task
+from twisted.internet.address import IPv4Address
+
+from txgossip.codec import JSONCodec, BinaryCodec
+from txgossip.gossip import Gossiper
+
+
+class FakeDatagramTransport(object):
+    """Records datagrams written by a protocol."""
+
+    def __init__(self, port):
+        self.port = port
+        self.written = []
+
+    def getHost(self):
+        return IPv4Address('UDP', '127.0.0.1', self.port)
+
+    def write(self, data, address):
+        self.written.append((data, address))
+
+
+def make_gossiper(clock, port=9000, participant=None, **kw):
+    if participant is None:
+        participant = mock()
+    gossiper = Gossiper(clock, participant, '127.0.0.1', **kw)
+    gossiper.transport = FakeDatagramTransport(port)
+    gossiper.startProtocol()
+    return gossiper
+
+
+class CodecNegotiationTestCase(unittest.TestCase):
+    """Test cases for picking a wire codec per peer."""
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.gossiper = make_gossiper(self.clock)
+        self.peer = ('127.0.0.1', 9001)
+        del self.gossiper.transport.written[:]
+
+    def test_unknown_peers_are_spoken_to_in_json(self):
+        self.gossiper._send({'type': 'request', 'digest': {}}, self.peer)
+        data, address = self.gossiper.transport.written[0]
+        message = JSONCodec().decode(data)
+        self.assertEquals(message['codecs'], ['json', 'binary'])
+
+    def test_json_is_preferred_by_default(self):
+        self.gossiper.datagramReceived(JSONCodec().encode({
+                    'type': 'request', 'digest': {},
+                    'codecs': ['binary', 'json']}), self.peer)
+        data, address = self.gossiper.transport.written[0]
+        self.assertTrue(JSONCodec().accepts(data))
+
+    def test_peer_advertising_binary_is_spoken_to_in_binary(self):
+        gossiper = make_gossiper(self.clock,
+                                 codecs=[BinaryCodec(), JSONCodec()])
+        gossiper.datagramReceived(JSONCodec().encode({
+                    'type': 'request', 'digest': {},
+                    'codecs': ['binary', 'json']}), self.peer)
+        data, address = gossiper.transport.written[-1]
+        self.assertTrue(BinaryCodec().accepts(data))
+
+    def test_peer_speaking_binary_is_spoken_to_in_binary(self):
+        self.gossiper.datagramReceived(BinaryCodec().encode({
+                    'type': 'request', 'digest': {}}), self.peer)
+        data, address = self.gossiper.transport.written[0]
+        self.assertTrue(BinaryCodec().accepts(data))
+
+    def test_old_peers_are_spoken_to_in_json(self):
+        self.gossiper.datagramReceived(JSONCodec().encode({
+                    'type': 'request', 'digest': {}}), self.peer)
+        data, address = self.gossiper.transport.written[0]
+        self.assertTrue(JSONCodec().accepts(data))
+
+    def test_json_only_gossiper_never_sends_binary(self):
+        gossiper = make_gossiper(self.clock, codecs=[JSONCodec()])
+        gossiper.datagramReceived(BinaryCodec().encode({
+                    'type': 'request', 'digest': {}}), self.peer)
+        self.assertEquals(gossiper.transport.written, [])
+        gossiper.datagramReceived(JSONCodec().encode({
+                    'type': 'request', 'digest': {},
+                    'codecs': ['binary', 'json']}), self.peer)
+        data, address = gossiper.transport.written[-1]
+        self.assertTrue(JSONCodec().accepts(data))
+
+
+class DigestHashTestCase(unittest.TestCase):
+    """Test cases for the digest hash short-circuit."""
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.gossiper = make_gossiper(self.clock)
+        self.gossiper._setup_state_for_peer('127.0.0.1:9001')
+        self.peer = ('127.0.0.1', 9001)
+        self.codec = JSONCodec()
+        del self.gossiper.transport.written[:]
+
+    def received(self, message):
+        self.gossiper.datagramReceived(self.codec.encode(message),
+                                       self.peer)
+
+    def sent(self):
+        data, address = self.gossiper.transport.written.pop()
+        return self.codec.decode(data)
+
+    def test_full_digest_sent_to_peers_without_feature(self):
+        self.gossiper._gossip_with_peer(
+            self.gossiper._states['127.0.0.1:9001'])
+        self.assertIn('digest', self.sent())
+
+    def test_hash_sent_to_peers_with_feature(self):
+        self.received({'type': 'request', 'digest': {},
+                       'features': ['digest-hash']})
+        self.gossiper._gossip_with_peer(
+            self.gossiper._states['127.0.0.1:9001'])
+        message = self.sent()
+        self.assertNotIn('digest', message)
+        self.assertEquals(message['hash'], self.gossiper._scuttle.digest_hash)
+
+    def test_requests_carry_heartbeats(self):
+        self.gossiper._gossip_with_peer(
+            self.gossiper._states['127.0.0.1:9001'])
+        self.assertEquals(self.sent()['heartbeats'],
+                          {'127.0.0.1:9000': 1, '127.0.0.1:9001': 0})
+
+    def hash_request_size(self):
+        self.gossiper._gossip_with_peer(
+            self.gossiper._states['127.0.0.1:9001'])
+        data, address = self.gossiper.transport.written.pop()
+        return len(data)
+
+    def test_hash_request_size_does_not_grow_with_cluster(self):
+        self.gossiper._scuttle.heartbeat_size = 32
+        self.received({'type': 'request', 'digest': {},
+                       'features': ['digest-hash', 'heartbeats']})
+        sizes = []
+        for ports in [range(9100, 9150), range(9150, 9250)]:
+            heartbeats = {}
+            for port in ports:
+                name = '127.0.0.1:%d' % port
+                self.gossiper._setup_state_for_peer(name)
+                heartbeats[name] = 5
+            self.gossiper._scuttle.update_heartbeats(heartbeats)
+            sizes.append(self.hash_request_size())
+        self.assertEquals(sizes[0], sizes[1])
+
+    def test_heartbeats_do_not_change_digest(self):
+        self.received({'type': 'request', 'digest': {},
+                       'features': ['digest-hash', 'heartbeats']})
+        digest_hash = self.gossiper._scuttle.digest_hash
+        self.clock.pump([1] * 5)
+        self.assertEquals(self.gossiper.state.heart_beat_version, 6)
+        self.assertEquals(self.gossiper._scuttle.digest_hash, digest_hash)
+
+    def test_heartbeats_are_published_as_key_for_old_peers(self):
+        self.gossiper._states['127.0.0.1:9001'].mark_alive()
+        self.received({'type': 'request', 'digest': {}})
+        self.clock.pump([1] * 5)
+        self.assertEquals(self.gossiper.state.get('__heartbeat__'), 6)
+
+    def test_dead_old_peers_are_not_published_for(self):
+        self.received({'type': 'request', 'digest': {}})
+        self.clock.pump([1] * 5)
+        self.assertNotIn('__heartbeat__', self.gossiper.state)
+
+    def test_peers_not_heard_from_are_not_published_for(self):
+        self.gossiper._states['127.0.0.1:9001'].mark_alive()
+        self.clock.pump([1] * 5)
+        self.assertNotIn('__heartbeat__', self.gossiper.state)
+
+    def test_heartbeat_key_stops_once_all_peers_have_channel(self):
+        self.gossiper._states['127.0.0.1:9001'].mark_alive()
+        self.received({'type': 'request', 'digest': {}})
+        self.clock.pump([1])
+        self.assertEquals(self.gossiper.state.get('__heartbeat__'), 2)
+        self.received({'type': 'request', 'digest': {},
+                       'features': ['digest-hash', 'heartbeats']})
+        self.clock.pump([1] * 3)
+        self.assertEquals(self.gossiper.state.get('__heartbeat__'), 2)
+        self.assertEquals(self.gossiper.state.heart_beat_version, 5)
+
+    def test_received_heartbeats_feed_failure_detector(self):
+        peer = self.gossiper._states['127.0.0.1:9001']
+        self.received({'type': 'request',
+                       'hash': self.gossiper._scuttle.digest_hash,
+                       'heartbeats': {'127.0.0.1:9001': 3}})
+        self.assertEquals(peer.heart_beat_version, 3)
+        self.assertNotEquals(peer.detector.last_time, None)
+
+    def test_newer_heartbeats_are_sent_back(self):
+        self.gossiper._states['127.0.0.1:9001'].update_heartbeat(5)
+        self.received({'type': 'request',
+                       'hash': self.gossiper._scuttle.digest_hash,
+                       'heartbeats': {'127.0.0.1:9000': 1,
+                                      '127.0.0.1:9001': 2}})
+        message = self.sent()
+        self.assertEquals(message['type'], 'first-response')
+        self.assertEquals(message['heartbeats'], {'127.0.0.1:9001': 5})
+
+    def test_hash_requests_advertise_features(self):
+        self.received({'type': 'request', 'digest': {},
+                       'features': ['digest-hash', 'heartbeats']})
+        self.gossiper._gossip_with_peer(
+            self.gossiper._states['127.0.0.1:9001'])
+        self.assertEquals(self.sent()['features'],
+                          ['digest-hash', 'heartbeats'])
+
+    def test_responses_advertise_features(self):
+        self.received({'type': 'request', 'digest': {}})
+        message = self.sent()
+        self.assertEquals(message['type'], 'first-response')
+        self.assertEquals(message['features'], ['digest-hash', 'heartbeats'])
+
+    def test_matching_hash_is_not_answered(self):
+        self.received({'type': 'request',
+                       'hash': self.gossiper._scuttle.digest_hash})
+        self.assertEquals(self.gossiper.transport.written, [])
+
+    def test_differing_hash_is_answered_with_digest_request(self):
+        self.received({'type': 'request',
+                       'hash': self.gossiper._scuttle.digest_hash + 1})
+        self.assertEquals(self.sent()['type'], 'digest-request')
+
+    def test_digest_request_is_answered_with_full_digest(self):
+        self.received({'type': 'digest-request'})
+        message = self.sent()
+        self.assertEquals(message['type'], 'request')
+        self.assertEquals(message['digest'], {'127.0.0.1:9000': 0,
+                                              '127.0.0.1:9001': 0})
+
+
+class DatagramSizeTestCase(unittest.TestCase):
+    """Test cases for keeping responses within the MTU."""
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.gossiper = make_gossiper(self.clock, mtu=600)
+        self.peer = ('127.0.0.1', 9001)
+        self.codec = JSONCodec()
+        self.heartbeats = {}
+        for i in range(20):
+            name = '127.0.0.1:%d' % (9100 + i)
+            self.gossiper._setup_state_for_peer(name)
+            self.heartbeats[name] = 0
+        self.gossiper._scuttle.update_heartbeats(
+            dict((name, 5) for name in self.heartbeats))
+        for i in range(40):
+            self.gossiper.set('key:%d' % i, 'value ' * 8)
+        del self.gossiper.transport.written[:]
+
+    def received(self, message):
+        self.gossiper.datagramReceived(self.codec.encode(message),
+                                       self.peer)
+
+    def sent(self):
+        data, address = self.gossiper.transport.written.pop()
+        return data, self.codec.decode(data)
+
+    def test_first_response_fits_mtu(self):
+        self.received({'type': 'request', 'digest': {'127.0.0.1:9000': 0},
+                       'heartbeats': self.heartbeats,
+                       'features': ['digest-hash', 'heartbeats']})
+        data, message = self.sent()
+        self.assertTrue(message['updates'])
+        self.assertTrue(len(data) <= 600)
+
+    def test_second_response_fits_mtu(self):
+        self.received({'type': 'first-response', 'updates': [],
+                       'digest': {'127.0.0.1:9000': 0}})
+        data, message = self.sent()
+        self.assertEquals(message['type'], 'second-response')
+        self.assertTrue(message['updates'])
+        self.assertTrue(len(data) <= 600)
+
+    def test_single_oversized_delta_is_sent(self):
+        gossiper = make_gossiper(self.clock, port=9002, mtu=600)
+        gossiper.set('big', 'x' * 3000)
+        gossiper.set('small', 'x')
+        del gossiper.transport.written[:]
+        gossiper.datagramReceived(
+            self.codec.encode({'type': 'first-response', 'updates': [],
+                               'digest': {'127.0.0.1:9002': 0}}),
+            self.peer)
+        data, address = gossiper.transport.written.pop()
+        message = self.codec.decode(data)
+        self.assertEquals([delta[1] for delta in message['updates']],
+                          ['big'])
+
+    def test_oversized_deltas_are_trimmed(self):
+        self.gossiper._scuttle.sizeof = lambda *args: 1
+        self.received({'type': 'first-response', 'updates': [],
+                       'digest': {'127.0.0.1:9000': 0}})
+        data, message = self.sent()
+        self.assertTrue(message['updates'])
+        self.assertTrue(len(data) <= 600)
+
+
+class FanoutTestCase(unittest.TestCase):
+    """Test cases for configurable gossip rounds."""
+
+    def setUp(self):
+        self.clock = task.Clock()
+
+    def make_gossiper(self, peers=10, **kw):
+        gossiper = make_gossiper(self.clock, **kw)
+        for i in range(peers):
+            name = '127.0.0.1:%d' % (9001 + i)
+            gossiper._setup_state_for_peer(name)
+            gossiper._states[name].detector.add(self.clock.seconds())
+            gossiper._states[name].mark_alive()
+        del gossiper.transport.written[:]
+        return gossiper
+
+    def test_gossip_with_fanout_peers_each_round(self):
+        gossiper = self.make_gossiper(fanout=3)
+        gossiper._gossip()
+        addresses = [a for (d, a) in gossiper.transport.written]
+        self.assertEquals(len(addresses), 3)
+        self.assertEquals(len(set(addresses)), 3)
+
+    def test_adaptive_fanout_grows_with_cluster_size(self):
+        gossiper = self.make_gossiper(peers=30, adaptive=True)
+        gossiper._gossip()
+        self.assertEquals(len(gossiper.transport.written), 4)
+
+    def test_intervals_are_configurable(self):
+        gossiper = self.make_gossiper(gossip_interval=0.5,
+                                      heartbeat_interval=2)
+        generation = gossiper.state.heart_beat_version
+        self.clock.advance(0.5)
+        self.assertEquals(len(gossiper.transport.written), 1)
+        self.assertEquals(gossiper.state.heart_beat_version, generation)
+        self.clock.advance(1.5)
+        self.assertEquals(gossiper.state.heart_beat_version, generation + 1)
+
+    def test_adaptive_interval_backs_off_while_nothing_changes(self):
+        gossiper = self.make_gossiper(adaptive=True, heartbeat_interval=60)
+        gossiper._gossip()
+        gossiper._gossip()
+        self.assertEquals(gossiper._gossip_timer.interval, 2)
+        gossiper._gossip()
+        gossiper._gossip()
+        self.assertEquals(gossiper._gossip_timer.interval, 4)
+        gossiper.set('k', 'v')
+        gossiper._gossip()
+        self.assertEquals(gossiper._gossip_timer.interval, 1)
+
+
+class MembershipTestCase(unittest.TestCase):
+    """Test cases for the live and dead peer index."""
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.gossiper = make_gossiper(self.clock)
+        for i in range(3):
+            self.gossiper._setup_state_for_peer('127.0.0.1:%d' % (9001 + i))
+
+    def state(self, port):
+        return self.gossiper._states['127.0.0.1:%d' % port]
+
+    def test_new_peers_are_dead(self):
+        self.assertEquals(len(self.gossiper.live_peers), 0)
+        self.assertEquals(set(self.gossiper.dead_peers),
+                          set([self.state(9001), self.state(9002),
+                               self.state(9003)]))
+
+    def test_marking_peer_alive_moves_it(self):
+        self.state(9002).mark_alive()
+        self.assertEquals(list(self.gossiper.live_peers),
+                          [self.state(9002)])
+        self.assertNotIn(self.state(9002), self.gossiper.dead_peers)
+        self.assertEquals(len(self.gossiper.dead_peers), 2)
+        self.state(9002).mark_dead()
+        self.assertEquals(len(self.gossiper.live_peers), 0)
+        self.assertEquals(len(self.gossiper.dead_peers), 3)
+
+    def test_local_peer_is_never_listed(self):
+        self.assertNotIn(self.gossiper.state, self.gossiper.live_peers)
+        self.assertNotIn(self.gossiper.state, self.gossiper.dead_peers)
+
+    def test_seeding_with_own_address_does_not_list_local_peer(self):
+        gossiper = Gossiper(self.clock, mock(), '127.0.0.1')
+        gossiper.seed(['127.0.0.1:9005'])
+        gossiper.transport = FakeDatagramTransport(9005)
+        gossiper.startProtocol()
+        self.assertEquals(len(gossiper.dead_peers), 0)
+
+
+class EvictionTestCase(unittest.TestCase):
+    """Test cases for forgetting long-dead peers."""
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.gossiper = make_gossiper(self.clock, dead_peer_ttl=60,
+                                      tombstone_ttl=100)
+        self.gossiper.seed(['127.0.0.1:9001'])
+        self.gossiper._handle_new_peers(['127.0.0.1:9002'])
+        self.peer = ('127.0.0.1', 9003)
+
+    def received(self, message):
+        del self.gossiper.transport.written[:]
+        self.gossiper.datagramReceived(JSONCodec().encode(message), self.peer)
+
+    def sent(self):
+        data, address = self.gossiper.transport.written[-1]
+        return JSONCodec().decode(data)
+
+    def test_long_dead_peer_is_evicted(self):
+        digest_hash = self.gossiper._scuttle.digest_hash
+        self.clock.advance(30)
+        self.gossiper._gossip()
+        self.assertIn('127.0.0.1:9002', self.gossiper._states)
+        self.clock.advance(30)
+        self.gossiper._gossip()
+        self.assertNotIn('127.0.0.1:9002', self.gossiper._states)
+        self.assertNotIn('127.0.0.1:9002', self.gossiper._scuttle.digest())
+        self.assertNotEquals(self.gossiper._scuttle.digest_hash, digest_hash)
+        self.assertEquals(len(self.gossiper.dead_peers), 1)
+
+    def test_seeds_are_kept(self):
+        self.clock.advance(120)
+        self.gossiper._gossip()
+        self.assertIn('127.0.0.1:9001', self.gossiper._states)
+
+    def test_tombstone_stops_resurrection_until_it_expires(self):
+        self.clock.advance(60)
+        self.gossiper._gossip()
+        self.received({'type': 'request',
+                       'digest': {'127.0.0.1:9002': 5}})
+        self.assertNotIn('127.0.0.1:9002', self.gossiper._states)
+        self.assertEquals(self.sent()['digest'], {})
+        self.clock.advance(100)
+        self.gossiper._gossip()
+        self.received({'type': 'request',
+                       'digest': {'127.0.0.1:9002': 5}})
+        self.assertIn('127.0.0.1:9002', self.gossiper._states)
+
+    def test_tombstones_are_gossiped(self):
+        self.clock.advance(60)
+        self.gossiper._gossip()
+        self.clock.advance(10)
+        self.gossiper._send_digest(self.peer)
+        self.assertEquals(self.sent()['tombstones'], {'127.0.0.1:9002': 90})
+
+    def test_expired_tombstones_are_not_gossiped(self):
+        self.clock.advance(60)
+        self.gossiper._gossip()
+        # As if the next round were still a while off.
+        self.gossiper._gossip_timer.stop()
+        self.clock.advance(101)
+        self.gossiper._send_digest(self.peer)
+        self.assertIn('127.0.0.1:9002', self.gossiper._scuttle.tombstones)
+        self.assertNotIn('tombstones', self.sent())
+
+    def test_received_tombstones_without_ttl_are_ignored(self):
+        self.received({'type': 'request', 'digest': {},
+                       'tombstones': {'127.0.0.1:9002': 0,
+                                      '127.0.0.1:9004': -1}})
+        self.assertIn('127.0.0.1:9002', self.gossiper._states)
+        self.assertEquals(self.gossiper._scuttle.tombstones, {})
+
+    def test_received_tombstone_evicts_dead_peer(self):
+        self.received({'type': 'request', 'digest': {},
+                       'tombstones': {'127.0.0.1:9002': 50,
+                                      '127.0.0.1:9004': 50}})
+        self.assertNotIn('127.0.0.1:9002', self.gossiper._states)
+        self.assertIn('127.0.0.1:9004', self.gossiper._scuttle.tombstones)
+
+    def test_contact_from_evicted_peer_lifts_tombstone(self):
+        self.clock.advance(60)
+        self.gossiper._gossip()
+        self.gossiper.datagramReceived(JSONCodec().encode({
+                    'type': 'request', 'digest': {'127.0.0.1:9002': 1},
+                    'name': '127.0.0.1:9002'}), ('10.0.0.2', 9002))
+        self.assertIn('127.0.0.1:9002', self.gossiper._states)
+
+    def test_tombstone_is_not_lifted_by_source_address(self):
+        self.clock.advance(60)
+        self.gossiper._gossip()
+        self.gossiper.datagramReceived(JSONCodec().encode({
+                    'type': 'request', 'digest': {'127.0.0.1:9002': 1},
+                    'name': '127.0.0.1:9005'}), ('127.0.0.1', 9002))
+        self.assertNotIn('127.0.0.1:9002', self.gossiper._states)
+
+    def test_requests_carry_our_name(self):
+        self.gossiper._send_digest(self.peer)
+        self.assertEquals(self.sent()['name'], '127.0.0.1:9000')
+
+
+class BatchParticipant(object):
+
+    def __init__(self):
+        self.batches = []
+
+    def make_connection(self, gossiper):
+        pass
+
+    def values_changed(self, peer, changes):
+        self.batches.append((peer.name, changes))
+
+
+class BatchNotificationTestCase(unittest.TestCase):
+    """Test cases for delivering a message's updates at once."""
+
+    def test_updates_of_a_message_are_delivered_together(self):
+        clock = task.Clock()
+        participant = BatchParticipant()
+        gossiper = Gossiper(clock, participant, '127.0.0.1')
+        gossiper.transport = FakeDatagramTransport(9000)
+        gossiper.startProtocol()
+        gossiper._setup_state_for_peer('127.0.0.1:9001')
+        gossiper.datagramReceived(JSONCodec().encode({
+                    'type': 'second-response',
+                    'updates': [('127.0.0.1:9001', 'a', 1, 1),
+                                ('127.0.0.1:9001', '__heartbeat__', 1, 2),
+                                ('127.0.0.1:9001', 'b', 2, 3)]}),
+                                  ('127.0.0.1', 9001))
+        self.assertEquals(participant.batches,
+                          [('127.0.0.1:9001', [('a', 1), ('b', 2)])])
+
+    def make_gossiper(self):
+        self.participant = BatchParticipant()
+        gossiper = Gossiper(task.Clock(), self.participant, '127.0.0.1')
+        gossiper.transport = FakeDatagramTransport(9000)
+        gossiper.startProtocol()
+        return gossiper
+
+    def test_set_many_is_delivered_together(self):
+        gossiper = self.make_gossiper()
+        gossiper.set_many([('a', 1), ('b', 2), ('c', 3)])
+        self.assertEquals(self.participant.batches,
+                          [('127.0.0.1:9000', [('a', 1), ('b', 2), ('c', 3)])])
+        self.assertEquals([n for (k, v, n) in
+                           gossiper.state.deltas_after_version(0)], [1, 2, 3])
+
+    def test_batch_sets_values_when_block_ends(self):
+        gossiper = self.make_gossiper()
+        with gossiper.batch() as batch:
+            batch.set('a', 1)
+            batch['b'] = 2
+            self.assertNotIn('b', gossiper)
+        self.assertEquals(self.participant.batches,
+                          [('127.0.0.1:9000', [('a', 1), ('b', 2)])])
+
+    def test_failed_batch_sets_nothing(self):
+        gossiper = self.make_gossiper()
+        def fail():
+            with gossiper.batch() as batch:
+                batch.set('a', 1)
+                raise ValueError()
+        self.assertRaises(ValueError, fail)
+        self.assertNotIn('a', gossiper)
+        gossiper.set('b', 2)
+        self.assertEquals(self.participant.batches,
+                          [('127.0.0.1:9000', [('b', 2)])])
+
+    def test_other_sets_are_not_part_of_batch(self):
+        gossiper = self.make_gossiper()
+        def fail():
+            with gossiper.batch() as batch:
+                batch.set('a', 1)
+                gossiper.set('b', 2)
+                raise ValueError()
+        self.assertRaises(ValueError, fail)
+        self.assertNotIn('a', gossiper)
+        self.assertEquals(gossiper.get('b'), 2)
+
+
+class SubscriptionTestCase(unittest.TestCase):
+    """Test cases for attaching several participants to a gossiper."""
+
+    def test_recipes_can_share_a_gossiper(self):
+        clock = task.Clock()
+        gossiper = Gossiper(clock, None, '127.0.0.1')
+        first, second = BatchParticipant(), BatchParticipant()
+        gossiper.subscribe(first, prefixes=['first:'])
+        gossiper.transport = FakeDatagramTransport(9000)
+        gossiper.startProtocol()
+        gossiper.subscribe(second, keys=['second'])
+        gossiper.set('first:a', 1)
+        gossiper.set('second', 2)
+        self.assertEquals(first.batches, [('127.0.0.1:9000', [('first:a', 1)])])
+        self.assertEquals(second.batches, [('127.0.0.1:9000', [('second', 2)])])
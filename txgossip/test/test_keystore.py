@@ -20,12 +20,37 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import threading
+
 from mockito import mock, when, verify
 
 from twisted.trial import unittest
-from twisted.internet import task
+from twisted.internet import defer, task
+
+from txgossip.recipies import KeyIndex, KeyStoreMixin
+
+
+class SyncCountingStorage(dict):
+
+    syncs = 0
+
+    def sync(self):
+        self.syncs += 1
+
 
-from txgossip.recipies import KeyStoreMixin
+class BlockingSyncStorage(dict):
+
+    synced = False
+
+    def __init__(self, *args):
+        dict.__init__(self, *args)
+        self.syncing = threading.Event()
+        self.release = threading.Event()
+
+    def sync(self):
+        self.syncing.set()
+        self.release.wait(10)
+        self.synced = True
 
 
 class KeyStoreTestCase(unittest.TestCase):
@@ -66,6 +91,15 @@ class KeyStoreTestCase(unittest.TestCase):
         when(self.gossiper).keys().thenReturn(['a', 'b'])
         self.assertIn('a', self.keystore)
 
+    def test_index_follows_local_changes(self):
+        when(self.gossiper).keys().thenReturn(['a'])
+        self.assertNotIn('b', self.keystore)
+        peer = mock()
+        peer.name = 'self'
+        self.keystore.values_changed(peer, [('b', (0, 'x'))])
+        self.assertIn('b', self.keystore)
+        self.assertEquals(self.keystore.keys(), ['a', 'b'])
+
     def test_get_results_default_value_if_value_not_present(self):
         when(self.gossiper).keys().thenReturn([])
         self.assertEquals(self.keystore.get('a', '!'), '!')
@@ -74,3 +108,196 @@ class KeyStoreTestCase(unittest.TestCase):
         when(self.gossiper).keys().thenReturn(['a'])
         when(self.gossiper).get('a').thenReturn((0, '!'))
         self.assertEquals(self.keystore.get('a'), '!')
+
+    def test_load_from_installs_values_in_one_step(self):
+        keystore = KeyStoreMixin(self.clock, self.storage, ignore_keys=['i'])
+        keystore.make_connection(self.gossiper)
+        keystore.load_from({'a': [0, 'x'], 'i': [0, 'y']})
+        verify(self.gossiper).load([('a', [0, 'x'])])
+
+    def test_set_many_uses_one_timestamp(self):
+        self.clock.advance(10)
+        self.keystore.set_many([('a', 'x'), ('b', 'y')])
+        verify(self.gossiper).set_many([('a', [10, 'x']), ('b', [10, 'y'])])
+
+    def test_batch_sets_timestamped_values_together(self):
+        self.clock.advance(10)
+        with self.keystore.batch() as batch:
+            batch['a'] = 'x'
+            batch['b'] = 'y'
+        verify(self.gossiper).set_many([('a', [10, 'x']), ('b', [10, 'y'])])
+
+    def test_batch_of_local_values_is_synced_once(self):
+        storage = SyncCountingStorage()
+        keystore = KeyStoreMixin(self.clock, storage)
+        keystore.make_connection(self.gossiper)
+        peer = mock()
+        peer.name = 'self'
+        keystore.values_changed(peer, [('a', (0, 'x')), ('b', (0, 'y')),
+                                       ('__heartbeat__', 3)])
+        self.assertEquals(storage, {'a': (0, 'x'), 'b': (0, 'y')})
+        self.assertEquals(storage.syncs, 1)
+
+    def test_batch_is_passed_on_to_overridden_value_changed(self):
+        seen = []
+
+        class KeyStore(KeyStoreMixin):
+            def value_changed(self, peer, key, timestamp_value):
+                seen.append(key)
+                KeyStoreMixin.value_changed(self, peer, key, timestamp_value)
+
+        storage = SyncCountingStorage()
+        keystore = KeyStore(self.clock, storage)
+        keystore.make_connection(self.gossiper)
+        peer = mock()
+        peer.name = 'self'
+        keystore.values_changed(peer, [('a', (0, 'x')), ('b', (0, 'y'))])
+        self.assertEquals(seen, ['a', 'b'])
+        self.assertEquals(storage, {'a': (0, 'x'), 'b': (0, 'y')})
+        self.assertEquals(storage.syncs, 1)
+
+
+class KeyIndexTestCase(unittest.TestCase):
+    """Test cases for the sorted key index."""
+
+    def setUp(self):
+        self.index = KeyIndex(['service:b', 'host:a', 'service:a', 'sx'])
+
+    def test_membership(self):
+        self.index.add('host:b')
+        self.index.add('host:b')
+        self.assertIn('host:b', self.index)
+        self.assertNotIn('host:c', self.index)
+        self.assertEquals(len(self.index), 5)
+
+    def test_prefix_and_range_scans(self):
+        self.assertEquals(self.index.prefixed('service:'),
+                          ['service:a', 'service:b'])
+        self.assertEquals(self.index.range('service:', 'sx'),
+                          ['service:a', 'service:b'])
+        self.assertEquals(self.index.range(high='s'), ['host:a'])
+
+    def test_glob_match(self):
+        self.assertEquals(self.index.match('service:*'),
+                          ['service:a', 'service:b'])
+        self.assertEquals(self.index.match('s*b'), ['service:b'])
+        self.assertEquals(self.index.match('*:a'), ['host:a', 'service:a'])
+        self.assertEquals(self.index.match('sx'), ['sx'])
+        self.assertEquals(self.index.match('sy'), [])
+
+
+class WriteBehindTestCase(unittest.TestCase):
+    """Test cases for queued writes in the key-value store mixin."""
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.storage = SyncCountingStorage()
+        self.commits = []
+        self.keystore = KeyStoreMixin(self.clock, self.storage,
+                                      flush_interval=5, flush_size=3,
+                                      run_in_thread=self.run_in_thread)
+        self.gossiper = mock()
+        self.gossiper.name = 'self'
+        self.keystore.make_connection(self.gossiper)
+
+    def run_in_thread(self, f, *args):
+        d = defer.Deferred()
+        self.commits.append((d, f, args))
+        return d
+
+    def finish_commit(self):
+        d, f, args = self.commits.pop(0)
+        f(*args)
+        d.callback(None)
+
+    def test_changes_are_committed_after_interval(self):
+        self.keystore.persist_key_value('a', (0, 'x'))
+        self.keystore.persist_key_value('b', (0, 'y'))
+        self.assertEquals(self.commits, [])
+        self.clock.advance(5)
+        self.finish_commit()
+        self.assertEquals(self.storage, {'a': (0, 'x'), 'b': (0, 'y')})
+        self.assertEquals(self.storage.syncs, 1)
+
+    def test_reaching_flush_size_commits_right_away(self):
+        self.keystore.persist_key_values([('a', (0, 'x')), ('b', (0, 'y')),
+                                          ('c', (0, 'z'))])
+        self.assertEquals(len(self.commits), 1)
+        self.finish_commit()
+        self.assertFalse(self.clock.getDelayedCalls())
+
+    def test_flush_waits_for_queued_changes(self):
+        self.keystore.persist_key_value('a', (0, 'x'))
+        flushed = []
+        self.keystore.flush().addCallback(flushed.append)
+        self.assertEquals(flushed, [])
+        self.finish_commit()
+        self.assertEquals(flushed, [None])
+        self.assertEquals(self.storage, {'a': (0, 'x')})
+
+    def test_flush_during_commit_covers_later_changes(self):
+        self.keystore.persist_key_value('a', (0, 'x'))
+        self.keystore.flush()
+        self.keystore.persist_key_value('b', (0, 'y'))
+        flushed = []
+        self.keystore.flush().addCallback(flushed.append)
+        self.finish_commit()
+        self.assertEquals(flushed, [])
+        self.finish_commit()
+        self.assertEquals(flushed, [None])
+        self.assertEquals(self.storage, {'a': (0, 'x'), 'b': (0, 'y')})
+
+    def test_queued_value_is_used_to_reject_older_replicas(self):
+        self.keystore.persist_key_value('k', (1, 'value'))
+        peer = mock()
+        peer.name = 'a'
+        self.keystore.value_changed(peer, 'k', (0, 'value'))
+        verify(self.gossiper, times=0).set('k', (0, 'value'))
+
+    def test_failed_commit_is_retried(self):
+        self.keystore.persist_key_value('a', (0, 'x'))
+        failed = []
+        self.keystore.flush().addErrback(failed.append)
+        d, f, args = self.commits.pop(0)
+        d.errback(IOError("disk full"))
+        self.assertEquals(len(failed), 1)
+        self.assertEquals(len(self.flushLoggedErrors(IOError)), 1)
+        self.clock.advance(5)
+        self.finish_commit()
+        self.assertEquals(self.storage, {'a': (0, 'x')})
+
+    def test_replicated_change_is_handled_while_commit_syncs(self):
+        storage = BlockingSyncStorage({'k': (1, 'value')})
+        commits = []
+
+        def run_in_thread(f, *args):
+            thread = threading.Thread(target=f, args=args)
+            thread.start()
+            commits.append(thread)
+            return defer.Deferred()
+
+        keystore = KeyStoreMixin(self.clock, storage, flush_interval=5,
+                                 run_in_thread=run_in_thread)
+        keystore.make_connection(self.gossiper)
+        keystore.persist_key_value('a', (0, 'x'))
+        keystore.flush()
+        try:
+            self.assertTrue(storage.syncing.wait(10))
+            peer = mock()
+            peer.name = 'a'
+            keystore.value_changed(peer, 'k', (0, 'value'))
+            self.assertFalse(storage.synced)
+        finally:
+            storage.release.set()
+            commits[0].join()
+        verify(self.gossiper, times=0).set('k', (0, 'value'))
+
+    def test_committed_values_are_not_read_back(self):
+        self.keystore.persist_key_value('k', (1, 'value'))
+        self.clock.advance(5)
+        self.finish_commit()
+        del self.storage['k']
+        peer = mock()
+        peer.name = 'a'
+        self.keystore.value_changed(peer, 'k', (0, 'value'))
+        verify(self.gossiper, times=0).set('k', (0, 'value'))
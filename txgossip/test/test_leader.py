@@ -135,4 +135,25 @@ class KeyStoreTestCase(unittest.TestCase):
         self.election._vote()
         verify(self.gossiper).set(self.election.VOTE_KEY, 'peer')
 
-
+    def test_batch_acts_on_each_key_once(self):
+        peer = mock()
+        when(peer).keys().thenReturn([self.election.VOTE_KEY])
+        when(peer).get(self.election.VOTE_KEY).thenReturn('a')
+        self.gossiper.live_peers = [peer]
+        when(self.gossiper).get(self.election.VOTE_KEY).thenReturn('a')
+        self.election.values_changed('peer', [
+                (self.election.VOTE_KEY, 'b'),
+                ('other', 1),
+                (self.election.VOTE_KEY, 'a')])
+        verify(self.gossiper, times=1).set(self.election.LEADER_KEY, 'a')
+
+    def test_batch_is_passed_on_to_overridden_value_changed(self):
+        seen = []
+
+        class Election(LeaderElectionMixin):
+            def value_changed(self, peer, key, value):
+                seen.append((key, value))
+
+        election = Election(self.clock)
+        election.values_changed('peer', [('a', 1), ('b', 2), ('a', 3)])
+        self.assertEquals(seen, [('a', 3), ('b', 2)])
@@ -0,0 +1,157 @@
+# Copyright (C) 2011 Johan Rydberg
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from collections import OrderedDict
+
+from twisted.trial import unittest
+from twisted.internet import task
+from twisted.internet.address import IPv4Address
+
+from txgossip.codec import JSONCodec
+from txgossip.gossip import Gossiper
+from txgossip.merkle import AntiEntropy, MerkleTree
+from txgossip.recipies import KeyStoreMixin
+
+
+class MerkleTreeTestCase(unittest.TestCase):
+    """Test cases for the hash tree."""
+
+    def test_hash_does_not_depend_on_order(self):
+        a, b = MerkleTree(), MerkleTree()
+        for i in range(100):
+            a.set('k%d' % i, [i, 'v'])
+        for i in reversed(range(100)):
+            b.set('k%d' % i, [0, 'old'])
+            b.set('k%d' % i, [i, 'v'])
+        self.assertEquals(a.hash(), b.hash())
+        self.assertEquals(a.children('1'), b.children('1'))
+
+    def test_hash_does_not_depend_on_dict_order(self):
+        a, b = MerkleTree(), MerkleTree()
+        a.set('k', [1, OrderedDict([('x', 1), ('y', 2)])])
+        b.set('k', [1, OrderedDict([('y', 2), ('x', 1)])])
+        self.assertEquals(a.hash(), b.hash())
+
+    def test_changed_entry_changes_its_path_only(self):
+        a, b = MerkleTree(depth=2), MerkleTree(depth=2)
+        for tree in (a, b):
+            for i in range(100):
+                tree.set('k%d' % i, [i, 'v'])
+        b.set('k1', [200, 'new'])
+        differing = [c for (c, x, y) in zip('0123456789abcdef',
+                                            a.children(''), b.children(''))
+                     if x != y]
+        self.assertEquals(len(differing), 1)
+
+
+class LinkedTransport(object):
+    """Delivers datagrams straight to other gossipers."""
+
+    def __init__(self, port, network):
+        self.port = port
+        self.network = network
+        self.types = []
+
+    def getHost(self):
+        return IPv4Address('UDP', '127.0.0.1', self.port)
+
+    def write(self, data, address):
+        message = JSONCodec().decode(data) if data[:1] == '{' else None
+        self.types.append(message and message['type'])
+        self.network[address[1]].datagramReceived(
+            data, ('127.0.0.1', self.port))
+
+
+class AntiEntropyTestCase(unittest.TestCase):
+    """Test cases for reconciling key stores."""
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.network = {}
+        self.nodes = [self.make_node(9000), self.make_node(9001)]
+
+    def make_node(self, port):
+        keystore = KeyStoreMixin(self.clock, {})
+        gossiper = Gossiper(self.clock, keystore, '127.0.0.1',
+                            codecs=[JSONCodec()])
+        anti_entropy = AntiEntropy(keystore, self.clock)
+        gossiper.subscribe(anti_entropy, prefixes=[''])
+        gossiper.transport = LinkedTransport(port, self.network)
+        self.network[port] = gossiper
+        gossiper.startProtocol()
+        gossiper.stopProtocol()
+        return keystore, gossiper, anti_entropy
+
+    def test_equal_stores_exchange_one_message(self):
+        for keystore, gossiper, anti_entropy in self.nodes:
+            for i in range(50):
+                gossiper.set('k%d' % i, [1, i])
+        self.nodes[0][2].synchronize(('127.0.0.1', 9001))
+        self.assertEquals(self.nodes[0][1].transport.types, ['merkle-hashes'])
+        self.assertEquals(self.nodes[1][1].transport.types, [])
+
+    def test_differing_keys_are_reconciled(self):
+        (a, ga, ea), (b, gb, eb) = self.nodes
+        for i in range(200):
+            ga.set('k%d' % i, [1, i])
+            gb.set('k%d' % i, [1, i])
+        ga.set('k7', [2, 'a'])
+        gb.set('k9', [2, 'b'])
+        gb.set('only-b', [1, 'b'])
+        ea.synchronize(('127.0.0.1', 9001))
+        self.assertEquals(gb.get('k7'), [2, 'a'])
+        self.assertEquals(ga.get('k9'), [2, 'b'])
+        self.assertEquals(ga.get('only-b'), [1, 'b'])
+        self.assertEquals(ea.tree.hash(), eb.tree.hash())
+        entries = (ga.transport.types + gb.transport.types).count(
+            'merkle-entries')
+        self.assertTrue(entries <= 6)
+
+    def test_same_timestamp_is_settled_by_value(self):
+        (a, ga, ea), (b, gb, eb) = self.nodes
+        ga.set('k', [1, 'a'])
+        gb.set('k', [1, 'b'])
+        ea.synchronize(('127.0.0.1', 9001))
+        self.assertEquals(ga.get('k'), [1, 'b'])
+        self.assertEquals(ea.tree.hash(), eb.tree.hash())
+        del ga.transport.types[:]
+        ea.synchronize(('127.0.0.1', 9001))
+        self.assertEquals(ga.transport.types, ['merkle-hashes'])
+
+    def test_loaded_values_are_reconciled(self):
+        (a, ga, ea), (b, gb, eb) = self.nodes
+        a.load_from({'k': [5, 'loaded']})
+        self.assertNotEquals(ea.tree.hash(), eb.tree.hash())
+        ea.synchronize(('127.0.0.1', 9001))
+        self.assertEquals(gb.get('k'), [5, 'loaded'])
+        self.assertEquals(ea.tree.hash(), eb.tree.hash())
+
+    def test_large_leaves_are_split(self):
+        (a, ga, ea), (b, gb, eb) = self.nodes
+        ea.tree = MerkleTree(depth=1)
+        eb.tree = MerkleTree(depth=1)
+        ea.max_bytes = eb.max_bytes = 200
+        for i in range(100):
+            ga.set('k%d' % i, [1, 'x' * 20])
+        ea.synchronize(('127.0.0.1', 9001))
+        self.assertEquals(ea.tree.hash(), eb.tree.hash())
+        self.assertTrue(ga.transport.types.count('merkle-entries') > 16)
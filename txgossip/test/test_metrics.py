@@ -0,0 +1,136 @@
+# Copyright (C) 2011 Johan Rydberg
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from twisted.trial import unittest
+from twisted.internet import task
+from twisted.web.test.requesthelper import DummyRequest
+
+from txgossip.codec import JSONCodec
+from txgossip.metrics import Metrics, MetricsResource, format_text
+from txgossip.test.test_gossip import make_gossiper
+
+
+class MetricsTestCase(unittest.TestCase):
+    """Test cases for the metrics registry."""
+
+    def setUp(self):
+        self.metrics = Metrics()
+
+    def test_same_name_and_labels_give_same_metric(self):
+        self.metrics.counter('sent', type='a').inc()
+        self.metrics.counter('sent', type='a').inc(2)
+        self.metrics.counter('sent', type='b').inc()
+        self.assertEquals(self.metrics.snapshot(),
+                          {'sent{type="a"}': 3, 'sent{type="b"}': 1})
+
+    def test_gauges_and_collectors_are_read_at_snapshot(self):
+        values = [1]
+        self.metrics.gauge('size', lambda: len(values))
+        self.metrics.add_collector(
+            lambda add: add('phi', 0.5, peer='p'))
+        values.append(2)
+        self.assertEquals(self.metrics.snapshot(),
+                          {'size': 2, 'phi{peer="p"}': 0.5})
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = self.metrics.histogram('bytes', (10, 100))
+        for value in (5, 10, 50, 500):
+            histogram.observe(value)
+        self.assertEquals(histogram.get(),
+                          {'buckets': [(10, 2), (100, 3), (None, 4)],
+                           'count': 4, 'sum': 565})
+
+    def test_text_format(self):
+        self.metrics.counter('sent', type='a').inc()
+        self.metrics.histogram('bytes', (10,)).observe(5)
+        self.assertEquals(format_text(self.metrics.snapshot()),
+                          'txgossip_bytes_bucket{le="10"} 1\n'
+                          'txgossip_bytes_bucket{le="+Inf"} 1\n'
+                          'txgossip_bytes_count 1\n'
+                          'txgossip_bytes_sum 5\n'
+                          'txgossip_sent{type="a"} 1\n')
+
+    def test_resource_renders_text(self):
+        self.metrics.counter('sent').inc()
+        request = DummyRequest([''])
+        body = MetricsResource(self.metrics).render_GET(request)
+        self.assertEquals(body, 'txgossip_sent 1\n')
+
+
+class GossiperMetricsTestCase(unittest.TestCase):
+    """Test cases for what a gossiper counts."""
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.gossiper = make_gossiper(self.clock)
+        self.gossiper._setup_state_for_peer('127.0.0.1:9001')
+
+    def snapshot(self):
+        return self.gossiper.metrics.snapshot()
+
+    def test_messages_are_counted_by_type(self):
+        data = JSONCodec().encode({'type': 'request', 'digest': {}})
+        self.gossiper.datagramReceived(data, ('127.0.0.1', 9001))
+        self.gossiper.datagramReceived('garbage', ('127.0.0.1', 9001))
+        snapshot = self.snapshot()
+        self.assertEquals(snapshot['messages_received{type="request"}'], 1)
+        self.assertEquals(snapshot['messages_sent{type="first-response"}'],
+                          1)
+        self.assertEquals(snapshot['datagrams_dropped'], 1)
+        self.assertEquals(snapshot['bytes_received'], len(data) + 7)
+        self.assertEquals(snapshot['bytes_sent'], sum(
+                len(d) for (d, a) in self.gossiper.transport.written))
+
+    def test_messages_with_odd_types_are_counted_as_unknown(self):
+        for message_type in ([1], {'a': 1}, 'other'):
+            self.gossiper.datagramReceived(
+                JSONCodec().encode({'type': message_type}),
+                ('127.0.0.1', 9001))
+        self.assertEquals(self.snapshot()['messages_received{type="unknown"}'],
+                          3)
+
+    def test_applied_and_stale_deltas_are_counted(self):
+        updates = [('127.0.0.1:9001', 'a', 1, 1),
+                   ('127.0.0.1:9001', 'b', 2, 2)]
+        self.gossiper._apply_updates(updates)
+        self.gossiper._apply_updates(updates)
+        snapshot = self.snapshot()
+        self.assertEquals(snapshot['deltas_applied'], 2)
+        self.assertEquals(snapshot['deltas_stale'], 2)
+
+    def test_peer_state_is_reported(self):
+        state = self.gossiper._states['127.0.0.1:9001']
+        state.update_heartbeat(1)
+        state.mark_alive()
+        state.mark_dead()
+        snapshot = self.snapshot()
+        self.assertEquals(snapshot['peer_transitions{to="alive"}'], 1)
+        self.assertEquals(snapshot['peer_transitions{to="dead"}'], 1)
+        self.assertEquals(snapshot['dead_peers'], 1)
+        self.assertEquals(snapshot['digest_peers'], 2)
+        self.assertIn('phi{peer="127.0.0.1:9001"}', snapshot)
+
+    def test_lag_is_recorded(self):
+        self.gossiper.datagramReceived(JSONCodec().encode({
+                    'type': 'request', 'digest': {'127.0.0.1:9001': 7}}),
+                                       ('127.0.0.1', 9001))
+        self.assertEquals(self.snapshot()['versions_behind'], 7)
@@ -0,0 +1,225 @@
+# Copyright (C) 2011 Johan Rydberg
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from mockito import mock
+
+from twisted.trial import unittest
+from twisted.internet import task
+
+from txgossip.state import PeerState
+from txgossip.scuttle import Scuttle, delta_size
+
+
+class ScuttleTestCase(unittest.TestCase):
+    """Test cases for reconciliation of peer states."""
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.participant = mock()
+        self.peers = {}
+        self.local = self.add_peer('self')
+        self.scuttle = Scuttle(self.peers, self.local)
+
+    def add_peer(self, name, keys=0):
+        state = PeerState(self.clock, self.participant, name=name)
+        for i in range(keys):
+            state.update_local('k%d' % i, 'v' * 10)
+        self.peers[name] = state
+        if hasattr(self, 'scuttle'):
+            self.scuttle.add_peer(state)
+        return state
+
+    def test_digest_follows_version_changes(self):
+        state = self.add_peer('a')
+        self.assertEquals(self.scuttle.digest(), {'self': 0, 'a': 0})
+        state.update_with_delta('k', 'v', 7)
+        self.assertEquals(self.scuttle.digest(), {'self': 0, 'a': 7})
+
+    def test_equal_digests_have_equal_hashes(self):
+        self.add_peer('a').update_local('k', 'v')
+        peers = {}
+        other = Scuttle(peers, self.local)
+        for name, version in [('a', 1), ('self', 0)]:
+            state = PeerState(self.clock, self.participant, name=name)
+            peers[name] = state
+            other.add_peer(state)
+            if version:
+                state.update_with_delta('k', 'v', version)
+        self.assertEquals(other.digest_hash, self.scuttle.digest_hash)
+
+    def test_removed_peer_leaves_digest_and_hash(self):
+        digest_hash = self.scuttle.digest_hash
+        self.add_peer('a', keys=3)
+        self.scuttle.remove_peer('a')
+        del self.peers['a']
+        self.assertEquals(self.scuttle.digest(), {'self': 0})
+        self.assertEquals(self.scuttle.digest_hash, digest_hash)
+
+    def test_tombstoned_peers_are_not_requested(self):
+        self.scuttle.tombstones['a'] = 100
+        deltas, requests, new_peers = self.scuttle.scuttle({'a': 3, 'b': 1})
+        self.assertEquals(requests, {'b': 0})
+        self.assertEquals(new_peers, ['b'])
+
+    def test_hash_changes_with_versions(self):
+        state = self.add_peer('a')
+        empty = self.scuttle.digest_hash
+        state.update_local('k', 'v')
+        self.assertNotEquals(self.scuttle.digest_hash, empty)
+
+    def test_scuttle_returns_deltas_for_peers_that_are_behind(self):
+        self.add_peer('a', keys=2)
+        deltas, requests, new_peers = self.scuttle.scuttle({'a': 1})
+        self.assertEquals(deltas, [('a', 'k1', 'v' * 10, 2)])
+        self.assertEquals(requests, {})
+
+    def test_scuttle_requests_newer_and_unknown_peers(self):
+        self.add_peer('a', keys=2)
+        deltas, requests, new_peers = self.scuttle.scuttle(
+            {'a': 5, 'b': 3})
+        self.assertEquals(requests, {'a': 2, 'b': 0})
+        self.assertEquals(new_peers, ['b'])
+
+    def test_deltas_are_bounded_by_budget(self):
+        self.add_peer('a', keys=50)
+        size = delta_size('a', 'k0', 'v' * 10, 1)
+        deltas = self.scuttle.fetch_deltas({'a': 0}, max_bytes=size * 5)
+        self.assertEquals([d[3] for d in deltas], [1, 2, 3, 4, 5])
+
+    def test_leftover_deltas_are_sent_later(self):
+        state = self.add_peer('a', keys=50)
+        size = delta_size('a', 'k10', 'v' * 10, 10)
+        other = PeerState(self.clock, self.participant, name='a')
+        while other.max_version_seen < state.max_version_seen:
+            for peer, key, value, version in self.scuttle.fetch_deltas(
+                    {'a': other.max_version_seen}, max_bytes=size * 7):
+                other.update_with_delta(key, value, version)
+        self.assertEquals(sorted(other.keys()), sorted(state.keys()))
+
+    def test_oversized_delta_is_sent_on_its_own(self):
+        self.add_peer('a', keys=2)
+        deltas = self.scuttle.fetch_deltas({'a': 0}, max_bytes=1)
+        self.assertEquals(len(deltas), 1)
+
+    def test_most_behind_peers_go_first(self):
+        self.add_peer('a', keys=1)
+        self.add_peer('b', keys=3)
+        deltas = self.scuttle.fetch_deltas({'a': 0, 'b': 0})
+        self.assertEquals([d[0] for d in deltas], ['b', 'b', 'b', 'a'])
+
+    def test_round_robin_rotates_first_peer(self):
+        self.scuttle = Scuttle(self.peers, self.local, policy='round-robin')
+        self.add_peer('a', keys=1)
+        self.add_peer('b', keys=1)
+        first = [self.scuttle.fetch_deltas({'a': 0, 'b': 0})[0][0]
+                 for i in range(4)]
+        self.assertEquals(first, ['a', 'b', 'a', 'b'])
+
+    def test_oldest_first_prefers_peers_left_out(self):
+        self.scuttle = Scuttle(self.peers, self.local,
+                               policy='oldest-first')
+        self.add_peer('a', keys=3)
+        self.add_peer('b', keys=3)
+        size = delta_size('a', 'k0', 'v' * 10, 1)
+        deltas = self.scuttle.fetch_deltas({'a': 0, 'b': 0}, size * 3)
+        left_out = 'b' if deltas[0][0] == 'a' else 'a'
+        deltas = self.scuttle.fetch_deltas({'a': 0, 'b': 0}, size * 3)
+        self.assertEquals(deltas[0][0], left_out)
+
+    def test_unknown_policy_is_rejected(self):
+        self.assertRaises(ValueError, Scuttle, self.peers, self.local,
+                          policy='whatever')
+
+    def test_full_digest_is_sent_unless_size_is_set(self):
+        self.add_peer('a')
+        self.assertEquals(self.scuttle.digest_slice(),
+                          self.scuttle.digest())
+
+    def test_window_covers_all_peers(self):
+        for i in range(10):
+            self.add_peer('p%d' % i)
+        self.scuttle.digest_size = 3
+        seen = set()
+        for i in range(4):
+            digest = self.scuttle.digest_slice()
+            self.assertIn('self', digest)
+            self.assertTrue(len(digest) <= 4)
+            seen.update(digest)
+        self.assertEquals(seen, set(self.scuttle.digest()))
+
+    def test_random_slice_is_bounded(self):
+        for i in range(10):
+            self.add_peer('p%d' % i)
+        self.scuttle.digest_size = 3
+        self.scuttle.digest_mode = 'random'
+        digest = self.scuttle.digest_slice()
+        self.assertIn('self', digest)
+        self.assertTrue(len(digest) <= 4)
+
+    def test_recent_slice_holds_recently_updated_peers(self):
+        states = [self.add_peer('p%d' % i) for i in range(10)]
+        states[4].update_with_delta('k', 'v', 3)
+        states[7].update_with_delta('k', 'v', 5)
+        self.scuttle.digest_size = 4
+        self.scuttle.digest_mode = 'recent'
+        digest = self.scuttle.digest_slice()
+        self.assertEquals(len(digest), 5)
+        self.assertEquals((digest['p4'], digest['p7']), (3, 5))
+
+    def test_recent_slice_covers_peers_that_do_not_change(self):
+        states = [self.add_peer('p%d' % i) for i in range(10)]
+        self.scuttle.digest_size = 4
+        self.scuttle.digest_mode = 'recent'
+        seen = set()
+        for version in range(1, 11):
+            states[0].update_with_delta('k', 'v', version)
+            seen.update(self.scuttle.digest_slice())
+        self.assertEquals(seen, set(self.peers))
+
+    def test_scuttle_only_reconciles_peers_in_slice(self):
+        self.add_peer('a', keys=1)
+        self.add_peer('b', keys=1)
+        deltas, requests, new_peers = self.scuttle.scuttle({'a': 0})
+        self.assertEquals([d[0] for d in deltas], ['a'])
+
+    def test_heartbeat_slice_covers_digest_slice_unless_size_is_set(self):
+        self.add_peer('a')
+        self.assertEquals(self.scuttle.heartbeat_slice(),
+                          {'self': 0, 'a': 0})
+
+    def test_heartbeat_slice_hands_out_changes_oldest_first(self):
+        for i in range(5):
+            self.add_peer('p%d' % i)
+        self.scuttle.heartbeat_size = 2
+        self.scuttle.update_heartbeats({'p3': 1, 'p1': 1, 'p4': 1})
+        self.assertEquals(self.scuttle.heartbeat_slice(),
+                          {'self': 0, 'p3': 1, 'p1': 1})
+        self.scuttle.update_heartbeats({'p3': 2})
+        self.assertEquals(self.scuttle.heartbeat_slice(),
+                          {'self': 0, 'p4': 1, 'p3': 2})
+        self.assertEquals(self.scuttle.heartbeat_slice(), {'self': 0})
+
+    def test_old_heartbeats_are_not_handed_out(self):
+        self.add_peer('a').update_heartbeat(3)
+        self.scuttle.heartbeat_size = 2
+        self.scuttle.update_heartbeats({'a': 2})
+        self.assertEquals(self.scuttle.heartbeat_slice(), {'self': 0})
@@ -0,0 +1,167 @@
+# Copyright (C) 2011 Johan Rydberg
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import random
+
+from twisted.internet import task
+from twisted.internet.protocol import DatagramProtocol
+from twisted.trial import unittest
+
+from txgossip.simulation import Network, Simulation
+
+
+class Receiver(DatagramProtocol):
+
+    def __init__(self):
+        self.received = []
+
+    def datagramReceived(self, data, address):
+        self.received.append((data, address))
+
+
+class NetworkTestCase(unittest.TestCase):
+    """Test cases for the in-memory network."""
+
+    def setUp(self):
+        self.network = Network(latency=0.5)
+        self.a, self.b = Receiver(), Receiver()
+        self.network.listenUDP(1, self.a)
+        self.network.listenUDP(2, self.b)
+
+    def test_datagrams_arrive_after_latency(self):
+        self.a.transport.write('x', ('127.0.0.1', 2))
+        self.network.clock.advance(0.4)
+        self.assertEquals(self.b.received, [])
+        self.network.clock.advance(0.1)
+        self.assertEquals(self.b.received, [('x', ('127.0.0.1', 1))])
+        self.assertEquals((self.network.messages, self.network.bytes), (1, 1))
+
+    def test_partition_drops_datagrams_until_healed(self):
+        self.network.partition([('127.0.0.1', 1)])
+        self.a.transport.write('x', ('127.0.0.1', 2))
+        self.network.clock.advance(1)
+        self.network.heal()
+        self.a.transport.write('y', ('127.0.0.1', 2))
+        self.network.clock.advance(1)
+        self.assertEquals([d for (d, a) in self.b.received], ['y'])
+        self.assertEquals(self.network.dropped, 1)
+
+    def test_reordered_datagrams_are_overtaken(self):
+        network = Network(latency=0.1, reorder=0.5, seed=3)
+        a, b = Receiver(), Receiver()
+        network.listenUDP(1, a)
+        network.listenUDP(2, b)
+        for i in range(20):
+            a.transport.write(str(i), ('127.0.0.1', 2))
+        network.clock.advance(1)
+        data = [int(d) for (d, address) in b.received]
+        self.assertEquals(sorted(data), range(20))
+        self.assertNotEquals(data, range(20))
+
+    def test_loss_is_repeatable(self):
+        def run():
+            network = Network(loss=0.3, seed=7)
+            a, b = Receiver(), Receiver()
+            network.listenUDP(1, a)
+            network.listenUDP(2, b)
+            for i in range(50):
+                a.transport.write(str(i), ('127.0.0.1', 2))
+            network.clock.advance(1)
+            return b.received
+        self.assertEquals(run(), run())
+        self.assertTrue(0 < len(run()) < 50)
+
+
+class SimulationTestCase(unittest.TestCase):
+    """Test cases for running a cluster on the simulated network."""
+
+    def setUp(self):
+        random.seed(0)
+        self.simulation = Simulation(10)
+
+    def test_cluster_converges(self):
+        report = self.simulation.measure(timeout=60)
+        self.assertNotEquals(report['join_time'], None)
+        self.assertNotEquals(report['propagation_time'], None)
+        self.assertTrue(report['join_messages'] > 0)
+        self.assertEquals(report['false_positives'], 0)
+
+    def test_runs_with_the_same_seed_are_identical(self):
+        def run():
+            random.seed(0)
+            return Simulation(10).measure(timeout=60)
+        self.assertEquals(run(), run())
+
+    def test_heartbeats_are_not_published_as_key(self):
+        self.simulation.run_until(self.simulation.membership_converged, 60)
+        self.simulation.run(30)
+        for gossiper in self.simulation.gossipers:
+            self.assertNotIn('__heartbeat__', gossiper.state)
+            self.assertFalse(gossiper._has_legacy_peers())
+
+    def test_stopped_node_is_detected(self):
+        self.simulation.run_until(self.simulation.membership_converged, 60)
+        self.simulation.stop(5)
+        self.assertNotEquals(
+            self.simulation.run_until(self.simulation.membership_converged,
+                                      60), None)
+        self.assertEquals(self.simulation.false_positives, 0)
+
+    def test_stopped_node_in_larger_cluster_is_detected_in_time(self):
+        random.seed(0)
+        simulation = Simulation(40)
+        simulation.run_until(simulation.membership_converged, 60)
+        simulation.run(30)
+        simulation.stop(3)
+        elapsed = simulation.run_until(simulation.membership_converged, 50)
+        self.assertNotEquals(elapsed, None)
+        self.assertEquals(simulation.false_positives, 0)
+
+    def test_partitioned_nodes_are_false_positives(self):
+        self.simulation.run_until(self.simulation.membership_converged, 60)
+        self.simulation.network.partition(
+            [('127.0.0.1', 10000 + i) for i in range(5)])
+        self.simulation.run(30)
+        self.assertTrue(self.simulation.false_positives > 0)
+
+    def test_recent_digest_slices_converge(self):
+        random.seed(0)
+        simulation = Simulation(10, digest_size=2, digest_mode='recent')
+        simulation.run_until(simulation.membership_converged, 60)
+        busy = task.LoopingCall(lambda: [
+                gossiper.set('busy', simulation.clock.seconds())
+                for gossiper in simulation.gossipers[1:4]])
+        busy.clock = simulation.clock
+        busy.start(0.5)
+        simulation.run(5)
+        # The value has to be passed on by the peers that got it
+        # before its origin went down, while busy peers keep the
+        # slices of recent changes full.
+        origin = simulation.gossipers[0]
+        origin.set('k', 'v')
+        simulation.run(1)
+        simulation.stop(0)
+        self.assertNotEquals(
+            simulation.run_until(
+                lambda: simulation.value_converged(origin, 'k', 'v'), 120),
+            None)
+        busy.stop()
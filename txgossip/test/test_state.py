@@ -0,0 +1,276 @@
+# Copyright (C) 2011 Johan Rydberg
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import random
+
+from mockito import any, mock, verify
+
+from twisted.trial import unittest
+from twisted.internet import task
+
+from txgossip.state import Membership, PeerSet, PeerState, ValueStore
+
+
+class PeerSetTestCase(unittest.TestCase):
+    """Test cases for the indexed peer set."""
+
+    def test_add_and_discard(self):
+        peers = PeerSet()
+        items = [object() for i in range(5)]
+        for item in items:
+            peers.add(item)
+        peers.add(items[0])
+        self.assertEquals(len(peers), 5)
+        peers.discard(items[1])
+        peers.discard(items[4])
+        peers.discard(items[4])
+        self.assertEquals(set(peers), set([items[0], items[2], items[3]]))
+        self.assertNotIn(items[1], peers)
+        self.assertIn(items[3], peers)
+
+    def test_random_selection(self):
+        peers = PeerSet()
+        items = [object() for i in range(5)]
+        for item in items:
+            peers.add(item)
+        self.assertIn(peers.choice(), items)
+        self.assertEquals(len(set(random.sample(peers, 5))), 5)
+
+
+class CountingPeerState(PeerState):
+
+    checks = 0
+
+    def check_suspected(self):
+        self.checks += 1
+        return PeerState.check_suspected(self)
+
+
+class MembershipTestCase(unittest.TestCase):
+    """Test cases for deadline-driven failure suspicion."""
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.membership = Membership()
+        self.states = []
+        for i in range(10):
+            state = CountingPeerState(self.clock, mock(), name='p%d' % i)
+            self.membership.add(state)
+            self.states.append(state)
+
+    def beat(self, state):
+        state.update_with_delta('__heartbeat__', state.heart_beat_version + 1,
+                                state.max_version_seen + 1)
+
+    def tick(self):
+        self.clock.advance(1)
+        self.membership.check_suspected(self.clock.seconds())
+
+    def test_heartbeat_makes_peer_alive(self):
+        self.beat(self.states[0])
+        self.tick()
+        self.assertTrue(self.states[0].alive)
+        self.assertIn(self.states[0], self.membership.live)
+
+    def test_only_peers_with_news_are_checked(self):
+        for i in range(20):
+            self.beat(self.states[0])
+            self.tick()
+        self.assertEquals(self.states[0].checks, 20)
+        self.assertEquals([s.checks for s in self.states[1:]], [0] * 9)
+
+    def test_silent_peer_is_suspected_after_deadline(self):
+        state = self.states[0]
+        for i in range(5):
+            self.beat(state)
+            self.tick()
+        deadline = state.detector.deadline(state.PHI)
+        while self.clock.seconds() < deadline:
+            self.assertTrue(state.alive)
+            self.tick()
+        self.tick()
+        self.assertFalse(state.alive)
+        self.assertIn(state, self.membership.dead)
+
+    def test_removed_peer_is_not_checked(self):
+        state = self.states[0]
+        self.beat(state)
+        self.membership.remove(state)
+        self.tick()
+        self.assertEquals(state.checks, 0)
+
+    def test_heartbeat_key_and_channel_count_once(self):
+        state = self.states[0]
+        for i in range(1, 4):
+            state.update_heartbeat(i)
+            state.update_with_delta('__heartbeat__', i,
+                                    state.max_version_seen + 1)
+            self.tick()
+        self.assertEquals(len(state.detector.intervals), 3)
+
+    def test_only_live_legacy_peers_are_counted(self):
+        a, b = self.states[0], self.states[1]
+        self.membership.mark_legacy(a, True)
+        self.membership.mark_legacy(b, True)
+        self.assertEquals(self.membership.live_legacy, 0)
+        a.mark_alive()
+        self.assertEquals(self.membership.live_legacy, 1)
+        self.membership.mark_legacy(a, True)
+        self.assertEquals(self.membership.live_legacy, 1)
+        a.mark_dead()
+        self.assertEquals(self.membership.live_legacy, 0)
+        b.mark_alive()
+        self.membership.mark_legacy(b, False)
+        self.assertEquals(self.membership.live_legacy, 0)
+        a.mark_alive()
+        self.membership.remove(a)
+        self.assertEquals(self.membership.live_legacy, 0)
+
+
+class DeltaLogTestCase(unittest.TestCase):
+    """Test cases for the version-ordered delta log."""
+
+    def setUp(self):
+        self.state = PeerState(task.Clock(), mock(), name='p')
+
+    def test_deltas_are_sorted_by_version(self):
+        for key in 'abcab':
+            self.state.update_local(key, key.upper())
+        self.assertEquals(self.state.deltas_after_version(0),
+                          [('c', 'C', 3), ('a', 'A', 4), ('b', 'B', 5)])
+
+    def test_deltas_after_version(self):
+        for i in range(10):
+            self.state.update_local('k%d' % i, i)
+        self.assertEquals(self.state.deltas_after_version(8),
+                          [('k8', 8, 9), ('k9', 9, 10)])
+        self.assertEquals(self.state.deltas_after_version(10), [])
+
+    def test_log_is_compacted(self):
+        for i in range(1000):
+            self.state.update_local('k%d' % (i % 10), i)
+        self.assertTrue(len(self.state._log_versions) < 100)
+        self.assertEquals([d[2] for d in self.state.deltas_after_version(0)],
+                          range(991, 1001))
+
+    def test_remote_deltas_are_logged(self):
+        self.state.update_with_delta('a', 1, 4)
+        self.state.update_with_delta('b', 2, 9)
+        self.state.update_with_delta('a', 3, 12)
+        self.assertEquals(self.state.deltas_after_version(4),
+                          [('b', 2, 9), ('a', 3, 12)])
+
+
+class LoadTestCase(unittest.TestCase):
+    """Test cases for installing state in bulk."""
+
+    def setUp(self):
+        self.participant = mock()
+        self.state = PeerState(task.Clock(), self.participant, name='p')
+        self.listener = mock()
+        self.state.listener = self.listener
+
+    def test_keys_get_consecutive_versions(self):
+        self.state.update_local('a', 1)
+        self.state.load([('b', 2), ('c', 3), ('a', 4)])
+        self.assertEquals(self.state.max_version_seen, 4)
+        self.assertEquals(self.state.deltas_after_version(1),
+                          [('b', 2, 2), ('c', 3, 3), ('a', 4, 4)])
+
+    def test_set_many_notifies_after_version_change(self):
+        self.state.set_many({'a': 1})
+        verify(self.listener, times=1).version_changed(self.state, 0)
+        verify(self.participant).value_changed(self.state, 'a', 1)
+        self.assertEquals(self.state.max_version_seen, 1)
+
+    def test_load_changes_version_once_and_is_silent(self):
+        self.state.load([('k%d' % i, i) for i in range(100)])
+        verify(self.listener, times=1).version_changed(self.state, 0)
+        verify(self.participant, times=0).value_changed(any(), any(), any())
+
+
+class ValueStoreTestCase(unittest.TestCase):
+    """Test cases for sharing values between peer states."""
+
+    def setUp(self):
+        self.values = ValueStore()
+        clock = task.Clock()
+        self.a = PeerState(clock, mock(), name='a', values=self.values)
+        self.b = PeerState(clock, mock(), name='b', values=self.values)
+
+    def test_equal_values_are_shared(self):
+        self.a.update_with_delta('k', (1.5, u'value'), 1)
+        self.b.update_with_delta('k', (1.5, u'value'), 1)
+        self.assertIdentical(self.a.get('k'), self.b.get('k'))
+        self.assertEquals(len(self.values), 1)
+
+    def test_lists_and_dicts_are_copied_but_share_their_items(self):
+        for state in [self.a, self.b]:
+            state.update_with_delta('k', [1.5, {u'key': u'value'}], 1)
+        a, b = self.a.get('k'), self.b.get('k')
+        self.assertNotIdentical(a, b)
+        self.assertNotIdentical(a[1], b[1])
+        self.assertIdentical(a[1][u'key'], b[1][u'key'])
+        a[1][u'key'] = u'changed'
+        self.assertEquals(b, [1.5, {u'key': u'value'}])
+
+    def test_values_holding_nan_are_released(self):
+        nan = float('nan')
+        self.a.set('k', (nan, u'x'))
+        self.b.set('k', (float('nan'), u'x'))
+        self.a.set('k', 1)
+        self.b.set('k', 1)
+        self.assertEquals(len(self.values), 0)
+
+    def test_values_of_different_types_are_kept_apart(self):
+        self.a.set('k', (1, 2))
+        self.b.set('k', [1, 2])
+        self.assertEquals(type(self.b.get('k')), list)
+
+    def test_dict_keys_of_different_types_are_kept_apart(self):
+        self.a.set('k', {'1': 'x'})
+        self.b.set('k', {1: 'x'})
+        self.assertEquals(self.b.get('k').keys(), [1])
+
+    def test_nested_values_of_different_types_are_kept_apart(self):
+        self.a.set('k', [[1, 2]])
+        self.b.set('k', [(1, 2)])
+        self.assertEquals(type(self.b.get('k')[0]), tuple)
+
+    def test_nested_strings_of_different_types_are_kept_apart(self):
+        self.a.set('k', ['a'])
+        self.b.set('k', [u'a'])
+        self.assertEquals(type(self.b.get('k')[0]), unicode)
+
+    def test_signed_zeros_are_kept_apart(self):
+        self.a.set('k', [0.0])
+        self.b.set('k', [-0.0])
+        self.assertEquals(repr(self.b.get('k')[0]), '-0.0')
+
+    def test_unreferenced_value_is_dropped(self):
+        self.a.set('k', [1, u'x'])
+        self.b.set('k', [1, u'x'])
+        self.a.set('k', [2, u'y'])
+        self.assertEquals(len(self.values), 2)
+        self.b.load([('k', [3, u'z'])])
+        self.assertEquals(len(self.values), 2)
+        self.assertEquals(self.b.get('k'), [3, u'z'])
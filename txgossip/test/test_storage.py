@@ -0,0 +1,75 @@
+# Copyright (C) 2011 Johan Rydberg
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+
+from twisted.trial import unittest
+
+from txgossip.storage import LogStorage
+
+
+class LogStorageTestCase(unittest.TestCase):
+    """Test cases for the snapshot and log storage."""
+
+    def setUp(self):
+        self.path = os.path.join(self.mktemp(), 'store')
+        os.makedirs(os.path.dirname(self.path))
+
+    def reopen(self, storage, **kwargs):
+        storage.close()
+        return LogStorage(self.path, **kwargs)
+
+    def test_values_survive_reopen(self):
+        storage = LogStorage(self.path)
+        storage['a'] = [1.0, 'x']
+        storage['b'] = [2.0, {'y': 1}]
+        storage['a'] = [3.0, 'z']
+        del storage['b']
+        storage = self.reopen(storage)
+        self.assertEquals(dict(storage.items()), {'a': [3.0, 'z']})
+        storage.close()
+
+    def test_log_is_compacted_into_snapshot(self):
+        storage = LogStorage(self.path, min_compact=10)
+        for i in range(20):
+            storage['k%d' % (i % 3)] = [i, i]
+        storage.sync()
+        self.assertEquals(os.path.getsize(self.path + '.log'), 0)
+        storage['k0'] = [20, 20]
+        storage = self.reopen(storage)
+        self.assertEquals(dict(storage.items()),
+                          {'k0': [20, 20], 'k1': [19, 19], 'k2': [17, 17]})
+        storage.close()
+
+    def test_torn_record_is_dropped(self):
+        storage = LogStorage(self.path)
+        storage['a'] = [1, 'x']
+        storage.close()
+        with open(self.path + '.log', 'ab') as f:
+            f.write('["b",[2,')
+        storage = LogStorage(self.path)
+        self.assertEquals(dict(storage.items()), {'a': [1, 'x']})
+        storage['c'] = [3, 'z']
+        storage = self.reopen(storage)
+        self.assertEquals(dict(storage.items()),
+                          {'a': [1, 'x'], 'c': [3, 'z']})
+        storage.close()